@@ -0,0 +1,199 @@
+# ksp-compiler - a compiler for the Kontakt script language
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''Compiling several scripts in one go (e.g. all script slots of an instrument).
+
+   The compiler keeps its state in module-level tables, so compilations cannot run side by side in threads of the same process.
+   Instead each script is handed to a pool of worker processes. Every worker keeps its own ImportCache alive for the whole batch,
+   so a library imported by several scripts is only parsed once per worker. When only one worker is requested (or no worker
+   process can be started) the scripts are compiled one after another in the calling process, sharing a single ImportCache.'''
+
+import re
+import os
+import traceback
+import concurrent.futures
+from datetime import datetime
+
+import ksp_ast
+import ksp_compiler
+import utils
+
+# import cache kept alive for the lifetime of the process (one per worker process when a pool is used)
+process_import_cache = ksp_compiler.ImportCache()
+
+
+class CompileJob(object):
+    '''Source code of one script together with the compiler options to use for it'''
+
+    def __init__(self, source, basedir = None, filename = None, options = None):
+        self.source = source
+        self.basedir = basedir
+        self.filename = filename
+        self.options = options or {}
+
+
+class CompileResult(object):
+    '''Outcome of a CompileJob. Only holds plain data so that it can be sent back from a worker process'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.success = False
+        self.aborted = False
+        self.compiled_code = None
+        self.output_files = []
+        self.short2original = {}
+        self.error_message = None
+        self.error_filename = None
+        self.error_lineno = None     # zero-based line number within error_filename
+        self.duration = None
+
+
+def describe_compile_error(compiler, e, main_filename = None):
+    '''Returns a (message, filename, zero-based line number) tuple describing where a compilation error happened.
+       A filename of None in the line locations refers to the main script, which is then replaced by main_filename.'''
+    error_msg = None
+    error_lineno = None
+    error_filename = main_filename
+
+    if isinstance(e, ksp_ast.ParseException):
+        error_msg = str(e)
+        line_object = None
+
+        if compiler and e.lineno is not None and 0 <= e.lineno < len(compiler.lines):
+            line_object = compiler.lines[e.lineno]
+
+        if line_object:
+            error_lineno = line_object.lineno - 1
+            error_filename = line_object.filename or main_filename
+            error_msg = re.sub(r'line (\d+)', 'line %s' % line_object.lineno, error_msg)
+    elif isinstance(e, ksp_compiler.ParseException):
+        error_lineno = e.line.lineno - 1
+        error_filename = e.line.filename or main_filename
+        error_msg = e.message
+    else:
+        error_msg = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+
+    return (error_msg, error_filename, error_lineno)
+
+
+def compile_job(job, import_cache = None):
+    '''Compiles a single job and returns a CompileResult. This is the function executed by the worker processes.'''
+    result = CompileResult(job.filename)
+    t1 = datetime.now()
+    compiler = None
+
+    if import_cache is None:
+        import_cache = process_import_cache
+
+    try:
+        compiler = ksp_compiler.KSPCompiler(job.source, job.basedir, import_cache = import_cache, **job.options)
+
+        if compiler.compile():
+            result.success = True
+            result.compiled_code = compiler.compiled_code.replace('\r', '')
+            result.output_files = [f if os.path.isabs(f) or not job.basedir else os.path.join(job.basedir, f)
+                                   for f in compiler.output_files]
+            result.short2original = compiler.short2original
+        else:
+            result.aborted = True
+    except Exception as e:
+        result.error_message, result.error_filename, result.error_lineno = describe_compile_error(compiler, e, job.filename)
+
+    result.duration = datetime.now() - t1
+
+    return result
+
+
+class BatchCompiler(object):
+    '''Compiles a list of CompileJob objects, using up to max_workers worker processes.
+       python_executable can be used to point the worker processes at a Python interpreter when the calling
+       process is not a regular Python interpreter (e.g. the Sublime Text plugin host).'''
+
+    def __init__(self, jobs, max_workers = 1, python_executable = None):
+        self.jobs = jobs
+        self.max_workers = max(1, min(max_workers or 1, len(jobs)))
+        self.python_executable = python_executable
+        self.abort_requested = False
+        self.executor = None
+        self.futures = {}
+
+    def create_executor(self):
+        import multiprocessing
+
+        context = multiprocessing.get_context('spawn')
+
+        if self.python_executable:
+            context.set_executable(self.python_executable)
+
+        return concurrent.futures.ProcessPoolExecutor(max_workers = self.max_workers, mp_context = context)
+
+    def run(self, on_result = None):
+        '''Compiles all jobs and returns the list of CompileResult objects in the same order as the jobs.
+           on_result(result, num_done, num_total) is invoked as soon as each individual script has been compiled.'''
+        results = [None] * len(self.jobs)
+        num_done = 0
+
+        def report(index, result):
+            nonlocal num_done
+
+            num_done += 1
+            results[index] = result
+
+            if on_result:
+                on_result(result, num_done, len(self.jobs))
+
+        if self.max_workers > 1:
+            try:
+                self.executor = self.create_executor()
+            except Exception as e:
+                utils.log_message('Could not start compile worker processes (%s), compiling scripts one by one instead.' % e)
+                self.executor = None
+
+        if self.executor is None:
+            for index, job in enumerate(self.jobs):
+                if self.abort_requested:
+                    break
+
+                report(index, compile_job(job))
+
+            return results
+
+        try:
+            self.futures = dict((self.executor.submit(compile_job, job), index) for (index, job) in enumerate(self.jobs))
+
+            for future in concurrent.futures.as_completed(self.futures):
+                if self.abort_requested:
+                    break
+
+                index = self.futures[future]
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # the worker process itself failed (e.g. it could not be started)
+                    result = CompileResult(self.jobs[index].filename)
+                    result.error_message = 'Compile worker failed: %s' % e
+
+                report(index, result)
+        finally:
+            self.executor.shutdown(wait = not self.abort_requested)
+            self.executor = None
+            self.futures = {}
+
+        return results
+
+    def abort(self):
+        self.abort_requested = True
+
+        for future in list(self.futures):
+            future.cancel()
@@ -0,0 +1,187 @@
+# ksp-compiler - a compiler for the Kontakt script language
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''Call graph of the functions of a script, shared by the compiler and the optimization passes in ksp_compiler_extras.
+
+   Nodes are function names, None represents the callbacks. All traversals are iterative, so that long call chains
+   cannot run into Python's recursion limit.'''
+
+from collections import OrderedDict
+
+
+def sort_key(node):
+    return '' if node is None else node
+
+
+class CallGraph(object):
+    '''Directed graph where an edge (a, b) means that function a invokes function b.
+       Every edge is stored once, together with the number of call sites it stands for.'''
+
+    def __init__(self):
+        self.edges = OrderedDict()   # node -> OrderedDict(successor -> number of call sites)
+
+    def add_node(self, node):
+        if node not in self.edges:
+            self.edges[node] = OrderedDict()
+
+    def add_edge(self, source, target):
+        self.add_node(source)
+        self.add_node(target)
+
+        successors = self.edges[source]
+        successors[target] = successors.pop(target, 0) + 1   # keep successors in the order of their last call site
+
+    def successors(self, node):
+        return list(self.edges.get(node, ()))
+
+    def multiplicity(self, source, target):
+        '''Returns the number of call sites in source that invoke target'''
+        return self.edges.get(source, {}).get(target, 0)
+
+    def nodes(self):
+        '''Returns all nodes in sorted order (None first)'''
+        return sorted(self.edges, key = sort_key)
+
+    def clear(self):
+        self.edges.clear()
+
+    def __contains__(self, node):
+        return node in self.edges
+
+    def __len__(self):
+        return len(self.edges)
+
+    def __iter__(self):
+        return iter(self.edges)
+
+    def reachable(self, start_nodes):
+        '''Returns the set of nodes reachable from (and including) the given start nodes, using a depth-first traversal'''
+        visited = set()
+        stack = list(start_nodes)
+
+        while stack:
+            node = stack.pop()
+
+            if node not in visited:
+                visited.add(node)
+                stack.extend(n for n in self.edges.get(node, ()) if n not in visited)
+
+        return visited
+
+    def strongly_connected_components(self):
+        '''Returns the strongly connected components of the graph (Tarjan's algorithm), each as a list of nodes.
+           A component is returned only after all components reachable from it.'''
+        index = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        components = []
+
+        for root in self.nodes():
+            if root in index:
+                continue
+
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.edges[root]))]
+
+            while work:
+                node, successors = work[-1]
+
+                for successor in successors:
+                    if successor not in index:
+                        index[successor] = lowlink[successor] = len(index)
+                        stack.append(successor)
+                        on_stack.add(successor)
+                        work.append((successor, iter(self.edges[successor])))
+                        break
+                    elif successor in on_stack:
+                        lowlink[node] = min(lowlink[node], index[successor])
+                else:
+                    work.pop()
+
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+                    if lowlink[node] == index[node]:
+                        component = []
+
+                        while True:
+                            n = stack.pop()
+                            on_stack.discard(n)
+                            component.append(n)
+
+                            if n == node:
+                                break
+
+                        components.append(sorted(component, key = sort_key))
+
+        return components
+
+    def cycle_through(self, component):
+        '''Returns a shortest cycle, eg. [a, b, a], that starts at the first node of a strongly connected component
+           and stays within it, or None if there is no such cycle (a single node that does not invoke itself)'''
+        members = set(component)
+        start = component[0]
+        parents = {}
+        queue = [start]
+
+        for node in queue:
+            for successor in self.edges[node]:
+                if successor == start:
+                    path = [start]
+
+                    while node != start:
+                        path.append(node)
+                        node = parents[node]
+
+                    return [start] + path[1:][::-1] + [start]
+
+                if successor in members and successor not in parents:
+                    parents[successor] = node
+                    queue.append(successor)
+
+        return None
+
+    def find_cycles(self):
+        '''Returns one cycle for every group of mutually recursive functions (empty if there is no recursion)'''
+        cycles = [self.cycle_through(component) for component in self.strongly_connected_components()]
+
+        return sorted((c for c in cycles if c), key = lambda c: [sort_key(n) for n in c])
+
+    def topological_sort(self):
+        '''Returns the nodes such that each node comes before the nodes it invokes.
+           Ties are broken by the sorted order of the nodes and the order of the call sites, so the result is deterministic.'''
+        nodes = self.nodes()
+        count = dict((node, 0) for node in nodes)
+
+        for node in nodes:
+            for successor, multiplicity in self.edges[node].items():
+                count[successor] += multiplicity
+
+        ready = [node for node in nodes if count[node] == 0]
+        result = []
+
+        while ready:
+            node = ready.pop(-1)
+            result.append(node)
+
+            for successor, multiplicity in self.edges[node].items():
+                count[successor] -= multiplicity
+
+                if count[successor] == 0:
+                    ready.append(successor)
+
+        return result
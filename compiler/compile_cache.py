@@ -0,0 +1,153 @@
+# ksp-compiler - a compiler for the Kontakt script language
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''On-disk cache of complete compilation results.
+
+   An entry is found by a key made of everything known before compiling (the main source, the compiler options and the
+   compiler version), and is only used if every other input it recorded (imported files, imported folders, nckp files
+   and so on) is still the same. Entries are evicted when they get too old or the cache gets too big.'''
+
+import hashlib
+import os
+import pickle
+import time
+
+
+class CompileCacheEntry(object):
+    '''The result of one compilation together with the inputs it depends on.
+       dependencies is a list of (kind, path, fingerprint) tuples, where the meaning of kind and fingerprint is up to the compiler.'''
+
+    def __init__(self, compiled_code, output_files, short2original, effective_options, dependencies):
+        self.compiled_code = compiled_code
+        self.output_files = output_files
+        self.short2original = short2original
+        self.effective_options = effective_options
+        self.dependencies = dependencies
+
+    def fingerprint(self, key):
+        '''Hash of all inputs of the compilation: the lookup key, the dependencies and the effective compiler options'''
+        sha = hashlib.sha1(key.encode('utf-8'))
+        sha.update(repr((sorted(self.dependencies), sorted(self.effective_options.items()))).encode('utf-8'))
+
+        return sha.hexdigest()
+
+    def is_up_to_date(self, fingerprint_func):
+        '''Returns True if fingerprint_func(kind, path) still gives the recorded fingerprint of every dependency'''
+        return all(fingerprint_func(kind, path) == fingerprint for (kind, path, fingerprint) in self.dependencies)
+
+
+class CompileCache(object):
+    '''Folder with one file per cached compilation. Entries older than max_age seconds are removed, and when the files
+       together take more than max_size bytes, the least recently used ones are removed until they fit again.'''
+
+    format_version = 1
+
+    def __init__(self, path, max_size = 64 * 1024 * 1024, max_age = 30 * 24 * 3600):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def default_path():
+        base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+
+        return os.path.join(base, 'ksp_compiler', 'compile_cache')
+
+    @staticmethod
+    def make_key(*parts):
+        sha = hashlib.sha1()
+
+        for part in parts:
+            sha.update(repr(part).encode('utf-8'))
+            sha.update(b'\0')
+
+        return sha.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + '.kspc')
+
+    def lookup(self, key, fingerprint_func):
+        '''Returns the entry stored for key if all of its dependencies are unchanged, otherwise None'''
+        path = self.entry_path(key)
+        entry = None
+
+        try:
+            with open(path, 'rb') as f:
+                version, entry = pickle.load(f)
+
+            if version != self.format_version or not entry.is_up_to_date(fingerprint_func):
+                entry = None
+        except (IOError, OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        try:
+            os.utime(path)   # the modification time tells which entries were used least recently
+        except OSError:
+            pass
+
+        return entry
+
+    def store(self, key, entry):
+        os.makedirs(self.path, exist_ok = True)
+
+        path = self.entry_path(key)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+
+        with open(temp_path, 'wb') as f:
+            pickle.dump((self.format_version, entry), f, protocol = pickle.HIGHEST_PROTOCOL)
+
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self, now = None):
+        '''Removes entries that are too old, then the least recently used entries until the cache is small enough.
+           Returns the number of removed entries.'''
+        now = time.time() if now is None else now
+        entries = []
+
+        for name in os.listdir(self.path):
+            if name.endswith('.kspc'):
+                path = os.path.join(self.path, name)
+
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort()
+        total_size = sum(size for (mtime, size, path) in entries)
+        removed = 0
+
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age and total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+
+            total_size -= size
+
+        return removed
@@ -0,0 +1,78 @@
+# ksp-compiler - a compiler for the Kontakt script language
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''Writing compiled code to the save_compiled_source targets.
+
+   A target is only rewritten when its content changes, so that unchanged outputs keep their modification time
+   and don't trigger Kontakt's script reloading or downstream builds.'''
+
+import hashlib
+import os
+import re
+
+from name_compaction import output_reverse_map_path, load_reverse_map, save_reverse_map
+
+date_header_re = re.compile(br'^\{ Compiled on [^}\r\n]* \}\r?\n')
+
+
+def encode_compiled_code(code):
+    '''Returns the bytes a compiled code file consists of (latin-1 and the line endings of the platform)'''
+    return code.replace('\n', os.linesep).encode('latin-1')
+
+
+def content_digest(data, ignore_date_header = False):
+    if ignore_date_header:
+        data = date_header_re.sub(b'', data, count = 1)
+
+    return hashlib.sha1(data).digest()
+
+
+def write_if_changed(path, code, ignore_date_header = False):
+    '''Writes code to path unless the file already has that content, optionally not counting a different compilation
+       date comment as a change. The file is written to a temporary file first and then renamed, so that it is never
+       seen half-written. Returns True if the file was written.'''
+    data = encode_compiled_code(code)
+
+    try:
+        with open(path, 'rb') as f:
+            old_data = f.read()
+    except (IOError, OSError):
+        old_data = None
+
+    if old_data is not None and content_digest(old_data, ignore_date_header) == content_digest(data, ignore_date_header):
+        return False
+
+    temp_path = path + '.tmp'
+
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+
+    os.replace(temp_path, path)
+
+    return True
+
+
+def write_compiled_code(paths, code, ignore_date_header = False, short2original = None):
+    '''Writes code to every path in paths, returns a list of (path, changed) tuples. If the variable names were
+       compacted, the short -> original name dictionary is written next to every path as well (see
+       output_reverse_map_path), unless that file already has the same names.'''
+    results = [(path, write_if_changed(path, code, ignore_date_header)) for path in paths]
+
+    if short2original:
+        for path in paths:
+            map_path = output_reverse_map_path(path)
+
+            if load_reverse_map(map_path) != short2original:
+                save_reverse_map(map_path, short2original)
+
+    return results
@@ -0,0 +1,93 @@
+# ksp-compiler - a compiler for the Kontakt script language
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''Records which parts of a script depend on which others, so that a recompile knows what an edit affects.
+
+   Files are identified by their path, the main script by None. Use sites are (filename, line number) tuples.'''
+
+import collections
+import hashlib
+
+
+class DependencyGraph(object):
+    '''file -> imported files, macro -> use sites, define -> use sites and function -> call sites'''
+
+    def __init__(self):
+        self.file_digests = {}                                  # filename -> sha1 of the source of that file
+        self.imports = collections.defaultdict(list)            # filename -> files imported by it (in import order)
+        self.folders = set()                                    # imported folders (any .ksp file added to them is imported as well)
+        self.macro_uses = collections.defaultdict(set)          # macro name -> set of (filename, lineno) where it is invoked
+        self.define_uses = collections.defaultdict(set)         # define name -> set of (filename, lineno) where it is used
+        self.function_calls = collections.defaultdict(set)      # function name -> set of (filename, lineno) where it is called
+        self.data_files = set()                                 # other files read while compiling (eg. nckp files)
+        self.uses_python = False                                # True if any file contains run<< >> or read<< >> blocks
+
+    @staticmethod
+    def digest(source):
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def add_file(self, filename, source):
+        self.file_digests[filename] = self.digest(source)
+
+    def add_import(self, importer, imported):
+        if imported not in self.imports[importer]:
+            self.imports[importer].append(imported)
+
+    def add_folder(self, path):
+        self.folders.add(path)
+
+    def add_data_file(self, path):
+        self.data_files.add(path)
+
+    def add_macro_use(self, name, location):
+        self.macro_uses[name].add(location)
+
+    def add_define_use(self, name, location):
+        self.define_uses[name].add(location)
+
+    def add_function_call(self, name, location):
+        self.function_calls[name].add(location)
+
+    def files(self):
+        return set(self.file_digests)
+
+    def importers(self, filenames):
+        '''Returns the set of files that directly or indirectly import any of the given files'''
+        imported_by = collections.defaultdict(set)
+
+        for importer, imported_files in self.imports.items():
+            for f in imported_files:
+                imported_by[f].add(importer)
+
+        result = set()
+        stack = list(filenames)
+
+        while stack:
+            for importer in imported_by[stack.pop()]:
+                if importer not in result:
+                    result.add(importer)
+                    stack.append(importer)
+
+        return result
+
+    def changed_files(self, newer):
+        '''Returns the files whose source differs between this graph and a newer one (including added and removed files)'''
+        return set(f for f in self.files() | newer.files() if self.file_digests.get(f) != newer.file_digests.get(f))
+
+    def affected_files(self, changed):
+        '''Returns the changed files together with every file that (indirectly) imports one of them'''
+        return set(changed) | self.importers(changed)
+
+    def uses_in_files(self, uses, filenames):
+        '''Returns the names from a use table (e.g. macro_uses) that are used somewhere in the given files'''
+        return sorted(name for (name, locations) in uses.items() if any(filename in filenames for (filename, lineno) in locations))
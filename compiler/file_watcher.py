@@ -0,0 +1,96 @@
+# ksp-compiler - a compiler for the Kontakt script language
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''Polling file watcher used by the --watch command line mode.
+
+   Polling only needs os.stat, so it works the same on every platform without extra packages.'''
+
+import os
+import time
+
+
+class FileWatcher(object):
+    '''Watches a set of files and folders (recursively, for .ksp files) for changes.
+       poll_interval is the time in seconds between two checks, and a change is only reported once nothing
+       has changed for settle_time seconds, so that a burst of saves results in a single recompilation.'''
+
+    def __init__(self, poll_interval = 0.5, settle_time = 0.3, extensions = ('.ksp',)):
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.extensions = extensions
+        self.files = set()
+        self.folders = set()
+        self.snapshot = {}
+
+    def watch(self, files, folders = ()):
+        '''Sets the files and folders to watch, taking their current state as the reference for detecting changes'''
+        self.files = set(files)
+        self.folders = set(folders)
+        self.snapshot = self.take_snapshot()
+
+    @staticmethod
+    def stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None  # missing files are part of the snapshot as well, so that (re)creating them counts as a change
+
+        return (st.st_mtime_ns, st.st_size)
+
+    def take_snapshot(self):
+        '''Returns a dictionary mapping every watched path to its (modification time, size), or None if it does not exist'''
+        snapshot = dict((path, self.stat(path)) for path in self.files)
+
+        for folder in self.folders:
+            for root, dirs, files in os.walk(folder):
+                for f in files:
+                    if os.path.splitext(f)[1] in self.extensions:
+                        path = os.path.join(root, f)
+                        snapshot[path] = self.stat(path)
+
+        return snapshot
+
+    @staticmethod
+    def changed_paths(old, new):
+        return sorted(path for path in set(old) | set(new) if old.get(path) != new.get(path))
+
+    def poll(self):
+        '''Returns the paths that changed since the last call (or since watch() was called) without waiting'''
+        snapshot = self.take_snapshot()
+        changed = self.changed_paths(self.snapshot, snapshot)
+        self.snapshot = snapshot
+
+        return changed
+
+    def wait_for_change(self, sleep = time.sleep):
+        '''Blocks until something changes and then until nothing has changed for settle_time seconds.
+           Returns the sorted list of all paths that changed during that time.'''
+        changed = set()
+
+        while not changed:
+            sleep(self.poll_interval)
+            changed.update(self.poll())
+
+        quiet_time = 0.0
+
+        while quiet_time < self.settle_time:
+            sleep(self.poll_interval)
+            more_changes = self.poll()
+
+            if more_changes:
+                changed.update(more_changes)
+                quiet_time = 0.0
+            else:
+                quiet_time += self.poll_interval
+
+        return sorted(changed)
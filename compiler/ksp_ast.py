@@ -45,7 +45,12 @@ def toint(i, bits=32):
     return int(i)
 
 class Emitter:
-    '''Class for converting Nodes to native KSP'''
+    '''Class for converting Nodes to native KSP.
+       Output requested from within the emit method of a node is queued and written once that method has returned,
+       so that nested statements are emitted using an explicit stack rather than nested calls.'''
+
+    INDENT = object()
+    DEDENT = object()
 
     def __init__(self, out=sys.stdout, compact=False, compiled_code_tab_size=2):
         self.out = out
@@ -53,12 +58,19 @@ class Emitter:
         self.beginning_of_line = True
         self.compact = compact
         self.compiled_code_tab_size = compiled_code_tab_size
+        self.pending = None  # output queued by the emit method currently running (None when not inside an emit method)
 
     def indent(self):
-        self.indent_num += self.compiled_code_tab_size
+        if self.pending is not None:
+            self.pending.append(Emitter.INDENT)
+        else:
+            self.indent_num += self.compiled_code_tab_size
 
     def dedent(self):
-        self.indent_num -= self.compiled_code_tab_size
+        if self.pending is not None:
+            self.pending.append(Emitter.DEDENT)
+        else:
+            self.indent_num -= self.compiled_code_tab_size
 
     def _write_string(self, s):
         lines = s.split('\n')
@@ -82,23 +94,41 @@ class Emitter:
                 self.beginning_of_line = False
 
     def write(self, *args, **kwargs):
-        indented = kwargs.get('indented', False)
-
-        if indented:
-            self.indent()
-        try:
-            for arg in args:
-                if isinstance(arg, str):
-                    self._write_string(arg)
-                elif isinstance(arg, list):
-                    self.write(*arg)
-                elif hasattr(arg, 'emit'):
-                    arg.emit(self)
-                else:
-                    self._write_string(str(arg))
-        finally:
-            if indented:
-                self.dedent()
+        items = list(args)
+
+        if kwargs.get('indented', False):
+            items = [Emitter.INDENT] + items + [Emitter.DEDENT]
+
+        if self.pending is not None:
+            self.pending.extend(items)
+        else:
+            self._write_items(items)
+
+    def _write_items(self, items):
+        stack = items[::-1]
+
+        while stack:
+            item = stack.pop()
+
+            if isinstance(item, str):
+                self._write_string(item)
+            elif item is Emitter.INDENT:
+                self.indent_num += self.compiled_code_tab_size
+            elif item is Emitter.DEDENT:
+                self.indent_num -= self.compiled_code_tab_size
+            elif isinstance(item, list):
+                stack.extend(item[::-1])
+            elif hasattr(item, 'emit'):
+                self.pending = []
+
+                try:
+                    item.emit(self)
+                finally:
+                    pending, self.pending = self.pending, None
+
+                stack.extend(pending[::-1])
+            else:
+                self._write_string(str(item))
 
     def writeln(self, *args, **kwargs):
         self.write(*args, **kwargs)
@@ -688,6 +718,10 @@ class Expr(ASTNode):
 class BinOp(Expr):
     '''Node for binary operators e.g 4 < 5'''
 
+    # a right operand that is itself a BinOp is put in parentheses unless this is False (set by the peephole optimizer
+    # where the operator of the right operand binds more tightly)
+    parenthesize_right = True
+
     def __init__(self, lexinfo, left, op, right):
         Expr.__init__(self, lexinfo)
         self.left = left
@@ -701,7 +735,7 @@ class BinOp(Expr):
         if isinstance(self.left, BinOp) and precedence[self.op] > precedence[self.left.op]:
             l = '(%s)' % l
 
-        if isinstance(self.right, BinOp) and not (self.right.op == self.op and self.op in '+&'):
+        if isinstance(self.right, BinOp) and self.parenthesize_right and not (self.right.op == self.op and self.op in '+&'):
             r = '(%s)' % r
 
         if self.op in '+-*/ = < > >= <=':
@@ -12,6 +12,7 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+from types import GeneratorType
 from ksp_ast import *
 from ksp_builtins import string_typed_control_parameters, control_parameters, event_parameters
 
@@ -118,7 +119,10 @@ class VariableNotDeclaredException(ParseException):
     pass
 
 class ASTVisitor(object):
-    '''Object to traverse and read AST nodes'''
+    '''Object to traverse and read AST nodes.
+       Nodes are visited depth-first in the same order as a recursive traversal would, but using an explicit stack,
+       so that deeply nested code does not run into Python's recursion limit. A visit method that returns False
+       stops the traversal from descending into the children of that node.'''
 
     def __init__(self, visit_expressions=True):
         self.node = None
@@ -127,29 +131,34 @@ class ASTVisitor(object):
         self.depth = -1
 
     def dispatch(self, parent, node, *args, **kwargs):
-        if not self._visit_expressions and isinstance(node, Expr):
-            return
+        visit_expressions = self._visit_expressions
+        cache = self._cache
+        stack = [(parent, node, self.depth + 1)]
+        depth = self.depth
 
-        self.node = node
-        node_class = node.__class__
-        meth = self._cache.get(node_class, None)
+        try:
+            while stack:
+                parent, node, self.depth = stack.pop()
 
-        if meth is None:
-            className = node_class.__name__
-            meth = getattr(self, 'visit' + className, self.visit_default)
-            self._cache[node_class] = meth
+                if not visit_expressions and isinstance(node, Expr):
+                    continue
 
-        self.depth += 1
+                self.node = node
+                node_class = node.__class__
 
-        try:
-            result = meth(parent, node, *args, **kwargs)
+                if node_class in cache:
+                    meth = cache[node_class]
+                else:
+                    meth = cache[node_class] = getattr(self, 'visit' + node_class.__name__, None)
 
-            if result is not False and not meth == self.visit_default:
-                self.visit_children(parent, node, *args, **kwargs)
-        finally:
-            self.depth -= 1
+                # nodes without a visit method of their own just have their children visited
+                if meth is None or meth(parent, node, *args, **kwargs) is not False:
+                    children = node.get_childnodes()
 
-        return
+                    if children:
+                        stack.extend([(node, child, self.depth + 1) for child in reversed(children)])
+        finally:
+            self.depth = depth
 
     def indent(self):
         return '  '*self.depth
@@ -158,9 +167,6 @@ class ASTVisitor(object):
         for child in node.get_childnodes():
             self.dispatch(node, child, *args, **kwargs)
 
-    def visit_default(self, parent, node, *args, **kwargs):
-        self.dispatch(parent, node, *args, **kwargs)
-
     def traverse(self, tree, *args, **kwargs):
         # Do walk of tree using visitor
         self.dispatch(parent=None, node=tree, *args, **kwargs)
@@ -170,7 +176,14 @@ class ASTVisitor(object):
 
 
 class ASTModifier(object):
-    '''Object to traverse and modify AST nodes'''
+    '''Object to traverse and modify AST nodes.
+
+       The default modify methods are generators (named _modifyXXX) that yield each child node to be modified together with
+       the arguments to pass along, and receive the modified child back. The dispatch loop keeps these generators on an explicit
+       stack instead of nesting Python calls, so the depth of the tree is not limited by Python's recursion limit.
+       The public modifyXXX methods run the same generators to completion, so subclasses can override them and call them as before.
+       An overriding method may itself be a generator following the same protocol (yield (child, args, kwargs), receive the
+       modified child) in order to keep the traversal below it recursion-free as well.'''
 
     def __init__(self, modify_expressions=True):
         self.node = None
@@ -178,30 +191,90 @@ class ASTModifier(object):
         self._cache = {}
         self.depth = -1
 
-    def dispatch(self, node, *args, **kwargs):
+    def _lookup(self, node_class):
+        '''Returns the function used to modify nodes of the given class: the generator of the default implementation if the
+           modify method has not been overridden, otherwise the bound modify method (or None if there is no such method)'''
+        className = node_class.__name__
+        meth = getattr(self, 'modify' + className, None)
+
+        if meth is not None and getattr(type(self), 'modify' + className) is getattr(ASTModifier, 'modify' + className, None):
+            meth = getattr(self, '_modify' + className, meth)
+
+        self._cache[node_class] = meth
+
+        return meth
+
+    def _start(self, node, args, kwargs):
+        '''Starts modifying a node. Returns either the result or a generator that still needs to be run'''
         if not self._modify_expressions and isinstance(node, Expr):
             return node
 
         self.node = node
         node_class = node.__class__
-        meth = self._cache.get(node_class, None)
 
-        if meth is None:
-            className = node_class.__name__
-            meth = getattr(self, 'modify' + className, None)
-            self._cache[node_class] = meth
+        if node_class in self._cache:
+            meth = self._cache[node_class]
+        else:
+            meth = self._lookup(node_class)
 
         if meth is None:
             return node
 
-        self.depth += 1
+        return meth(node, *args, **kwargs)
+
+    def _run(self, generator):
+        '''Runs a modify generator and the generators of all nodes below it using an explicit stack'''
+        stack = [generator]
+        depth = self.depth
+        value = None
+        error = None
 
         try:
-            return meth(node, *args, **kwargs)
+            while stack:
+                self.depth = depth + len(stack)
+
+                try:
+                    if error is None:
+                        request = stack[-1].send(value)
+                    else:
+                        e, error = error, None
+                        request = stack[-1].throw(e)
+                except StopIteration as e:
+                    stack.pop()
+                    value = e.value
+                    continue
+                except Exception as e:
+                    stack.pop()
+
+                    if not stack:
+                        raise
+
+                    error = e
+                    continue
+
+                node, args, kwargs = request
+
+                try:
+                    value = self._start(node, args, kwargs)
+                except Exception as e:
+                    error = e
+                    continue
+
+                if type(value) is GeneratorType:
+                    stack.append(value)
+                    value = None
         finally:
-            self.depth -= 1
+            self.depth = depth
 
-        return node
+        return value
+
+    def dispatch(self, node, *args, **kwargs):
+        result = self._start(node, args, kwargs)
+
+        if type(result) is GeneratorType:
+            result = self._run(result)
+
+        return result
 
     def indent(self):
         return '  ' * self.depth
@@ -209,65 +282,74 @@ class ASTModifier(object):
     def modify_default(self, node, *args, **kwargs):
         self.dispatch(node, *args, **kwargs)
 
-    def modifyCallback(self, node, *args, **kwargs):
-        node.variable = self.modify(node.variable, *args, **kwargs)
-        node.lines = flatten([self.modify(l, *args, **kwargs) for l in node.lines])
+    def _modify_list(self, nodes, args, kwargs):
+        '''Generator which modifies each node in a list and returns the list of results (not flattened)'''
+        result = []
+
+        for n in nodes:
+            result.append((yield (n, args, kwargs)))
+
+        return result
+
+    def _modifyCallback(self, node, *args, **kwargs):
+        node.variable = yield (node.variable, args, kwargs)
+        node.lines = flatten((yield from self._modify_list(node.lines, args, kwargs)))
 
         return node
 
-    def modifyFunctionDef(self, node, *args, **kwargs):
-        node.name = self.modify(node.name, *args, **kwargs)
-        node.lines = flatten([self.modify(l, *args, **kwargs) for l in node.lines])
+    def _modifyFunctionDef(self, node, *args, **kwargs):
+        node.name = yield (node.name, args, kwargs)
+        node.lines = flatten((yield from self._modify_list(node.lines, args, kwargs)))
 
         return node
 
-    def modifyFamilyStmt(self, node, *args, **kwargs):
-        node.name = self.modify(node.name, *args, **kwargs)
-        node.statements = flatten([self.modify(l, *args, **kwargs) for l in node.statements])
+    def _modifyFamilyStmt(self, node, *args, **kwargs):
+        node.name = yield (node.name, args, kwargs)
+        node.statements = flatten((yield from self._modify_list(node.statements, args, kwargs)))
 
         return [node]
 
-    def modifyAssignStmt(self, node, *args, **kwargs):
-        node.varref = self.modify(node.varref, *args, **kwargs)
-        node.expression = self.modify(node.expression, *args, **kwargs)
+    def _modifyAssignStmt(self, node, *args, **kwargs):
+        node.varref = yield (node.varref, args, kwargs)
+        node.expression = yield (node.expression, args, kwargs)
 
         return [node]
 
     def modifyPreprocessorCondition(self, node, *args, **kwargs):
         return [node]
 
-    def modifyFunctionCall(self, node, *args, **kwargs):
-        node.function_name = self.modify(node.function_name, *args, **kwargs)
-        node.parameters = [self.modify(p, *args, **kwargs) for p in node.parameters]
+    def _modifyFunctionCall(self, node, *args, **kwargs):
+        node.function_name = yield (node.function_name, args, kwargs)
+        node.parameters = yield from self._modify_list(node.parameters, args, kwargs)
 
         if node.is_procedure:
             return [node]
         else:
             return node
 
-    def modifyPropertyDef(self, node, *args, **kwargs):
-        node.name = self.modify(node.name, *args, **kwargs)
+    def _modifyPropertyDef(self, node, *args, **kwargs):
+        node.name = yield (node.name, args, kwargs)
 
         if node.get_func_def:
-            node.get_func_def = self.modify(node.get_func_def, *args, **kwargs)
+            node.get_func_def = yield (node.get_func_def, args, kwargs)
 
         if node.set_func_def:
-            node.set_func_def = self.modify(node.set_func_def, *args, **kwargs)
+            node.set_func_def = yield (node.set_func_def, args, kwargs)
 
         return [node]
 
-    def modifyWhileStmt(self, node, *args, **kwargs):
-        node.statements = stripFalse(flatten([self.modify(s, *args, **kwargs) for s in node.statements]))
-        node.condition = self.modify(node.condition, *args, **kwargs)
+    def _modifyWhileStmt(self, node, *args, **kwargs):
+        node.statements = stripFalse(flatten((yield from self._modify_list(node.statements, args, kwargs))))
+        node.condition = yield (node.condition, args, kwargs)
 
         return [node]
 
-    def modifyIfStmt(self, node, *args, **kwargs):
+    def _modifyIfStmt(self, node, *args, **kwargs):
         temp = []
 
         for (condition, stmts) in node.condition_stmts_tuples:
-            condition = self.modify(condition, *args, **kwargs)
-            stmts = flatten([self.modify(s, *args, **kwargs) for s in stmts])
+            condition = yield (condition, args, kwargs)
+            stmts = flatten((yield from self._modify_list(stmts, args, kwargs)))
             temp.append((condition, stmts))
 
         if not temp:
@@ -277,28 +359,28 @@ class ASTModifier(object):
 
             return [node]
 
-    def modifyDeclareStmt(self, node, *args, **kwargs):
+    def _modifyDeclareStmt(self, node, *args, **kwargs):
         if not (node.size is None):
-            node.size = self.modify(node.size, *args, **kwargs)
+            node.size = yield (node.size, args, kwargs)
 
         if type(node.initial_value) is list:
-            node.initial_value = [self.modify(v, *args, **kwargs) for v in node.initial_value]
+            node.initial_value = yield from self._modify_list(node.initial_value, args, kwargs)
         elif node.initial_value:
-            node.initial_value = self.modify(node.initial_value, *args, **kwargs)
+            node.initial_value = yield (node.initial_value, args, kwargs)
 
-        node.variable = self.modify(node.variable, *args, **kwargs)
-        node.parameters = [self.modify(p, *args, **kwargs) for p in node.parameters]
+        node.variable = yield (node.variable, args, kwargs)
+        node.parameters = yield from self._modify_list(node.parameters, args, kwargs)
 
         return [node]
 
-    def modifySelectStmt(self, node, *args, **kwargs):
-        node.expression = self.modify(node.expression, *args, **kwargs)
+    def _modifySelectStmt(self, node, *args, **kwargs):
+        node.expression = yield (node.expression, args, kwargs)
         range_stmts_tuples = []
 
         for ((start, stop), stmts) in node.range_stmts_tuples:
-            start = self.modify(start, *args, **kwargs)
-            stop = self.modify(stop, *args, **kwargs)
-            stmts = flatten([self.modify(s, *args, **kwargs) for s in stmts])
+            start = yield (start, args, kwargs)
+            stop = yield (stop, args, kwargs)
+            stmts = flatten((yield from self._modify_list(stmts, args, kwargs)))
 
             if stmts:
                 range_stmts_tuples.append(((start, stop), stmts))
@@ -310,28 +392,71 @@ class ASTModifier(object):
         else:
             return []
 
-    def modifyBinOp(self, node, *args, **kwargs):
-        node.left = self.modify(node.left, *args, **kwargs)
-        node.right = self.modify(node.right, *args, **kwargs)
+    def _modifyBinOp(self, node, *args, **kwargs):
+        node.left = yield (node.left, args, kwargs)
+        node.right = yield (node.right, args, kwargs)
 
         return node
 
-    def modifyUnaryOp(self, node, *args, **kwargs):
-        node.right = self.modify(node.right, *args, **kwargs)
+    def _modifyUnaryOp(self, node, *args, **kwargs):
+        node.right = yield (node.right, args, kwargs)
 
         return node
 
-    def modifyVarRef(self, node, *args, **kwargs):
-        node.subscripts = [self.modify(s, *args, **kwargs) for s in node.subscripts]
-        node.identifier = self.modify(node.identifier, *args, **kwargs)
+    def _modifyVarRef(self, node, *args, **kwargs):
+        node.subscripts = yield from self._modify_list(node.subscripts, args, kwargs)
+        node.identifier = yield (node.identifier, args, kwargs)
 
         return node
 
+    def _modifyModule(self, node, *args, **kwargs):
+        node.blocks = flatten((yield from self._modify_list(node.blocks, args, kwargs)))
+
+    # synchronous versions of the default implementations, for subclasses to override and call
+    def modifyCallback(self, node, *args, **kwargs):
+        return self._run(self._modifyCallback(node, *args, **kwargs))
+
+    def modifyFunctionDef(self, node, *args, **kwargs):
+        return self._run(self._modifyFunctionDef(node, *args, **kwargs))
+
+    def modifyFamilyStmt(self, node, *args, **kwargs):
+        return self._run(self._modifyFamilyStmt(node, *args, **kwargs))
+
+    def modifyAssignStmt(self, node, *args, **kwargs):
+        return self._run(self._modifyAssignStmt(node, *args, **kwargs))
+
+    def modifyFunctionCall(self, node, *args, **kwargs):
+        return self._run(self._modifyFunctionCall(node, *args, **kwargs))
+
+    def modifyPropertyDef(self, node, *args, **kwargs):
+        return self._run(self._modifyPropertyDef(node, *args, **kwargs))
+
+    def modifyWhileStmt(self, node, *args, **kwargs):
+        return self._run(self._modifyWhileStmt(node, *args, **kwargs))
+
+    def modifyIfStmt(self, node, *args, **kwargs):
+        return self._run(self._modifyIfStmt(node, *args, **kwargs))
+
+    def modifyDeclareStmt(self, node, *args, **kwargs):
+        return self._run(self._modifyDeclareStmt(node, *args, **kwargs))
+
+    def modifySelectStmt(self, node, *args, **kwargs):
+        return self._run(self._modifySelectStmt(node, *args, **kwargs))
+
+    def modifyBinOp(self, node, *args, **kwargs):
+        return self._run(self._modifyBinOp(node, *args, **kwargs))
+
+    def modifyUnaryOp(self, node, *args, **kwargs):
+        return self._run(self._modifyUnaryOp(node, *args, **kwargs))
+
+    def modifyVarRef(self, node, *args, **kwargs):
+        return self._run(self._modifyVarRef(node, *args, **kwargs))
+
     def modifyModule(self, node, *args, **kwargs):
-        node.blocks = flatten([self.modify(b, *args, **kwargs) for b in node.blocks])
+        return self._run(self._modifyModule(node, *args, **kwargs))
 
     def traverse(self, tree, *args, **kwargs):
         # Do walk of tree using AST modifier
         self.dispatch(node=tree, *args, **kwargs)
 
-    modify = dispatch
\ No newline at end of file
+    modify = dispatch
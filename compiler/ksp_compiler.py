@@ -22,10 +22,17 @@ import ksp_ast
 import ksp_ast_processing
 from ksp_compiler_extras import flatten
 import ksp_compiler_extras as comp_extras
+import optimizer
 import ksp_builtins
 from ksp_parser import parse
 from taskfunc import taskfunc_code
+from dependency_graph import DependencyGraph
+from call_graph import CallGraph
+from compiled_output import write_compiled_code
+from compile_cache import CompileCache, CompileCacheEntry
+from name_compaction import NameCompactionMap, compress_variable_name, reverse_map_path, output_reverse_map_path, load_reverse_map, save_reverse_map, rank_names_by_frequency
 import hashlib
+import pickle
 import ply.lex as lex
 import time
 import json
@@ -114,23 +121,142 @@ import_re = re.compile(r'''
     $                                       # match the end of the line
 ''' % white_space_re, re.MULTILINE | re.DOTALL | re.VERBOSE)
 
+placeholder_ref_re = re.compile(r'\{(\d+)\}')
+
 import_basic_re = re.compile(r'^\s*import ')
 import_ignore_re = re.compile(r'^\s*__IGNORE__')
 macro_start_re = re.compile(r'^\s*macro(?=\W)')
 macro_end_re = re.compile(r'^\s*end\s+macro')
 
 
-placeholders            = {}            # mapping from placeholder number to contents (placeholders used for comments, strings, etc.)
+class PlaceholderTable(object):
+    '''Table of the strings replaced by {N} placeholders during a compilation. Identical strings share the same number.
+       Indexing with a placeholder number returns the string, like the dictionary that was used before.'''
+
+    def __init__(self):
+        self.strings = []
+        self.numbers = {}
+
+    def add(self, s):
+        '''Returns the placeholder number for s, adding s to the table if it is not already in it'''
+        n = self.numbers.get(s)
+
+        if n is None:
+            n = len(self.strings)
+            self.strings.append(s)
+            self.numbers[s] = n
+
+        return n
+
+    def get(self, n, default = None):
+        if 0 <= n < len(self.strings):
+            return self.strings[n]
+
+        return default
+
+    def replace_all(self, s):
+        '''Returns s with all placeholders replaced by their strings'''
+        if '{' not in s:
+            return s
+
+        strings = self.strings
+
+        return placeholder_ref_re.sub(lambda match: strings[int(match.group(1))], s)
+
+    def clear(self):
+        del self.strings[:]
+        self.numbers.clear()
+
+    def __getitem__(self, n):
+        return self.strings[n]
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __contains__(self, n):
+        return 0 <= n < len(self.strings)
+
+class PrefixIndexEntry(object):
+    '''Everything an unprefixed name (compared in lower case) can refer to'''
+    __slots__ = ('kinds', 'variable_prefixes', 'builtin_prefixes', 'resolved')
+
+    def __init__(self):
+        self.kinds = {}                 # exact name -> 'function', 'family', 'property' or 'builtin' (a builtin function)
+        self.variable_prefixes = set()  # prefixes of the declared variables with this name (variable names are case insensitive)
+        self.builtin_prefixes = {}      # exact name -> set of prefixes of the builtin variables and constants with that name
+        self.resolved = {}              # exact name -> result of PrefixIndex.resolve
+
+class PrefixIndex(object):
+    '''Maps lowercase unprefixed names to the possible variable prefixes and the kind of the name, so that the prefixing passes
+       can resolve each identifier with a single lookup. Declared variables are added as they are registered.'''
+
+    def __init__(self):
+        self.entries = {}
+        self.clear()
+
+    def entry(self, name):
+        key = name.lower()
+        entry = self.entries.get(key)
+
+        if entry is None:
+            entry = self.entries[key] = PrefixIndexEntry()
+
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+
+        for name in ksp_builtins.functions:
+            self.add_name(name, 'builtin')
+
+        for name in ksp_builtins.all_builtins:
+            entry = self.entry(name[1:])
+            entry.builtin_prefixes.setdefault(name[1:], set()).add(name[0])
+
+    def add_name(self, name, kind):
+        '''Registers a function, family or property name'''
+        entry = self.entry(name)
+        entry.kinds.setdefault(name, kind)
+        entry.resolved.clear()
+
+    def add_variable(self, name):
+        '''Registers a declared variable, given with its prefix'''
+        if name[:1] in variable_prefixes:
+            entry = self.entry(name[1:])
+            entry.variable_prefixes.add(name[0])
+            entry.resolved.clear()
+
+    def resolve(self, name):
+        '''Returns a (kind, prefixes) tuple for an unprefixed name. kind is None for variables, and prefixes lists the prefixes
+           of the variables the name could refer to, in the order of variable_prefixes.'''
+        entry = self.entries.get(name.lower())
+
+        if entry is None:
+            return (None, ())
+
+        result = entry.resolved.get(name)
+
+        if result is None:
+            builtin_prefixes = entry.builtin_prefixes.get(name, ())
+            result = entry.resolved[name] = (entry.kinds.get(name),
+                                             tuple(p for p in variable_prefixes if p in entry.variable_prefixes or p in builtin_prefixes))
+
+        return result
+
+placeholders           = PlaceholderTable() # mapping from placeholder number to contents (placeholders used for comments, strings, etc.)
 functions               = OrderedDict() # maps from function names (prefixed with namespaces) to AST node corresponding to the function definition
 functions_before_prefix = OrderedDict() # maps from function names to AST node corresponding to the function definition
 variables               = set()         # a set of the names of the declared variables (prefixed with $, %, !, ? or @)
 ui_variables            = set()         # a set of the names of the declared variables of UI type, like ui_knob, ui_value_edit, etc. (prefixed with $, %, !, ? or @)
 families                = set()         # a set of the family names (prefixed with namespaces)
 properties              = set()         # a set of the property names
+multidimensional_arrays = {}            # maps from property names to the PropertyDef of properties that only map a multidimensional index onto a flat array
 functions_invoking_wait = set()         # a set functions containing the wait function
 true_conditions         = set()         # the conditions set using SET_CONDITION
 called_functions        = set()         # functions that are somewhere in the script invoked using the Kontakt 4.1 "call" keyword
-call_graph = collections.defaultdict(list)  # an item (a, b) is included if function a invokes function b using the "call" keyword
+call_graph = CallGraph()                # an edge (a, b) is included if function a invokes function b (None represents the callbacks)
+function_call_sites = collections.defaultdict(set) # maps from function names to the line numbers (indices into the compiler lines) of the calls
+prefix_index = PrefixIndex()            # maps unprefixed names to their possible variable prefixes (see ASTModifierFixPrefixes)
 
 def clear_global_context():
     placeholders.clear()
@@ -140,10 +266,13 @@ def clear_global_context():
     ui_variables.clear()
     families.clear()
     properties.clear()
+    multidimensional_arrays.clear()
     functions_invoking_wait.clear()
     true_conditions.clear()
     called_functions.clear()
     call_graph.clear()
+    function_call_sites.clear()
+    prefix_index.clear()
 
 
 class StringIO:
@@ -291,8 +420,7 @@ class Line:
         return self.copy(new_command = s)
 
     def replace_placeholders(self, placeholders = placeholders):
-        replace_func = lambda matchobj: placeholders[int(matchobj.group(1))]
-        self.command = re.sub(r'\{(\d+?)\}', replace_func, self.command)
+        self.command = placeholders.replace_all(self.command)
 
     def __str__(self):
         return self.command
@@ -305,6 +433,7 @@ class Macro:
     def __init__(self, lines):
         self.lines = lines
         self.name, self.parameters = self.get_macro_name_and_parameters()
+        self.source_digest = None
 
     def get_name_prefixed_by_namespace(self):
         return prefix_with_ns(self.name, self.lines[0].namespaces)
@@ -312,6 +441,15 @@ class Macro:
     def get_overloaded_name(self):
         return append_overloaded_name(self.name, self.parameters)
 
+    def get_source_digest(self):
+        '''Hash of the macro definition (with strings resolved), used to recognise an unchanged macro in a later compilation'''
+        if self.source_digest is None:
+            source = '\n'.join(resolve_placeholders(line.command) for line in self.lines)
+            source += '\n' + '.'.join(self.lines[0].namespaces)
+            self.source_digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+        return self.source_digest
+
     def get_macro_name_and_parameters(self):
         '''Returns the function name, parameter list, and result variable (or None) as a tuple'''
         param = white_space_re + r'([$%@!?~]?[\w\.]+|#[\w\.]+#)' + white_space_re
@@ -459,75 +597,491 @@ def parse_lines(s, basepath = None, filename = None, namespaces = None):
 
     return collections.deque(lines)
 
+def localize_placeholders(commands):
+    '''Renumbers the string placeholders used by a list of commands, starting from 0.
+       Returns (commands, placeholder strings) so that the commands can be stored independently of the current compilation'''
+    local_placeholders = []
+    local_numbers = {}
+
+    def to_local(match):
+        n = int(match.group(1))
+
+        if n not in local_numbers:
+            local_numbers[n] = len(local_placeholders)
+            local_placeholders.append(placeholders[n])
+
+        return '{%d}' % local_numbers[n]
+
+    return ([placeholder_ref_re.sub(to_local, command) for command in commands], local_placeholders)
+
+def globalize_placeholders(commands, local_placeholders):
+    '''Reverse of localize_placeholders: adds the strings to the placeholder table and renumbers the commands accordingly'''
+    if not local_placeholders:
+        return commands
+
+    numbers = [placeholders.add(s) for s in local_placeholders]
+    to_global = lambda match: '{%d}' % numbers[int(match.group(1))]
+
+    return [placeholder_ref_re.sub(to_global, command) for command in commands]
+
+def resolve_placeholders(s):
+    '''Returns s with all string placeholders replaced by the strings they stand for'''
+    return placeholder_ref_re.sub(lambda match: placeholders.get(int(match.group(1)), match.group(0)), s)
+
+class ImportCache(object):
+    '''Cache of source code already converted to Line objects, so that several compilations (e.g. of scripts that import the same library)
+       can share the parsing work. Entries are keyed by filename, namespaces and a hash of the source, so a changed file is parsed again.
+       Placeholder numbers are stored relative to the cached entry and renumbered whenever the lines are handed out again.'''
+
+    def __init__(self, max_entries = 256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_cacheable(source):
+        # run<< >> and read<< >> blocks execute arbitrary code (which may read other files), so never cache those sources
+        return not ('<<' in source and ('run' in source or 'read' in source))
+
+    def make_key(self, source, basepath, filename, namespaces):
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+        return (filename, basepath, tuple(namespaces or []), digest)
+
+    def parse_lines(self, s, basepath = None, filename = None, namespaces = None):
+        '''Same as the parse_lines function, but reuses any lines previously parsed from identical source code'''
+        if not self.is_cacheable(s):
+            return parse_lines(s, basepath, filename, namespaces)
+
+        key = self.make_key(s, basepath, filename, namespaces)
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            lines = parse_lines(s, basepath, filename, namespaces)
+            self.store(key, lines)
+
+            return lines
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+
+        return self.restore(entry, namespaces)
+
+    def store(self, key, lines):
+        commands, local_placeholders = localize_placeholders([line.command for line in lines])
+        self.entries[key] = (list(zip(commands, [line.locations for line in lines])), local_placeholders)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    def restore(self, entry, namespaces):
+        commands, local_placeholders = entry
+        commands = globalize_placeholders([command for (command, locations) in commands], local_placeholders)
+
+        return collections.deque(Line(command, locations, namespaces)
+                                 for (command, (_, locations)) in zip(commands, entry[0]))
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+class MacroExpansionCache(object):
+    '''Cache of already expanded macro invocations. An invocation is identified by the macro name, the source of the macro
+       definition, the arguments (with strings resolved) and the define constants that the macro body or arguments refer to.
+       The cached lines keep their locations relative to the macro definition, so moving a macro around in its file is fine.'''
+
+    def __init__(self, max_entries = 4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.set_define_constants([])
+
+    def set_define_constants(self, define_cache):
+        '''Sets the define constants used by the current compilation'''
+        self.define_signatures = []
+        self.define_names = []
+        self.define_values = []
+        self.define_name_words = collections.defaultdict(list)   # word -> indices of the defines whose name contains that word
+        self.macro_defines = {}                                   # macro source digest -> indices of the defines used by the macro
+
+        for i, dc in enumerate(define_cache or []):
+            value = resolve_placeholders(dc.value)
+
+            self.define_signatures.append('%s(%s):=%s' % (dc.name, ','.join(dc.args), value))
+            self.define_names.append(dc.name)
+            self.define_values.append(value)
+
+            for word in set(re.findall(r'\w+', dc.name)):
+                self.define_name_words[word].append(i)
+
+    def find_used_defines(self, text):
+        '''Returns the indices of the define constants that text refers to, directly or through the value of another define'''
+        used = set()
+        pending = [text]
+
+        while pending:
+            text = pending.pop()
+
+            for word in set(re.findall(r'\w+', text)):
+                for i in self.define_name_words.get(word, ()):
+                    if i not in used and self.define_names[i] in text:
+                        used.add(i)
+                        pending.append(self.define_values[i])
+
+        return used
+
+    def make_key(self, macro, args, replace_raw):
+        digest = macro.get_source_digest()
+        args = tuple(resolve_placeholders(a) for a in args)
+
+        if digest not in self.macro_defines:
+            self.macro_defines[digest] = self.find_used_defines('\n'.join(resolve_placeholders(line.command) for line in macro.lines))
+
+        used_defines = self.macro_defines[digest] | self.find_used_defines('\n'.join(args))
+        defines = '\n'.join(self.define_signatures[i] for i in sorted(used_defines))
+
+        return (macro.get_overloaded_name(), digest, args, replace_raw, defines)
+
+    def lookup(self, macro, args, replace_raw, calling_line):
+        '''Returns (normal_lines, callback_lines) for the invocation of macro on calling_line, or None if it has not been expanded before'''
+        key = self.make_key(macro, args, replace_raw)
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+
+        stored_macro_locations, num_normal_lines, commands, locations, namespaces, local_placeholders = entry
+        commands = globalize_placeholders(commands, local_placeholders)
+
+        # map the locations of the macro lines at the time the entry was stored to the current ones
+        relocate = dict(zip(stored_macro_locations, [tuple(line.locations) for line in macro.lines]))
+        call_location = calling_line.locations[0]
+        calling_lines = (calling_line.calling_lines or []) + [calling_line]
+
+        lines = [Line(command, list(relocate.get(location_prefix, location_prefix)) + [call_location], line_namespaces, calling_lines = calling_lines)
+                 for (command, location_prefix, line_namespaces) in zip(commands, locations, namespaces)]
+
+        return (lines[:num_normal_lines], lines[num_normal_lines:])
+
+    def store(self, macro, args, replace_raw, calling_line, normal_lines, callback_lines):
+        call_location = calling_line.locations[0]
+        lines = normal_lines + callback_lines
+
+        # every expanded line is expected to have the invocation as its last location, otherwise don't cache the expansion
+        if any(line.locations[-1] != call_location for line in lines):
+            return
+
+        commands, local_placeholders = localize_placeholders([line.command for line in lines])
+        locations = [tuple(line.locations[:-1]) for line in lines]
+        namespaces = [line.namespaces for line in lines]
+        macro_locations = [tuple(line.locations) for line in macro.lines]
+
+        self.entries[self.make_key(macro, args, replace_raw)] = (macro_locations, len(normal_lines), commands, locations, namespaces, local_placeholders)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+def compiler_fingerprint():
+    '''Hash of the source code of the compiler itself, so that cached results of an older compiler version are never used'''
+    global _compiler_fingerprint
+
+    if _compiler_fingerprint is None:
+        sha = hashlib.sha1()
+        compiler_dir = os.path.dirname(os.path.abspath(__file__))
+
+        for name in sorted(os.listdir(compiler_dir)):
+            if name.endswith('.py'):
+                with open(os.path.join(compiler_dir, name), 'rb') as f:
+                    sha.update(f.read())
+
+        _compiler_fingerprint = sha.hexdigest()
+
+    return _compiler_fingerprint
+
+_compiler_fingerprint = None
+
+class IncrementalCache(object):
+    '''State kept between compilations of the same script, so that recompiling after a small edit only redoes the work
+       for the parts that changed: the parsed lines of every file, the expanded macro invocations and the dependency graph
+       of the last compilation. It can be saved to and loaded from a file, in order to persist between command line runs.'''
+
+    format_version = 1
+
+    def __init__(self, path = None):
+        self.path = path
+        self.import_cache = ImportCache()
+        self.expansion_cache = MacroExpansionCache()
+        self.python_read_cache = PythonReadCache()
+        self.dependency_graph = None       # graph of the last successful compilation
+        self.full_phase_timings = None     # [(phase, seconds)] of the last compilation which could not reuse anything
+        self.last_phase_timings = None     # [(phase, seconds)] of the last compilation
+        self.changed_files = set()         # files that changed since the compilation before the last one
+        self.affected_files = set()        # changed files plus all files importing them
+
+    @classmethod
+    def load(cls, path):
+        '''Loads the cache saved at path. An empty cache is returned if there is none, or it was saved by another compiler version'''
+        cache = cls(path)
+
+        try:
+            with open(path, 'rb') as f:
+                version, fingerprint, state = pickle.load(f)
+
+            if version == cls.format_version and fingerprint == compiler_fingerprint():
+                cache.__dict__.update(state)
+                cache.path = path
+        except (IOError, OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+            pass
+
+        return cache
+
+    def save(self, path = None):
+        path = path or self.path
+        temp_path = path + '.tmp'
+
+        with open(temp_path, 'wb') as f:
+            pickle.dump((self.format_version, compiler_fingerprint(), self.__dict__), f, protocol = pickle.HIGHEST_PROTOCOL)
+
+        os.replace(temp_path, path)
+
+    def count_hits(self):
+        return (self.import_cache.hits, self.expansion_cache.hits)
+
+    def begin_compilation(self):
+        '''Resets the hit counters, so that afterwards they tell what this compilation reused (and not what all the
+           compilations since the cache was created did)'''
+        for cache in (self.import_cache, self.expansion_cache):
+            cache.hits = 0
+            cache.misses = 0
+
+    def end_compilation(self, compiler):
+        graph = compiler.dependency_graph
+
+        if self.dependency_graph is not None:
+            self.changed_files = self.dependency_graph.changed_files(graph)
+            self.affected_files = self.dependency_graph.affected_files(self.changed_files) | graph.affected_files(self.changed_files)
+        else:
+            self.changed_files = graph.files()
+            self.affected_files = graph.files()
+
+        self.dependency_graph = graph
+        self.last_phase_timings = compiler.phase_timings
+
+        if self.count_hits() == (0, 0):
+            self.full_phase_timings = compiler.phase_timings
+
+class PythonReadCache(object):
+    '''Memoised results of read<< >> blocks. A result is reused when the block itself, all run<< >> blocks of the same source and
+       the modification times of all files opened (using open()) while running those blocks are unchanged.
+       Blocks that depend on anything else (e.g. the current time or a folder listing) should not be compiled with this cache.'''
+
+    def __init__(self, max_entries = 1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def make_key(self, basepath, run_blocks, read_block):
+        sha = hashlib.sha1()
+
+        for block in [basepath or ''] + run_blocks + [read_block]:
+            sha.update(block.encode('utf-8'))
+            sha.update(b'\0')
+
+        return sha.hexdigest()
+
+    def lookup(self, key):
+        '''Returns the cached result of a block, or None'''
+        entry = self.entries.get(key)
+
+        if entry is not None:
+            result, file_mtimes = entry
+
+            if all(self.get_mtime(path) == mtime for (path, mtime) in file_mtimes):
+                self.hits += 1
+                self.entries.move_to_end(key)
+
+                return result
+
+            del self.entries[key]
+
+        self.misses += 1
+
+        return None
+
+    def store(self, key, result, opened_files):
+        self.entries[key] = (result, [(path, self.get_mtime(path)) for path in sorted(opened_files)])
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+python_run_re = re.compile(r"run\s*<<(?P<code>.+?)>>", re.DOTALL)    # re.DOTALL makes '.' match newlines
+python_read_re = re.compile(r"read\s*<<(?P<code>.+?)>>", re.DOTALL)
+python_read_cache = None    # PythonReadCache used by the current compilation, or None if read<< >> results are not memoised
+
+class BasepathModule(object):
+    '''Stands in for the os, os.path or glob module inside run<< >> and read<< >> blocks. The functions listed in
+       path_functions resolve a relative path given as their first parameter from basepath, so that the blocks see
+       the files next to the script as if it were the working directory, without the working directory of the
+       process being changed. Everything else is taken from the module itself.'''
+
+    path_functions = {
+        'os':      ['listdir', 'scandir', 'walk', 'stat', 'lstat', 'access', 'mkdir', 'makedirs', 'remove', 'unlink', 'rmdir'],
+        'os.path': ['exists', 'lexists', 'isfile', 'isdir', 'islink', 'getsize', 'getmtime', 'getctime', 'getatime', 'abspath', 'realpath'],
+        'glob':    ['glob', 'iglob'],
+    }
+
+    def __init__(self, module, basepath, module_name):
+        self._module = module
+        self._basepath = basepath
+        self._module_name = module_name
+
+    def __getattr__(self, name):
+        value = getattr(self._module, name)
+
+        if name in self.path_functions[self._module_name]:
+            return self.rebased(value, name)
+        elif self._module is os and name == 'path':
+            return BasepathModule(os.path, self._basepath, 'os.path')
+        elif self._module is os and name == 'getcwd':
+            return lambda: self._basepath
+
+        return value
+
+    def rebased(self, function, name):
+        basepath = self._basepath
+
+        def call(path = '.', *args, **kwargs):
+            if not isinstance(path, str) or os.path.isabs(path):
+                return function(path, *args, **kwargs)
+            elif name == 'glob':
+                return [os.path.relpath(p, basepath) for p in function(os.path.join(basepath, path), *args, **kwargs)]
+            elif name == 'iglob':
+                return (os.path.relpath(p, basepath) for p in function(os.path.join(basepath, path), *args, **kwargs))
+
+            return function(os.path.join(basepath, path), *args, **kwargs)
+
+        return call
+
 def handlePython(code, basepath):
-    # Use re.DOTALL to make '.' match newlines
-    run_re = re.compile(r"run\s*<<(?P<code>.+?)>>", re.DOTALL)
-    read_re = re.compile(r"read\s*<<(?P<code>.+?)>>", re.DOTALL)
+    '''Executes all run<< >> blocks (which are removed) and then evaluates all read<< >> blocks (which are replaced by their result).
+       All blocks share one namespace. Relative paths passed to open() and to the common functions of the os, os.path and
+       glob modules (see BasepathModule) are resolved from basepath.'''
+    import builtins
+    import glob
+    import textwrap
+
+    if 'run' not in code and 'read' not in code:
+        return code
+
+    opened_files = set()
+
+    def open_from_basepath(file, *args, **kwargs):
+        if isinstance(file, str):
+            if basepath and not os.path.isabs(file):
+                file = os.path.join(basepath, file)
+
+            opened_files.add(os.path.abspath(file))
+
+        return io.open(file, *args, **kwargs)
+
+    rebased_modules = {}
+
+    if basepath:
+        rebased_modules = {'os': BasepathModule(os, basepath, 'os'), 'glob': BasepathModule(glob, basepath, 'glob')}
+
+    def import_from_basepath(name, globals = None, locals = None, fromlist = (), level = 0):
+        module = builtins.__import__(name, globals, locals, fromlist, level)
+
+        # "import os.path" binds os, "from os.path import exists" needs os.path itself
+        if name == 'os.path' and fromlist and 'os' in rebased_modules:
+            return rebased_modules['os'].path
+
+        return rebased_modules.get(module.__name__, module)
 
-    namespace = {'__builtins__': __builtins__}
     namespace = {'basepath': basepath}
     namespace.update(globals())
+    namespace.update(rebased_modules)
+    namespace['open'] = open_from_basepath
+    namespace['__builtins__'] = dict(builtins.__dict__, open = open_from_basepath, __import__ = import_from_basepath)
 
-    import textwrap
-    def trimmed(s: str) -> str:
-        """
-        Removes the minimum common indentation from all lines in a Python code string,
-        so that the root-level hierarchy starts at the very beginning of the line.
-        """
-        return textwrap.dedent(s)
-
-    # Change directory to compile path
-    wd = os.getcwd()
-    if basepath:
-        os.chdir(basepath)
-
-    new_code = code
-    finished = False
-    while (not finished):
-        finished = True
-
-        # Process all run<< >> blocks first
-        for m in run_re.finditer(new_code):  # Process in reverse to maintain indices
-            exec_code = trimmed(m.group('code'))
-            exec(exec_code, namespace)
-            new_code = new_code[:m.start()] + new_code[m.end():]
-
-            finished = False
-            break
-
-        if not finished:
-            continue
-
-        # Then process all read<< >> blocks
-        for m in read_re.finditer(new_code):  # Process in reverse to maintain indices
-            eval_code = trimmed(m.group('code'))
-            final = eval(eval_code, namespace)
-
-            if isinstance(final, int):
-                final = str(final)
-            elif isinstance(final, list):
-                final = '\n'.join(final)
-            else:
-                final = str(final)
+    all_run_blocks = []
 
-            new_code = new_code[:m.start()] + final + new_code[m.end():]
+    while True:
+        run_blocks = [textwrap.dedent(m.group('code')) for m in python_run_re.finditer(code)]
 
-            finished = False
-            break
+        if run_blocks:
+            for block in run_blocks:
+                exec(block, namespace)
 
-        if not finished:
-            continue
+            code = python_run_re.sub('', code)
+            all_run_blocks.extend(run_blocks)
 
-    if basepath:
-        os.chdir(wd)
+        # evaluate all read blocks in a single pass, collecting the pieces of the resulting code
+        pieces = []
+        pos = 0
+        num_read_blocks = 0
+
+        for m in python_read_re.finditer(code):
+            block = textwrap.dedent(m.group('code'))
+            result = None
 
-    return new_code
+            if python_read_cache is not None:
+                key = python_read_cache.make_key(basepath, all_run_blocks, block)
+                result = python_read_cache.lookup(key)
+
+            if result is None:
+                result = eval(block, namespace)
+
+                if isinstance(result, list):
+                    result = '\n'.join(result)
+                else:
+                    result = str(result)
+
+                if python_read_cache is not None:
+                    python_read_cache.store(key, result, opened_files)
+
+            pieces.append(code[pos:m.start()])
+            pieces.append(result)
+            pos = m.end()
+            num_read_blocks += 1
+
+        if num_read_blocks:
+            pieces.append(code[pos:])
+            code = ''.join(pieces)
+
+        # the code produced by read blocks can contain further blocks
+        if not num_read_blocks or not (python_run_re.search(code) or python_read_re.search(code)):
+            return code
+
+def has_raw_string(command):
+    '''Returns True if the command may still contain a string which has not been converted to a placeholder'''
+    return '"' in command or "'" in command
 
 def convert_strings_to_placeholders(lines):
-    '''Converts all strings to placeholders, appending string to placeholder dictionary'''
+    '''Converts all strings to placeholders, adding the strings to the placeholder table.
+       Lines without any quote characters are skipped, so repeated passes only touch lines with new strings'''
     def replace_func(match):
-        i = len(placeholders)
-
         # replace the match with a placeholder (eg. "{8}") and store the replaced string
         s = match.group(0)
 
@@ -535,19 +1089,37 @@ def convert_strings_to_placeholders(lines):
         if s and s[0] == "'":
             s = '"%s"' % s[1:-1].replace(r"\'", "'")
 
-        placeholders[i] = s
-
-        return '{%d}' % i
+        return '{%d}' % placeholders.add(s)
 
     # substitute strings with placeholders
     if hasattr(lines, '__iter__'):
         for l in lines:
-            l.command = string_re.sub(replace_func, l.command)
-    else:
+            if has_raw_string(l.command):
+                l.command = string_re.sub(replace_func, l.command)
+    elif has_raw_string(lines.command):
         lines.command = string_re.sub(replace_func, lines.command)
 
-def parse_lines_and_handle_imports(basepath, source, compiler_import_cache, filename = None, namespaces = None, preprocessor_func = None):
-    '''parses lines into Line objects and imports all files. preprocessor_func does not mean preprocessor_plugins'''
+def list_ksp_files(folder):
+    '''Returns the paths of all .ksp files in folder and its subfolders, in the order in which they are imported'''
+    paths = []
+
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            if os.path.splitext(f)[1] == '.ksp':
+                paths.append(os.path.join(root, f))
+
+    return paths
+
+def read_source_file(path):
+    '''Returns the source of an imported file, with normalized line endings'''
+    with io.open(path, 'r', encoding = 'utf-8') as s:
+        return '\n' + re.sub('\r+\n*', '\n', s.read())
+
+def parse_lines_and_handle_imports(basepath, source, compiler_import_cache, filename = None, namespaces = None, preprocessor_func = None, import_cache = None,
+                                   dependency_graph = None):
+    '''parses lines into Line objects and imports all files. preprocessor_func does not mean preprocessor_plugins.
+       If import_cache (an ImportCache object) is given, sources that have been parsed before are not parsed again.
+       If dependency_graph (a DependencyGraph object) is given, all files and imports are recorded in it'''
 
     def read_path(basepath, filepath):
         # import from URL
@@ -567,12 +1139,10 @@ def parse_lines_and_handle_imports(basepath, source, compiler_import_cache, file
         if os.path.exists(path):
             # see if we're importing a folder or a file
             if os.path.isdir(path):
-                for root, dirs, files in os.walk(path):
-                    for f in files:
-                        split = os.path.splitext(f)
+                if dependency_graph is not None:
+                    dependency_graph.add_folder(path)
 
-                        if split[1] == '.ksp':
-                            paths.append(os.path.join(root, f))
+                paths.extend(list_ksp_files(path))
             elif os.path.isfile(path):
                 paths.append(path)
         else:
@@ -584,17 +1154,26 @@ def parse_lines_and_handle_imports(basepath, source, compiler_import_cache, file
 
         # actually open everything in paths list sequentially
         for p in paths:
-            with io.open(p, 'r', encoding = 'utf-8') as s:
-                src = '\n' + re.sub('\r+\n*', '\n', s.read())
-
-                out_data.append((p, src))
+            out_data.append((p, read_source_file(p)))
 
         return out_data
 
     if preprocessor_func:
         source = preprocessor_func(source, namespaces)
 
-    lines = parse_lines(source, basepath, filename, namespaces)
+    importing_filename = filename
+
+    if dependency_graph is not None:
+        dependency_graph.add_file(filename, source)
+
+        if python_run_re.search(source) or python_read_re.search(source):
+            dependency_graph.uses_python = True
+
+    if import_cache is not None:
+        lines = import_cache.parse_lines(source, basepath, filename, namespaces)
+    else:
+        lines = parse_lines(source, basepath, filename, namespaces)
+
     new_lines = collections.deque()
 
     while lines:
@@ -620,6 +1199,9 @@ def parse_lines_and_handle_imports(basepath, source, compiler_import_cache, file
             new_sources = read_path(basepath, filename)
 
             for path, source in new_sources:
+                if dependency_graph is not None:
+                    dependency_graph.add_import(importing_filename, path)
+
                 if path not in compiler_import_cache:
                     compiler_import_cache.append(path)
 
@@ -634,7 +1216,8 @@ def parse_lines_and_handle_imports(basepath, source, compiler_import_cache, file
                     if preprocessor_func:
                         preproc_s = preprocessor_func(source, namespaces)
 
-                    new_lines.extend(parse_lines_and_handle_imports(basepath, preproc_s, compiler_import_cache, path, namespaces))
+                    new_lines.extend(parse_lines_and_handle_imports(basepath, preproc_s, compiler_import_cache, path, namespaces,
+                                                                    import_cache = import_cache, dependency_graph = dependency_graph))
         # non-import line so just add it to result line list:
         else:
             new_lines.append(line)
@@ -777,9 +1360,11 @@ def sub_defines(lines, cur_line, define_cache):
         else:
             c.calling_lines = cur_line.calling_lines + [cur_line]
 
-def expand_macros(lines, macros, level = 0, replace_raw = True, define_cache = None):
+def expand_macros(lines, macros, level = 0, replace_raw = True, define_cache = None, expansion_cache = None, dependency_graph = None):
     '''Inline macro invocations by the body of the macro definition (with parameters properly replaced)
-        returns tuple (normal_lines, callback_lines) where the latter are callbacks'''
+        returns tuple (normal_lines, callback_lines) where the latter are callbacks.
+        expansion_cache (a MacroExpansionCache) lets invocations that were expanded before be reused,
+        dependency_graph (a DependencyGraph) gets the use sites of all macros added to it'''
     macro_call_re = re.compile(r'(?ms)^\s*([\w_.]+)\s*(\(.*\))?%s$' % white_space_re)
     name2macro = {}
 
@@ -827,24 +1412,32 @@ def expand_macros(lines, macros, level = 0, replace_raw = True, define_cache = N
                 if level > 40:
                     raise ParseException(line, "This macro seems to be invoking itself recursively, which is not allowed!")
 
-                # build a substitution mapping parameters to arguments, and substitute
-                name_subst_dict = dict(list(zip(macro.parameters, args)))
+                if dependency_graph is not None:
+                    dependency_graph.add_macro_use(macro_name, line.locations[0])
 
-                macro = macro.copy(add_location = line.locations[0])
-                macro = macro.substitute_names(replace_raw, name_subst_dict)
+                expanded = None
 
-                # add macro body
-                if args:
-                    macro_call_str = '%s(%s)' % (macro_name, ', '.join([re.sub(white_space, '', a).strip() for a in args]))
+                if expansion_cache is not None:
+                    expanded = expansion_cache.lookup(macro, args, replace_raw, line)
+
+                if expanded:
+                    normal_lines, callback_lines = expanded
                 else:
-                    macro_call_str = '%s' % (macro_name)
+                    definition = macro
+
+                    # build a substitution mapping parameters to arguments, and substitute
+                    name_subst_dict = dict(list(zip(macro.parameters, args)))
+
+                    macro = macro.copy(add_location = line.locations[0])
+                    macro = macro.substitute_names(replace_raw, name_subst_dict)
+
+                    normal_lines, callback_lines = extract_callback_lines(macro.lines[1:-1])
 
-                # erase any inner comments to not disturb outer
-                macro_call_str = re.sub(white_space, '', macro_call_str)
-                normal_lines, callback_lines = extract_callback_lines(macro.lines[1:-1])
+                    sub_defines(normal_lines, line, define_cache)
+                    sub_defines(callback_lines, line, define_cache)
 
-                sub_defines(normal_lines, line, define_cache)
-                sub_defines(callback_lines, line, define_cache)
+                    if expansion_cache is not None:
+                        expansion_cache.store(definition, args, replace_raw, line, normal_lines, callback_lines)
 
                 new_lines.extend(normal_lines)
                 new_callback_lines.extend(callback_lines)
@@ -852,7 +1445,7 @@ def expand_macros(lines, macros, level = 0, replace_raw = True, define_cache = N
                 num_substitutions += 1
 
     if num_substitutions:
-        return expand_macros(new_lines + new_callback_lines, macros, level + 1, replace_raw, define_cache)
+        return expand_macros(new_lines + new_callback_lines, macros, level + 1, replace_raw, define_cache, expansion_cache, dependency_graph)
     else:
         return (new_lines, new_callback_lines)
 
@@ -980,31 +1573,35 @@ class ASTModifierNodesToNativeKSP(ASTModifierBase):
         statements = [ksp_ast.AssignStmt(node.lexinfo, node.loopvar.copy(), node.start),
                       ksp_ast.WhileStmt(node.lexinfo, loop_condition,
                                         node.statements + [incdec_statement])]
-        return flatten([self.modify(stmt, *args, **kwargs) for stmt in statements])
+        return flatten((yield from self._modify_list(statements, args, kwargs)))
 
     def modifyIfStmt(self, node, *args, **kwargs):
         '''Convert if > else if > else statements into just if-else statements by nesting them inside each other'''
 
-        # modify the if condition and the statements in the if-body
-        if_condition, stmts = node.condition_stmts_tuples[0]
-        if_condition, stmts = (self.modify(if_condition, *args, **kwargs),
-                               flatten([self.modify(s, *args, **kwargs) for s in stmts]))
-        node.condition_stmts_tuples[0] = (if_condition, stmts)
-
-        # if if-else statement (i.e. no else-if part)
-        if len(node.condition_stmts_tuples) == 2 and node.condition_stmts_tuples[1][0] is None:
-            stmts = node.condition_stmts_tuples[1][1]
-            stmts = flatten([self.modify(s, *args, **kwargs) for s in stmts])
-            node.condition_stmts_tuples[1] = (None, stmts)
-
-        # else if there is any "else if" part
-        elif len(node.condition_stmts_tuples) > 1 and node.condition_stmts_tuples[1][0] is not None:
-            else_if_condition, else_if_stmts = node.condition_stmts_tuples[1]
-            # create a new if-statement consisting of the that 'else if' and all the following 'else if'/'else' clauses, and modify this recursively
-            new_if_stmt = self.modifyIfStmt(ksp_ast.IfStmt(node.condition_stmts_tuples[1][0].lexinfo, node.condition_stmts_tuples[1:]), *args, **kwargs)[0]
-            # the new contents of the else part will be the if-statement just created
-            node.condition_stmts_tuples = [node.condition_stmts_tuples[0],
-                                           (None, [new_if_stmt])]
+        # modify the conditions and statements of all the branches (in the order in which they appear)
+        branches = []
+
+        for (condition, stmts) in node.condition_stmts_tuples:
+            lexinfo = condition.lexinfo if condition is not None else None
+
+            if condition is not None:
+                condition = yield (condition, args, kwargs)
+
+            stmts = flatten((yield from self._modify_list(stmts, args, kwargs)))
+            branches.append((lexinfo, condition, stmts))
+
+        # the 'else' part, if any, goes into the innermost if-statement
+        else_part = []
+
+        if len(branches) > 1 and branches[-1][1] is None:
+            else_part = [(None, branches.pop()[2])]
+
+        # working from the last 'else if' towards the first one, each 'else if' becomes an if-statement
+        # which is the only statement in the else part of the if-statement created for the branch before it
+        for (lexinfo, condition, stmts) in reversed(branches[1:]):
+            else_part = [(None, [ksp_ast.IfStmt(lexinfo, [(condition, stmts)] + else_part)])]
+
+        node.condition_stmts_tuples = [branches[0][1:]] + else_part
 
         return [node]
 
@@ -1045,6 +1642,10 @@ class ASTModifierNodesToNativeKSP(ASTModifierBase):
 
         # add property to list
         properties.add(node.name.identifier)
+        prefix_index.add_name(node.name.identifier, 'property')
+
+        if is_multidimensional_array_property(node):
+            multidimensional_arrays[node.name.identifier] = node
 
         return []
 
@@ -1086,6 +1687,7 @@ class ASTModifierNodesToNativeKSP(ASTModifierBase):
                 raise ksp_ast.ParseException(node, 'Function already declared!')
         else:
             functions[node.name.identifier] = node
+            prefix_index.add_name(node.name.identifier, 'function')
 
         # modify the body of the function
         node.lines = flatten([self.modify(l, parent_function = node, function_params = params, parent_families = parent_families) for l in node.lines])
@@ -1105,6 +1707,7 @@ class ASTModifierNodesToNativeKSP(ASTModifierBase):
         # add family name to the table of all used families
         global_family_name = '.'.join(parent_families + [node.name.identifier])
         families.add(global_family_name)
+        prefix_index.add_name(global_family_name, 'family')
 
         # then modify statements and pass along information to nodes further down the tree of the chain of family definitions so far
         node.statements = flatten([self.modify(n, parent_function = parent_function,
@@ -1118,6 +1721,7 @@ class ASTModifierNodesToNativeKSP(ASTModifierBase):
 
         # add variable to list of variables
         variables.add(global_varname.lower())
+        prefix_index.add_variable(global_varname)
 
         if is_ui_declaration:
             ui_variables.add(global_varname.lower())
@@ -1316,6 +1920,42 @@ class ASTModifierNodesToNativeKSP(ASTModifierBase):
 
         return id
 
+def is_multidimensional_array_property(node):
+    '''Returns True if the property only maps a multidimensional index onto an element of a flat array, like the properties
+       generated for multidimensional arrays do:  function get(d1, d2) -> result / result := arr[<index>]  and
+       function set(d1, d2, val) / arr[<index>] := val  (using the same index expression in both functions)'''
+    get_func, set_func = node.get_func_def, node.set_func_def
+
+    if not (get_func and set_func) or len(get_func.lines) != 1 or len(set_func.lines) != 1:
+        return False
+
+    get_stmt, set_stmt = get_func.lines[0], set_func.lines[0]
+
+    if not (isinstance(get_stmt, ksp_ast.AssignStmt) and isinstance(set_stmt, ksp_ast.AssignStmt) and get_func.parameters and
+            list(set_func.parameters[:-1]) == list(get_func.parameters)):
+        return False
+
+    element = get_stmt.expression
+    value_param = set_func.parameters[-1]
+
+    return (isinstance(get_stmt.varref, ksp_ast.VarRef) and not get_stmt.varref.subscripts and
+            get_stmt.varref.identifier.identifier == get_func.return_value.identifier and
+            isinstance(element, ksp_ast.VarRef) and len(element.subscripts) == 1 and
+            isinstance(set_stmt.expression, ksp_ast.VarRef) and not set_stmt.expression.subscripts and
+            set_stmt.expression.identifier.identifier == str(value_param) and
+            str(set_stmt.varref) == str(element))
+
+def lower_multidimensional_array_access(node):
+    '''Replaces a multidimensional array access like arr[x, y] by the element of the flat array it maps to, eg. _arr[(5) * x + y].
+       Gives the same result as inlining the get/set function of the property, but only copies the index expression.'''
+    get_func = multidimensional_arrays[node.identifier.identifier].get_func_def
+
+    # the access is reported as a call of the get function, so that errors within the index refer to the line of the access
+    get_call = ksp_ast.FunctionCall(node.lexinfo, get_func.name, node.subscripts[:], is_procedure = False)
+    name_subst_dict = dict(list(zip(list(map(str, get_func.parameters)), node.subscripts)))
+
+    return ASTModifierVarRefSubstituter(name_subst_dict, inlining_function_node = get_call).modify(get_func.lines[0].expression.copy())
+
 class ASTModifierFixPrefixes(ASTModifierBase):
     '''Traverse AST and add prefixs to variables'''
 
@@ -1327,6 +1967,17 @@ class ASTModifierFixPrefixes(ASTModifierBase):
         return ASTModifierBase.modifyFunctionDef(self, node, parent_function = node) # pass along a reference to what function we're currently inside
 
     def modifyVarRef(self, node, parent_function = None, parent_varref = None):
+        # lower accesses of multidimensional arrays to their flat array element here rather than inlining the property functions later on.
+        # Other references (eg. the array passed on to a function, which may add the remaining subscripts, or a function parameter
+        # with the same name) are left to the function expander.
+        if node.identifier.identifier in multidimensional_arrays and \
+           len(node.subscripts) == len(multidimensional_arrays[node.identifier.identifier].get_func_def.parameters):
+            first_part = node.identifier.identifier_first_part
+
+            if not (parent_function and (first_part in parent_function.parameters or
+                                         parent_function.return_value and first_part == parent_function.return_value.identifier)):
+                node = lower_multidimensional_array_access(node)
+
         return ASTModifierBase.modifyVarRef(self, node, parent_function = parent_function, parent_varref = node) # pass along a reference to what varref we're currently inside
 
     def modifyID(self, node, parent_function = None, parent_varref = None):
@@ -1334,16 +1985,15 @@ class ASTModifierFixPrefixes(ASTModifierBase):
         name = node.prefix + node.identifier
         first_part = name.split('.')[0]
 
+        if node.prefix == '':
+            # a single lookup tells whether the name is a function, family or property, and which variables it could refer to
+            kind, possible_prefixes = prefix_index.resolve(name)
+
         # if prefix is missing and this is not a function or family and does not start with a function parameter
         # (e.g. if a parameter is passed as param and then referenced as param__member)
-        if node.prefix == '' and not (name in functions or
-                                      name in ksp_builtins.functions or
-                                      name in families or
-                                      name in properties or
+        if node.prefix == '' and not (kind or
                                       (parent_function and (first_part in parent_function.parameters or
                                                             parent_function.return_value and first_part == parent_function.return_value.identifier))):
-            possible_prefixes = [prefix for prefix in variable_prefixes
-                                 if prefix + name.lower() in variables or prefix + name in ksp_builtins.all_builtins]
 
             # if there is a subscript then only array types are possible
             if parent_varref and parent_varref.subscripts:
@@ -1410,6 +2060,24 @@ class ASTModifierIDSubstituter(ASTModifierBase):
         else:
             return node
 
+class ASTVisitorCountNames(ksp_ast_processing.ASTVisitor):
+    '''Counts how often each of the given (lower case, prefixed) names occurs in the AST. All other identifiers
+       are collected (lower case, without prefix) in other_names.'''
+
+    def __init__(self, ast, names):
+        ksp_ast_processing.ASTVisitor.__init__(self, visit_expressions = True)
+        self.counts = dict((name, 0) for name in names)
+        self.other_names = set()
+        self.traverse(ast)
+
+    def visitID(self, parent, node, *args):
+        key = (node.prefix + node.identifier).lower()
+
+        if key in self.counts:
+            self.counts[key] += 1
+        else:
+            self.other_names.add(node.identifier.lower())
+
 class ASTModifierVarRefSubstituter(ASTModifierBase):
     '''Class for replacing certain variables references with an expression, eg. replace all "param" by "$y+1".
        If there is an "x" to "y" substitution and it sees the name x.z, then this will be translated into y.z.
@@ -1521,10 +2189,288 @@ class ASTModifierNameFixer(ASTModifierBase):
 
         return node
 
+def statements_in(node):
+    '''Returns the statements directly nested in a callback, function or compound statement'''
+    if isinstance(node, (ksp_ast.Callback, ksp_ast.FunctionDef)):
+        return node.lines
+    elif isinstance(node, ksp_ast.IfStmt):
+        return [stmt for (condition, stmts) in node.condition_stmts_tuples for stmt in stmts]
+    elif isinstance(node, ksp_ast.SelectStmt):
+        return [stmt for (range, stmts) in node.range_stmts_tuples for stmt in stmts]
+    elif isinstance(node, ksp_ast.WhileStmt):
+        return node.statements
+
+    return []
+
+class FunctionOutliner(object):
+    '''Decides which functions to invoke with 'call' instead of inlining them, in order to make the compiled code smaller.
+
+       Functions are inlined wherever they are invoked without 'call', so their code is repeated for every invocation
+       (and for every copy of the functions that invoke them). A function is outlined when the code inlined for it would
+       take more than threshold lines and invoking it with 'call' saves lines: this makes the compiler emit it once as a
+       native KSP function, and every invocation a single line. Like any use of 'call', this has a cost at runtime.
+
+       Only invocations that could have been written with 'call' are changed: statements that invoke a function without
+       parameters or return value, outside the init callback and outside taskfuncs (including the functions inlined into
+       these, directly or through other functions). Functions that are taskfuncs,
+       override builtins, use polyphonic variables, invoke taskfuncs or use exit (also through the functions inlined
+       into them) are never outlined, and neither are functions that invoke themselves (the compiler reports those
+       later). An exit ends the callback when it is inlined, but only the function when it is invoked with 'call'.
+       The functions are chosen one by one, always the one that saves most lines, until none saves lines any more.'''
+
+    def __init__(self, module, threshold):
+        self.threshold = threshold
+        self.blocks = OrderedDict()   # function name or index of callback -> [own number of lines, [(function name, invocation, can be outlined)]]
+        self.is_init = set()          # keys of the init callbacks
+        self.taskfuncs = set()        # names of the taskfuncs
+        self.polyphonic = set(str(v.identifier) for v in self.find_polyphonic_variables(module))
+        self.outlined = OrderedDict() # name of outlined function -> (number of lines, number of inlined copies before outlining)
+        self.invocations_changed = 0
+        self.lines_saved = 0
+
+        for (i, block) in enumerate(module.blocks):
+            if isinstance(block, ksp_ast.Callback):
+                self.add_block(i, block, block.name == 'init')
+            elif isinstance(block, ksp_ast.FunctionDef):
+                self.add_block(block.name.identifier, block, False)
+
+        self.keep_inlined_invocations()
+        self.outline()
+
+    @staticmethod
+    def find_polyphonic_variables(module):
+        declarations = []
+        stack = list(module.blocks)
+
+        while stack:
+            node = stack.pop()
+
+            if isinstance(node, ksp_ast.DeclareStmt):
+                if 'polyphonic' in node.modifiers:
+                    declarations.append(node.variable)
+            else:
+                stack.extend(statements_in(node))
+
+        return declarations
+
+    def add_block(self, key, block, is_init):
+        '''Counts the lines of a callback or function (not including those of the functions inlined into it) and finds the invocations of functions in it'''
+        is_taskfunc = isinstance(block, ksp_ast.FunctionDef) and block.is_taskfunc
+        num_lines = 2
+        invocations = []
+        stack = list(reversed(block.lines))
+
+        while stack:
+            stmt = stack.pop()
+
+            if isinstance(stmt, ksp_ast.FunctionCall) and stmt.function_name.identifier in functions and not stmt.using_call_keyword:
+                can_outline = stmt.is_procedure and not stmt.parameters and not is_init and not is_taskfunc
+                invocations.append((stmt.function_name.identifier, stmt, can_outline))
+                continue
+            elif isinstance(stmt, ksp_ast.AssignStmt) and isinstance(stmt.expression, ksp_ast.FunctionCall) and \
+                 stmt.expression.function_name.identifier in functions:
+                invocations.append((stmt.expression.function_name.identifier, stmt.expression, False))
+                continue
+
+            num_lines += 1
+
+            if isinstance(stmt, ksp_ast.IfStmt):
+                num_lines += len(stmt.condition_stmts_tuples)
+            elif isinstance(stmt, ksp_ast.SelectStmt):
+                num_lines += len(stmt.range_stmts_tuples) + 1
+            elif isinstance(stmt, ksp_ast.WhileStmt):
+                num_lines += 1
+
+            stack.extend(reversed(statements_in(stmt)))
+
+        if is_init:
+            self.is_init.add(key)
+
+        if is_taskfunc:
+            self.taskfuncs.add(key)
+
+        self.blocks[key] = [num_lines, invocations]
+
+    def keep_inlined_invocations(self):
+        '''Marks the invocations in the functions inlined into the init callback or a taskfunc as not outlinable, since
+           'call' cannot be used there either. The invocation nodes of a function are shared by all of its inlined
+           copies, so an invocation cannot be outlined in some of them only.'''
+        restricted = set()
+
+        for key in self.is_init | self.taskfuncs:
+            restricted.update(self.inlined_functions(key))
+
+        for key in restricted:
+            num_lines, invocations = self.blocks.get(key, (0, []))
+            invocations[:] = [(callee, invocation, False) for (callee, invocation, can_outline) in invocations]
+
+    def can_be_outlined(self, name):
+        func = functions[name]
+
+        return not (func.parameters or func.return_value or func.is_taskfunc or func.override) and \
+               not any(self.must_be_inlined(n) for n in self.inlined_functions(name))
+
+    def must_be_inlined(self, name):
+        '''True if the function is a taskfunc, or uses a polyphonic variable, a taskfunc or exit in its own lines'''
+        func = functions[name]
+
+        if func.is_taskfunc:
+            return True
+
+        stack = list(func.lines)
+
+        while stack:
+            node = stack.pop()
+
+            if isinstance(node, ksp_ast.VarRef) and str(node.identifier.identifier) in self.polyphonic:
+                return True
+            elif isinstance(node, ksp_ast.FunctionCall) and node.function_name.identifier in functions and \
+                 functions[node.function_name.identifier].is_taskfunc:
+                return True
+            elif isinstance(node, ksp_ast.FunctionCall) and node.function_name.identifier == 'exit':
+                return True
+
+            stack.extend(child for child in node.get_childnodes() or [] if isinstance(child, ksp_ast.ASTNode))
+
+        return False
+
+    def inlined_functions(self, name):
+        '''Returns the function and all functions inlined into it'''
+        found = [name]
+        stack = [name]
+
+        while stack:
+            for (callee, invocation, can_outline) in self.blocks.get(stack.pop(), (0, []))[1]:
+                if callee not in found:
+                    found.append(callee)
+                    stack.append(callee)
+
+        return found
+
+    def sizes(self):
+        '''Returns the number of lines of each callback and function including the functions inlined into it, or None
+           if there is recursion'''
+        sizes = {}
+
+        for key in self.blocks:
+            stack = [(key, False)]
+            visiting = set()
+
+            while stack:
+                current, callees_done = stack.pop()
+
+                if current in sizes:
+                    continue
+
+                num_lines, invocations = self.blocks.get(current, (2, []))
+
+                if not callees_done:
+                    if current in visiting:
+                        return None
+
+                    visiting.add(current)
+                    stack.append((current, True))
+                    stack.extend((callee, False) for (callee, invocation, can_outline) in invocations if callee not in sizes)
+                else:
+                    sizes[current] = num_lines + sum(1 if self.is_outlined(callee, invocation, can_outline) else sizes[callee] - 2
+                                                     for (callee, invocation, can_outline) in invocations)
+
+        return sizes
+
+    def is_outlined(self, callee, invocation, can_outline):
+        return invocation.using_call_keyword or (callee in self.outlined and can_outline)
+
+    def copies(self):
+        '''Returns how often the code of each function occurs in the compiled code: once for every inlined invocation
+           (times the number of copies of the function it is in), and once more if it is invoked with 'call' somewhere'''
+        inlined = dict((key, 0) for key in self.blocks)
+        called = set(self.outlined) | set(name for name in self.blocks if name in functions and functions[name].is_taskfunc)
+
+        for (key, (num_lines, invocations)) in self.blocks.items():
+            for (callee, invocation, can_outline) in invocations:
+                if self.is_outlined(callee, invocation, False):
+                    called.add(callee)
+
+        # callers come before callees in a topological order, so the number of copies of a caller is known when it is used
+        order = []
+        num_callers = dict((key, 0) for key in self.blocks)
+
+        for (key, (num_lines, invocations)) in self.blocks.items():
+            for (callee, invocation, can_outline) in invocations:
+                num_callers[callee] = num_callers.get(callee, 0) + 1
+
+        ready = [key for key in self.blocks if num_callers[key] == 0]
+
+        while ready:
+            key = ready.pop()
+            order.append(key)
+
+            for (callee, invocation, can_outline) in self.blocks.get(key, (0, []))[1]:
+                num_callers[callee] -= 1
+
+                if num_callers[callee] == 0:
+                    ready.append(callee)
+
+        copies = {}
+
+        for key in order:
+            if key not in functions:
+                copies[key] = 1
+            else:
+                copies[key] = inlined.get(key, 0) + (1 if key in called else 0)
+
+            for (callee, invocation, can_outline) in self.blocks.get(key, (0, []))[1]:
+                if not self.is_outlined(callee, invocation, can_outline):
+                    inlined[callee] = inlined.get(callee, 0) + copies[key]
+
+        return copies, inlined
+
+    def outline(self):
+        candidates = [name for name in self.blocks if name in functions and self.can_be_outlined(name)]
+
+        while candidates:
+            sizes = self.sizes()
+
+            if sizes is None:
+                return
+
+            copies, inlined = self.copies()
+            best = None
+
+            for name in candidates:
+                # the invocations that would change, counted with the number of copies of the code they are in
+                changed = sum(copies.get(key, 0) for (key, (num_lines, invocations)) in self.blocks.items()
+                              for (callee, invocation, can_outline) in invocations if callee == name and can_outline)
+                body = sizes[name] - 2
+                extra = 0 if copies.get(name, 0) > inlined.get(name, 0) else sizes[name]   # the definition, unless already invoked with 'call'
+                saved = changed * (body - 1) - extra
+
+                if inlined.get(name, 0) * body > self.threshold and saved > 0 and (best is None or saved > best[1]):
+                    best = (name, saved, body, inlined.get(name, 0), changed)
+
+            if best is None:
+                return
+
+            name, saved, body, num_copies, changed = best
+            self.outlined[name] = (body, num_copies)
+            self.lines_saved += saved
+            candidates.remove(name)
+
+    def apply(self):
+        '''Makes the chosen invocations use 'call' and returns the number of changed invocations in the source code'''
+        for (key, (num_lines, invocations)) in self.blocks.items():
+            for (callee, invocation, can_outline) in invocations:
+                if callee in self.outlined and can_outline:
+                    invocation.using_call_keyword = True
+                    self.invocations_changed += 1
+
+        return self.invocations_changed
+
 class ASTModifierFunctionExpander(ASTModifierBase):
     '''Handle function usage'''
     def __init__(self, ast):
         ASTModifierBase.__init__(self, modify_expressions = True)
+        self.frame_slots_read = {}    # id of taskfunc -> offsets of the local variables it reads (see findFrameSlotsRead)
         self.traverse(ast, parent_toplevel = None, function_stack = [])
 
     def modifyModule(self, node, *args, **kwargs):
@@ -1555,6 +2501,10 @@ class ASTModifierFunctionExpander(ASTModifierBase):
         if (node.parameters or node.return_value) and not node.is_taskfunc:
             return node
         else:
+            if node.is_taskfunc:
+                # found before any taskfunc call in the body has its parameters removed
+                self.frame_slots_read[id(node)] = self.findFrameSlotsRead(node)
+
             return ASTModifierBase.modifyFunctionDef(self, node, parent_toplevel = node, function_stack = function_stack)
 
     def modifyCallback(self, node, parent_toplevel = None, function_stack = None):
@@ -1683,14 +2633,111 @@ class ASTModifierFunctionExpander(ASTModifierBase):
             if function_name not in functions:
                 raise ksp_ast.ParseException(node.function_name, "Unknown function: %s!" % function_name)
 
-            call_graph[parent_function_name].append(function_name)  # enter a link from the caller to the callee in the call graph
-            call_graph[function_name] = call_graph[function_name]   # add target node if it doesn't already exist
+            call_graph.add_edge(parent_function_name, function_name)  # enter a link from the caller to the callee in the call graph
+            function_call_sites[function_name].add(node.lineno)
 
             if node.using_call_keyword:
                 called_functions.add(function_name)
 
-    def getTaskFuncCallPrologueAndEpilogue(self, node, func, assign_stmt_lhs):
-        '''if the function call is of the format "x := myfunc(...)" then treat it like myfunc(..., x), i.e. insert the left hand side of the assignment as the last parameter'''
+    def isFrameVariable(self, param, parent_toplevel):
+        '''True if param is a parameter, return value or local variable of the taskfunc parent_toplevel, i.e. a slot in
+           its stack frame which no other function (and no other task) can refer to by name'''
+        if not (isinstance(parent_toplevel, ksp_ast.FunctionDef) and parent_toplevel.is_taskfunc and isinstance(param, ksp_ast.VarRef)):
+            return False
+
+        if not param.subscripts:
+            names = [str(p) for p in parent_toplevel.parameters + [parent_toplevel.return_value] if p is not None]
+            return param.identifier.identifier in names
+
+        # locals have already been replaced by %p[$fp + <var_index>]
+        subscript = param.subscripts[0]
+
+        return str(param.identifier) == '%p' and len(param.subscripts) == 1 and isinstance(subscript, ksp_ast.BinOp) and \
+               str(subscript.left) == '$fp' and subscript.op == '+' and isinstance(subscript.right, ksp_ast.Integer)
+
+    def taskfuncMayAssignParameter(self, func, name):
+        '''True unless the body of the taskfunc func certainly does not assign to its parameter called name. Passing the
+           parameter on to a user-defined function or as a variable parameter of a builtin counts as assigning to it.'''
+        stack = list(func.lines)
+
+        while stack:
+            node = stack.pop()
+
+            if isinstance(node, ksp_ast.AssignStmt) and node.varref.identifier.identifier_first_part == name:
+                return True
+
+            if isinstance(node, ksp_ast.ForStmt) and node.loopvar.identifier.identifier_first_part == name:
+                return True
+
+            if isinstance(node, ksp_ast.FunctionCall):
+                function_name = node.function_name.identifier
+                is_builtin = function_name in ksp_builtins.functions and function_name not in functions
+
+                for i, param in enumerate(node.parameters):
+                    if isinstance(param, ksp_ast.VarRef) and param.identifier.identifier_first_part == name and \
+                       (not is_builtin or optimizer.is_reference_parameter(function_name, i, len(node.parameters))):
+                        return True
+
+            stack.extend(n for n in node.get_childnodes() or [] if isinstance(n, ksp_ast.ASTNode))
+
+        return False
+
+    @staticmethod
+    def frameSlotOffset(param):
+        '''Returns n if param is %p[$fp + n], ie. a local variable of the current taskfunc, otherwise None'''
+        if isinstance(param, ksp_ast.VarRef) and str(param.identifier) == '%p' and len(param.subscripts) == 1:
+            subscript = param.subscripts[0]
+
+            if isinstance(subscript, ksp_ast.BinOp) and str(subscript.left) == '$fp' and subscript.op == '+' and \
+               isinstance(subscript.right, ksp_ast.Integer):
+                return subscript.right.value
+
+        return None
+
+    def findFrameSlotsRead(self, func):
+        '''Returns the offsets n of the local variables %p[$fp + n] that the taskfunc func may read, or None if it reads
+           %p in a way that may refer to any of them. Assigning to a variable or passing it as an 'out' parameter of a
+           taskfunc does not read it, and neither does reading %p[$sp - n], which is in the frame of a taskfunc called.'''
+        read = set()
+        stack = list(func.lines)
+
+        while stack:
+            node = stack.pop()
+
+            if isinstance(node, ksp_ast.AssignStmt):
+                stack.extend(node.varref.subscripts)
+                stack.append(node.expression)
+                continue
+            elif isinstance(node, ksp_ast.FunctionCall) and node.function_name.identifier in functions and \
+                 functions[node.function_name.identifier].is_taskfunc:
+                parameter_types = functions[node.function_name.identifier].parameter_types
+
+                for i, param in enumerate(node.parameters):
+                    if i < len(parameter_types) and parameter_types[i] == 'out' and isinstance(param, ksp_ast.VarRef):
+                        stack.extend(param.subscripts)
+                    else:
+                        stack.append(param)
+                continue
+            elif isinstance(node, ksp_ast.VarRef) and str(node.identifier) == '%p':
+                offset = self.frameSlotOffset(node)
+                subscript = node.subscripts[0] if len(node.subscripts) == 1 else None
+
+                if offset is not None:
+                    read.add(offset)
+                elif not (isinstance(subscript, ksp_ast.BinOp) and str(subscript.left) == '$sp' and subscript.op == '-' and
+                          isinstance(subscript.right, ksp_ast.Integer)):
+                    return None
+
+            stack.extend(n for n in node.get_childnodes() or [] if isinstance(n, ksp_ast.ASTNode))
+
+        return read
+
+    def getTaskFuncCallPrologueAndEpilogue(self, node, func, assign_stmt_lhs, parent_toplevel = None):
+        '''if the function call is of the format "x := myfunc(...)" then treat it like myfunc(..., x), i.e. insert the left hand side of the assignment as the last parameter.
+           The value of a 'var' parameter is only copied back if the taskfunc may change it or if the variable passed
+           could have been changed meanwhile by someone else (it is not a slot in the stack frame of the calling taskfunc).
+           The value of a 'var' or 'out' parameter is not copied back to a local variable of the calling taskfunc that
+           it never reads.'''
 
         if assign_stmt_lhs:
             parameters = node.parameters + [assign_stmt_lhs]
@@ -1718,6 +2765,16 @@ class ASTModifierFunctionExpander(ASTModifierBase):
                                        [ksp_ast.BinOp(li, ksp_ast.VarRef(li, ksp_ast.ID(li, '$sp')), '-', ksp_ast.Integer(li, idx))])
                 prologue.append(ksp_ast.AssignStmt(li, p_ref, param))
 
+            if func.parameter_types[i] == 'var' and self.isFrameVariable(param, parent_toplevel) and \
+               not self.taskfuncMayAssignParameter(func, str(func.parameters[i])):
+                continue
+
+            slots_read = self.frame_slots_read.get(id(parent_toplevel))
+            offset = self.frameSlotOffset(param) if self.isFrameVariable(param, parent_toplevel) else None
+
+            if offset is not None and slots_read is not None and offset not in slots_read:
+                continue
+
             if isinstance(param, ksp_ast.VarRef) and func.parameter_types[i] in ('out', 'var'):
                 li = param.lexinfo
                 p_ref = ksp_ast.VarRef(li, ksp_ast.ID(li, '%p'),
@@ -1756,7 +2813,7 @@ class ASTModifierFunctionExpander(ASTModifierBase):
 
         # if it's a call to a taskfunc function
         if func.is_taskfunc:
-            (prologue, epilogue) = self.getTaskFuncCallPrologueAndEpilogue(node, func, assign_stmt_lhs)
+            (prologue, epilogue) = self.getTaskFuncCallPrologueAndEpilogue(node, func, assign_stmt_lhs, parent_toplevel)
             prologue = flatten([self.modifyAssignStmt(stmt, parent_toplevel, function_stack, disallow_function_in_rhs = True) for stmt in prologue])
             epilogue = flatten([self.modifyAssignStmt(stmt, parent_toplevel, function_stack, disallow_function_in_rhs = True) for stmt in epilogue])
             result = prologue + [node] + epilogue
@@ -1855,17 +2912,16 @@ class ASTModifierTaskfuncFunctionHandler(ASTModifierBase):
         if 'TCM_DEBUG' in true_conditions:
             line3 = FunctionCall(li, function_name = ID(li, 'check_full'), parameters = [], is_procedure = True, using_call_keyword = True)
             node.lines.insert(3, line3)
-            call_graph[node.name.identifier].append('check_full')
+            call_graph.add_edge(node.name.identifier, 'check_full')
             called_functions.add('check_full')
 
-        # epilogue
-        line0 = AssignStmt(li, VarRef(li, ID(li, '$sp')), VarRef(li, ID(li, '$fp')))
+        # epilogue (the stack pointer is restored relative to the frame pointer before that is popped, which saves the
+        # "$sp := $fp" step)
+        line0 = AssignStmt(li, VarRef(li, ID(li, '$sp')), BinOp(li, VarRef(li, ID(li, '$fp')), '+', Integer(li, Ta)))
         line1 = AssignStmt(li, VarRef(li, ID(li, '$fp')), VarRef(li, ID(li, '%p'), [VarRef(li, ID(li, '$fp'))]))
-        line2 = AssignStmt(li, VarRef(li, ID(li, '$sp')), BinOp(li, VarRef(li, ID(li, '$sp')), '+', Integer(li, Ta)))
 
         node.lines.append(line0)
         node.lines.append(line1)
-        node.lines.append(line2)
 
         node.parameters = []
 
@@ -1929,25 +2985,16 @@ class ASTModifierFixPrefixesAndFixControlPars(ASTModifierFixPrefixes):
         else:
             return node
 
-def mark_used_functions_using_depth_first_traversal(call_graph, start_node = None, visited = None):
+def mark_used_functions_using_depth_first_traversal(call_graph, visited = None):
     ''' Make a depth-first traversal of call graph and set the used attribute of functions invoked directly or indirectly from some callback.
-        The graph is represented by a dictionary where graph[f1] == f1 means that the function with name f1 calls the function with name f2 (the names are strings).'''
+        None represents the source of a normal callback (a callback invoking a function as opposed to a function invoking a function).'''
 
     if visited is None:
         visited = set()
 
-    nodes_to_visit = set()
-
-    if start_node is None:
-        nodes_to_visit = set(call_graph[None])  # None represents the source of a normal callback (a callback invoking a function as opposed to a function invoking a function)
-    else:
-        if start_node not in visited:
-            functions[start_node].used = True
-            visited.add(start_node)
-            nodes_to_visit = set([x for x in call_graph[start_node] if x is not None])
-
-    for n in nodes_to_visit:
-        mark_used_functions_using_depth_first_traversal(call_graph, n, visited)
+    for function_name in call_graph.reachable(call_graph.successors(None)):
+        functions[function_name].used = True
+        visited.add(function_name)
 
 def find_node(start_node, search_node, visited = None, path = None):
     if visited is None:
@@ -1965,72 +3012,21 @@ def find_node(start_node, search_node, visited = None, path = None):
 
     return path
 
-def find_cycles(graph, ready = None):
-    # adapted from code at http://neopythonic.blogspot.com/2009/01/detecting-cycles-in-directed-graph.html
-    if ready is None:
-        ready = set()
+def find_cycles(graph):
+    '''Raise an exception listing every cycle in the call graph (functions invoking themselves directly or indirectly)'''
+    cycles = graph.find_cycles()
 
-    todo = set(graph.keys())
+    if cycles:
+        raise Exception('Recursion detected! ' + ', '.join('->'.join(map(str, cycle)) for cycle in cycles))
 
-    while todo:
-        node = todo.pop()
-        stack = [node]
+def uncompress_variable_names(compiled_code, short2original):
+    '''Replace the compacted variable names in compiled_code by their original names, using a short -> original name dictionary'''
+    def sub_func(match_obj):
+        s = match_obj.group(0)
 
-        while stack:
-            top = stack[-1]
+        return short2original.get(s, s)
 
-            for node in graph[top]:
-                if node in stack:
-                    raise Exception('Recursion detected! ' + '->'.join(map(str, stack + [node])))
-
-                if node in todo:
-                    stack.append(node)
-                    todo.remove(node)
-                    break
-            else:
-                node = stack.pop()
-        ready.add(node)
-
-    return None
-
-def topological_sort(graph):
-    # copied from here: http://www.logarithmic.net/pfh-files/blog/01208083168/sort.py
-    count = {}
-
-    # TODO: maybe replace None with empty string '' to make sorting easier
-    nodes = ['' if k is None else k for k in graph.keys()]
-    nodes.sort()
-    nodes = [None if k == '' else k for k in nodes]
-
-    for node in nodes:
-        count[node] = 0
-
-    for node in nodes:
-        for successor in graph[node]:
-            count[successor] += 1
-
-    ready = [node for node in nodes if count[node] == 0]
-
-    result = []
-
-    while ready:
-        node = ready.pop(-1)
-        result.append(node)
-
-        for successor in graph[node]:
-            count[successor] -= 1
-
-            if count[successor] == 0:
-                ready.append(successor)
-
-    return result
-
-def compress_variable_name(name):
-    symbols = 'abcdefghijklmnopqrstuvwxyz012345'
-    hash = hashlib.new('sha1')
-    hash.update(name.encode('utf-8'))
-
-    return ''.join((symbols[ch & 0x1F] for ch in hash.digest()[:5]))
+    return varname_re.sub(sub_func, compiled_code)
 
 def parse_nckp(path):
     '''
@@ -2088,7 +3084,7 @@ def parse_nckp(path):
     for i, p in enumerate(ui_controls_names):
         yield cur_prefix[i] + p
 
-def open_nckp(lines, basedir):
+def open_nckp(lines, basedir, dependency_graph = None):
     source = merge_lines(lines) # for checking purposes
     nckp_path = '' # predeclared to avoid errors if the import_nckp ksp function is not used
     ui_to_import = []
@@ -2112,6 +3108,9 @@ def open_nckp(lines, basedir):
                         nckp_path = os.path.join(basedir, nckp_path)
 
                     if os.path.exists(nckp_path):
+                        if dependency_graph is not None:
+                            dependency_graph.add_data_file(os.path.abspath(nckp_path))
+
                         ui_to_import = list(parse_nckp(nckp_path))
 
                         if not ui_to_import:
@@ -2121,10 +3120,12 @@ def open_nckp(lines, basedir):
                         for i, v in enumerate(ui_to_import):
                             variables.add(v.lower())
                             ui_variables.add(v.lower())
+                            prefix_index.add_variable(v)
                             comp_extras.add_nckp_var_to_nckp_table(v)
 
                             # Support the use of '.' variables in the compiler to reference controls with double underscores
                             variables.add(v.lower().replace('__', '.'))
+                            prefix_index.add_variable(v.replace('__', '.'))
                             ui_variables.add(v.lower().replace('__', '.'))
                             comp_extras.add_nckp_var_to_nckp_table(v.replace('__', '.'))
 
@@ -2143,7 +3144,36 @@ def strip_import_nckp_function_from_source(lines):
         if 'import_nckp' in ls_line:
             line_obj.command = re.sub(r'[^\r\n]', '', ls_line)
 
+def format_phase_timings(phase_timings, baseline_timings = None):
+    '''Returns a list of lines describing how long each compilation phase took,
+       next to the time the same phase took in baseline_timings (e.g. a full compilation) if given'''
+    result = []
+    baseline_timings = baseline_timings or []
+
+    for i, (desc, seconds) in enumerate(phase_timings):
+        line = '    %-34s %8.1f ms' % (desc, seconds * 1000)
+
+        if i < len(baseline_timings) and baseline_timings[i][0] == desc:
+            line += '   (full compile: %.1f ms)' % (baseline_timings[i][1] * 1000)
+
+        result.append(line)
+
+    total = '    %-34s %8.1f ms' % ('total', sum(seconds for (desc, seconds) in phase_timings) * 1000)
+
+    if baseline_timings:
+        total += '   (full compile: %.1f ms)' % (sum(seconds for (desc, seconds) in baseline_timings) * 1000)
+
+    result.append(total)
+
+    return result
+
 class KSPCompiler(object):
+    # options that influence the compiled code (some of them can be overridden by compile_with pragmas)
+    option_names = ('compact', 'compact_variables', 'combine_callbacks', 'extra_syntax_checks', 'optimize', 'additional_branch_optimization',
+                    'sanitize_exit_command', 'add_compiled_date_comment', 'force_compiler_arguments', 'write_log_on_fail',
+                    'compiled_code_tab_size', 'compaction_map_file', 'shortest_names', 'eliminate_common_subexpressions',
+                    'lower_select_statements', 'outline_threshold')
+
     def __init__(self,
                  source,
                  basedir,
@@ -2157,7 +3187,16 @@ class KSPCompiler(object):
                  add_compiled_date_comment      = False,
                  force_compiler_arguments       = False,
                  write_log_on_fail              = False,
-                 compiled_code_tab_size         = 2):
+                 compiled_code_tab_size         = 2,
+                 import_cache                   = None,
+                 incremental_cache              = None,
+                 python_read_cache              = None,
+                 compaction_map_file            = None,
+                 shortest_names                 = False,
+                 compile_cache                  = None,
+                 eliminate_common_subexpressions = False,
+                 lower_select_statements        = False,
+                 outline_threshold              = 0):
 
         self.source = source
         self.basedir = basedir
@@ -2172,6 +3211,9 @@ class KSPCompiler(object):
         self.write_log_on_fail = write_log_on_fail
         self.compiled_code_tab_size = compiled_code_tab_size
         self.extra_syntax_checks = extra_syntax_checks or optimize
+        self.eliminate_common_subexpressions = eliminate_common_subexpressions   # with optimize, keep repeated subexpressions in temporary variables
+        self.lower_select_statements = lower_select_statements                   # with optimize, turn large select statements into lookups or if trees
+        self.outline_threshold = outline_threshold                               # invoke functions with 'call' if inlining them takes more lines (0: never)
 
         self.abort_requested = False
 
@@ -2184,18 +3226,38 @@ class KSPCompiler(object):
 
         self.original2short = {}
         self.short2original = {}
+        self.compaction_map_file = compaction_map_file   # optional file in which the compacted names are kept between builds
+        self.shortest_names = shortest_names             # compact to the shortest names (by frequency) instead of hashes
 
         self.variable_names_to_preserve = set()
         self.compiler_options_to_override = dict()
 
         self.compiler_import_cache = []
+        self.import_cache = import_cache   # optional ImportCache shared between compilations
+
+        # optional IncrementalCache with the results of a previous compilation of the same script
+        self.incremental_cache = incremental_cache
+        self.dependency_graph = None
+        self.expansion_cache = None
+
+        if incremental_cache is not None:
+            self.import_cache = import_cache or incremental_cache.import_cache
+            self.expansion_cache = incremental_cache.expansion_cache
+
+        self.phase_timings = []            # list of (description, seconds) for each executed compilation phase
+        self.stats = OrderedDict()         # statistics about the last compilation, name -> value
+
+        self.python_read_cache = python_read_cache   # optional PythonReadCache memoising the results of read<< >> blocks
+        self.compile_cache = compile_cache           # optional CompileCache with the results of earlier compilations
 
     def do_imports_and_convert_to_line_objects(self):
         # Import files
         self.lines = parse_lines_and_handle_imports(self.basedir,
                                                     self.source,
                                                     self.compiler_import_cache,
-                                                    preprocessor_func = self.examine_pragmas)
+                                                    preprocessor_func = self.examine_pragmas,
+                                                    import_cache = self.import_cache,
+                                                    dependency_graph = self.dependency_graph)
 
         # Parse conditionals and remove lines if appropriate
         handle_conditional_lines(self.lines)
@@ -2222,14 +3284,15 @@ class KSPCompiler(object):
             self.lines += parse_lines_and_handle_imports(self.basedir,
                                                          taskfunc_code,
                                                          self.compiler_import_cache,
-                                                         preprocessor_func = self.examine_pragmas)
+                                                         preprocessor_func = self.examine_pragmas,
+                                                         import_cache = self.import_cache)
 
         # Run conditional stage a second time to catch the new source additions.
         handle_conditional_lines(self.lines)
 
     def search_for_nckp(self):
         '''Import nckp if import_nckp() found'''
-        if open_nckp(self.lines, self.basedir):
+        if open_nckp(self.lines, self.basedir, self.dependency_graph):
             strip_import_nckp_function_from_source(self.lines)
 
     def replace_string_placeholders(self):
@@ -2245,8 +3308,22 @@ class KSPCompiler(object):
         '''Create define cache and run pre_macro_functions from `preprocessor_plugins.py`'''
         from preprocessor_plugins import pre_macro_functions
 
+        if self.dependency_graph is not None:
+            # the define names are only known afterwards, so remember which words each line uses
+            words_per_line = [(line.locations[0], set(re.findall(r'[\w.]+', line.command))) for line in self.lines]
+
         self.define_cache = pre_macro_functions(self.lines)
 
+        if self.dependency_graph is not None:
+            define_names = set(dc.name for dc in self.define_cache)
+
+            for location, words in words_per_line:
+                for name in words & define_names:
+                    self.dependency_graph.add_define_use(name, location)
+
+        if self.expansion_cache is not None:
+            self.expansion_cache.set_define_constants(self.define_cache)
+
     def run_post_macro_functions(self):
         '''Run post_macro_functions from `preprocessor_plugins.py`'''
         from preprocessor_plugins import post_macro_functions, handleStringArrayInitialisation, handleArrayConcat
@@ -2268,19 +3345,19 @@ class KSPCompiler(object):
     def expand_macros(self):
         from preprocessor_plugins import macro_iter_functions, post_macro_iter_functions, substituteDefines
 
-        normal_lines, callback_lines = expand_macros(self.lines, self.macros, 0, True, self.define_cache)
+        normal_lines, callback_lines = expand_macros(self.lines, self.macros, 0, True, self.define_cache, self.expansion_cache, self.dependency_graph)
         self.lines = normal_lines + callback_lines
 
         convert_strings_to_placeholders(self.lines)
 
         while macro_iter_functions(self.lines, placeholders):
-            normal_lines, callback_lines = expand_macros(self.lines, self.macros, 0, True, self.define_cache)
+            normal_lines, callback_lines = expand_macros(self.lines, self.macros, 0, True, self.define_cache, self.expansion_cache, self.dependency_graph)
             self.lines = normal_lines + callback_lines
 
         convert_strings_to_placeholders(self.lines)
 
         while post_macro_iter_functions(self.lines, placeholders):
-            normal_lines, callback_lines = expand_macros(self.lines, self.macros, 0, True, self.define_cache)
+            normal_lines, callback_lines = expand_macros(self.lines, self.macros, 0, True, self.define_cache, self.expansion_cache, self.dependency_graph)
             self.lines = normal_lines + callback_lines
 
     def examine_pragmas(self, code, namespaces):
@@ -2351,7 +3428,7 @@ class KSPCompiler(object):
 
         # make a topological sorting of the call graph filter out the functions invoked using 'call'
         function_definition_order = [function_name
-                                     for function_name in reversed(topological_sort(call_graph))
+                                     for function_name in reversed(call_graph.topological_sort())
                                      if function_name in called_functions and function_name in used_functions]
 
         # create a lookup table from function name to function definition, remove all function definitions
@@ -2368,6 +3445,17 @@ class KSPCompiler(object):
                 f.global_declaration_statements = []
                 f.local_declaration_statements = []
 
+    def outline_functions(self):
+        outliner = FunctionOutliner(self.module, self.outline_threshold)
+        outliner.apply()
+
+        self.stats['outlined functions'] = len(outliner.outlined)
+        self.stats['invocations changed to call'] = outliner.invocations_changed
+        self.stats['estimated lines saved by outlining'] = outliner.lines_saved
+
+        for (name, (num_lines, num_copies)) in outliner.outlined.items():
+            self.stats['outlined function %s' % name] = '%d lines, was inlined %d times' % (num_lines, num_copies)
+
     def convert_dots_to_double_underscore(self):
         '''Convert all dots into '__' (and update the list of variables accordingly)
            Note: for historical reasons the ksp_compiler_extras functions assume
@@ -2386,60 +3474,162 @@ class KSPCompiler(object):
         # build regular expression that can later tell which names to preserve (these should not undergo compaction)
         preserve_pattern = re.compile(r'[$%@!?~]?(' + '|'.join(self.variable_names_to_preserve) + ')$', re.I)
 
-        for v in variables:
-            if self.variable_names_to_preserve and preserve_pattern.match(v):
-                continue
-            elif v not in self.original2short and v not in ksp_builtins.all_builtins:
-                self.original2short[v] = '%s%s' % (v[0], compress_variable_name(v))
-                if self.original2short[v] in ksp_builtins.all_builtins:
-                    raise Exception('This is your unlucky day! Even though the chance is only 0.32%%, the variable %s was mapped to the same hash as that of a builtin KSP variable.' % (v))
-                if self.original2short[v] in self.short2original:
-                    raise Exception('This is your unlucky day! Even though the chance is only 0.32%%, two variable names were compacted to the same short name: %s and %s.' % (v, self.short2original[self.original2short[v]]))
-                self.short2original[self.original2short[v]] = v
+        preserved_names = set(v for v in variables if self.variable_names_to_preserve and preserve_pattern.match(v))
+        names = set(v for v in variables if v not in preserved_names and v not in ksp_builtins.all_builtins)
+
+        if self.shortest_names:
+            self.compact_names_by_frequency(names, preserved_names)
+        else:
+            if self.compaction_map_file:
+                names_map = NameCompactionMap.load(self.compaction_map_file)
+            else:
+                names_map = NameCompactionMap()
+
+            names_map.add_names(names, reserved = ksp_builtins.all_builtins | preserved_names)
+
+            if self.compaction_map_file:
+                names_map.save()
+
+            self.original2short = dict((v, names_map.original2short[v]) for v in names)
+            self.short2original = names_map.short2original
+
+            self.stats['compacted names'] = len(names)
+            self.stats['newly compacted names'] = names_map.added
+            self.stats['compacted name collisions'] = names_map.collisions
 
         ASTModifierIDSubstituter(self.original2short, force_lower_case = True).modify(self.module)
 
+    def compact_names_by_frequency(self, names, preserved_names):
+        '''Gives the shortest names to the most frequently used variables. These names depend on how often each variable
+           is used, so unlike the hashed names they can change from one build to the next.'''
+        counter = ASTVisitorCountNames(self.module, names)
+        counts = counter.counts
+
+        # short names must not clash with anything else that occurs in the compiled code, whatever its prefix
+        reserved = set(name.lstrip('$%@!?~').lower() for name in ksp_builtins.all_builtins | preserved_names)
+        reserved |= set(name.lower() for name in ksp_builtins.keywords | set(ksp_builtins.functions))
+        reserved |= counter.other_names
+
+        self.original2short = rank_names_by_frequency(counts, reserved)
+        self.short2original = dict((short, v) for (v, short) in self.original2short.items())
+
+        if self.compaction_map_file:
+            save_reverse_map(reverse_map_path(self.compaction_map_file), self.short2original)
+
+        hashed_length = 1 + len(compress_variable_name(''))
+
+        self.stats['compacted names'] = len(names)
+        self.stats['bytes saved compared to hashed names'] = sum(n * (hashed_length - len(self.original2short[v])) for (v, n) in counts.items())
+        self.stats['bytes saved compared to original names'] = sum(n * (len(v) - len(self.original2short[v])) for (v, n) in counts.items())
+
     def init_extra_syntax_checks(self):
         comp_extras.clear_symbol_table()
         self.used_variables = set()
         self.var_assigns = {}
 
+    def propagate_constants(self):
+        propagation = optimizer.ASTModifierPropagateConstants(self.module)
+
+        self.stats['propagated constants'] = propagation.constants_propagated
+        self.stats['propagated copies'] = propagation.copies_propagated
+        self.stats['redundant assignments removed'] = propagation.redundant_assignments_removed
+
+    def optimize_peephole(self):
+        peephole = optimizer.PeepholeOptimizer(self.module)
+
+        for (name, hits) in peephole.hits.items():
+            self.stats['peephole rule %s' % name] = hits
+
+    def remove_dead_stores(self):
+        elimination = optimizer.DeadStoreElimination(self.module)
+
+        self.stats['dead stores removed'] = elimination.stores_removed
+
+    def merge_identical_functions(self):
+        merger = optimizer.IdenticalFunctionMerger(self.module)
+
+        self.stats['identical functions merged'] = len(merger.merged)
+
+        for (name, kept) in merger.merged.items():
+            self.stats['merged function %s' % name] = 'into %s' % kept
+
+        for controls in merger.similar_callbacks:
+            self.stats['ui callbacks differing only in their control %s' % controls[0]] = ', '.join(controls)
+
+    def lower_selects(self):
+        global variables
+
+        lowering = optimizer.SelectLowering(self.module, variables)
+        variables.update(name.lower() for name in lowering.temporary_names())
+
+        self.stats['select statements turned into lookup tables'] = lowering.lookup_tables
+        self.stats['select statements turned into if trees'] = lowering.search_trees
+        self.stats['expected select case tests saved per execution'] = round(lowering.expected_tests_saved, 1)
+
+    def move_loop_invariant_code(self):
+        global variables
+
+        motion = optimizer.LoopInvariantCodeMotion(self.module, variables)
+        variables.update(name.lower() for name in motion.temporary_names())
+
+        self.stats['loops with invariant code moved out'] = motion.loops_changed
+        self.stats['loop-invariant expressions moved'] = motion.expressions_moved
+
+    def replace_common_subexpressions(self):
+        global variables
+
+        elimination = optimizer.CommonSubexpressionEliminator(self.module, variables)
+        variables.update(name.lower() for name in elimination.temporary_names())
+
+        self.stats['temporary variables for common subexpressions'] = len(elimination.temporary_names())
+        self.stats['common subexpressions replaced'] = elimination.expressions_replaced
+
     def generate_compiled_code(self):
-        '''Generate compiled code from AST'''
+        '''Generate compiled code from AST (without the date comment, see add_compiled_date)'''
 
         buffer = StringIO()
         emitter = ksp_ast.Emitter(buffer, compact = self.compact, compiled_code_tab_size = self.compiled_code_tab_size)
         self.module.emit(emitter)
         self.compiled_code = buffer.getvalue()
 
-        lines = self.compiled_code.split('\n')
-
-        new_lines = []
+    def add_compiled_date(self):
+        '''Adds the current date in a comment before the compiled code if add_compiled_date_comment is set. This is done
+           after storing the code in the compile cache, so that a cache hit gets the date of the current compilation.'''
         if self.add_compiled_date_comment:
             localtime = time.asctime( time.localtime(time.time()) )
-            new_lines.append("{ Compiled on " + localtime + " }")
+            self.compiled_code = "{ Compiled on " + localtime + " }\n" + self.compiled_code
 
-        init_block = False
-        for l in lines:
-            new_lines.append(l)
+    def uncompress_variable_names(self, compiled_code):
+        return uncompress_variable_names(compiled_code, self.short2original)
 
-        self.compiled_code = '\n'.join(new_lines)
+    def compile(self, callback = None):
+        global variables, python_read_cache
 
-    def uncompress_variable_names(self, compiled_code):
-        def sub_func(match_obj):
-            s = match_obj.group(0)
+        clear_global_context()
 
-            if s in self.short2original:
-                return self.short2original[s]
-            else:
-                return s
+        python_read_cache = self.python_read_cache
 
-        return varname_re.sub(sub_func, compiled_code)
+        self.phase_timings = []
+        self.stats = OrderedDict()
 
-    def compile(self, callback = None):
-        global variables
+        if self.compile_cache is not None:
+            t = time.perf_counter()
+            cache_key = self.compile_cache_key()
+            entry = self.compile_cache.lookup(cache_key, self.dependency_fingerprint)
+            self.phase_timings.append(('looking up compile cache', time.perf_counter() - t))
 
-        clear_global_context()
+            if entry is not None:
+                self.use_cached_result(entry, cache_key)
+                return True
+
+        from preprocessor_plugins import stringEvaluator
+        evaluator_stats_before = stringEvaluator.stats()
+
+        if self.incremental_cache is not None or self.compile_cache is not None:
+            self.dependency_graph = DependencyGraph()
+
+        if self.incremental_cache is not None:
+            self.incremental_cache.begin_compilation()
 
         compiled_code = []
         try:
@@ -2457,7 +3647,9 @@ class KSPCompiler(object):
             if callback:
                 callback('scanning and importing code', tasks_executed)
 
+            t = time.perf_counter()
             self.do_imports_and_convert_to_line_objects()
+            self.phase_timings.append(('scanning and importing code', time.perf_counter() - t))
             tasks_executed += 1
 
             # override compiler options through pragma directives
@@ -2514,6 +3706,7 @@ class KSPCompiler(object):
                  ('combining callbacks',              lambda: ASTModifierCombineCallbacks(self.module, self.combine_callbacks),                       True),
                  ('modifying nodes to native KSP',    lambda: ASTModifierNodesToNativeKSP(self.module, self.lines),                                   True),
                  ('adding variable name prefixes',    lambda: ASTModifierFixPrefixesIncludingLocalVars(self.module),                                  True),
+                 ('outlining large functions',        self.outline_functions,                                                                         self.outline_threshold > 0),
                  ('inlining functions',               lambda: ASTModifierFunctionExpander(self.module),                                               True),
                  ('handling taskfuncs',               lambda: ASTModifierTaskfuncFunctionHandler(self.module),                                        True),
                  ('handling local variables',         lambda: self.sort_functions_and_insert_local_variables_into_on_init(),                          True),
@@ -2525,14 +3718,23 @@ class KSPCompiler(object):
                  ('checking statement types',         lambda: comp_extras.ASTVisitorCheckStatementExprTypes(self.module),                             do_extra),
                  ('removing unused branches',         lambda: comp_extras.ASTModifierRemoveUnusedBranches(self.module),                               do_abo),
                  ('checking declarations',            lambda: comp_extras.ASTVisitorCheckDeclarations(self.module),                                   do_extra),
+                 ('copying shared expressions',       lambda: optimizer.ASTModifierUnshareExpressions(self.module),                                   do_optim),
+                 ('simplying expressions',            lambda: comp_extras.ASTModifierSimplifyExpressions(self.module, True),                          do_optim),
+                 ('propagating constants and copies', self.propagate_constants,                                                                   do_optim),
                  ('simplying expressions',            lambda: comp_extras.ASTModifierSimplifyExpressions(self.module, True),                          do_optim),
                  ('removing unused branches',         lambda: comp_extras.ASTModifierRemoveUnusedBranches(self.module),                               do_optim),
+                 ('removing dead stores',             self.remove_dead_stores,                                                                        do_optim),
                  ('finding unused functions',         lambda: comp_extras.ASTVisitorFindUsedFunctions(self.module, used_functions),                   do_optim),
                  ('removing unused functions',        lambda: comp_extras.ASTModifierRemoveUnusedFunctions(self.module, used_functions),              do_optim),
                  ('finding unused variables',         lambda: comp_extras.ASTVisitorFindUsedVariables(self.module, used_variables, var_assigns),      do_optim),
                  ('removing unused variables',        lambda: comp_extras.ASTModifierRemoveUnusedVariables(self.module, used_variables, var_assigns), do_optim),
+                 ('merging identical functions',      self.merge_identical_functions,                                                                 do_optim),
+                 ('lowering select statements',       self.lower_selects,                                                                             do_optim and self.lower_select_statements),
+                 ('moving loop-invariant code',       self.move_loop_invariant_code,                                                                  do_optim),
+                 ('eliminating common subexpressions', self.replace_common_subexpressions,                                                        do_optim and self.eliminate_common_subexpressions),
 
                  ('compacting variable names',        self.compact_names,                                                                             self.compact_variables),
+                 ('applying peephole rules',          self.optimize_peephole,                                                                         do_optim),
                  ('generating code',                  self.generate_compiled_code,                                                                    True),
             ]
 
@@ -2548,10 +3750,29 @@ class KSPCompiler(object):
                     callback(desc, 100 * tasks_executed / total_tasks)
                     compiled_code = [line.command for line in self.lines]
 
+                t = time.perf_counter()
                 func()
+                self.phase_timings.append((desc, time.perf_counter() - t))
 
                 tasks_executed += 1
 
+            self.add_evaluator_stats(evaluator_stats_before, stringEvaluator.stats())
+
+            if self.incremental_cache is not None:
+                for function_name, line_numbers in function_call_sites.items():
+                    for lineno in line_numbers:
+                        if 0 <= lineno < len(self.lines):
+                            self.dependency_graph.add_function_call(function_name, self.lines[lineno].locations[0])
+
+                self.incremental_cache.end_compilation(self)
+
+            if self.compile_cache is not None:
+                t = time.perf_counter()
+                self.store_in_compile_cache(cache_key)
+                self.phase_timings.append(('storing in compile cache', time.perf_counter() - t))
+
+            self.add_compiled_date()
+
             return True
 
         except ksp_ast.ParseException as e:
@@ -2577,6 +3798,76 @@ class KSPCompiler(object):
             print("Exception encountered...")
             raise e
 
+    def compiler_options(self):
+        return OrderedDict((name, getattr(self, name)) for name in self.option_names)
+
+    def compile_cache_key(self):
+        '''Key of the compile cache entry for this compilation, made of everything that is known before compiling'''
+        return CompileCache.make_key(compiler_fingerprint(), self.basedir, list(self.compiler_options().items()), self.source)
+
+    @staticmethod
+    def dependency_fingerprint(kind, path):
+        '''Fingerprint of an input of the compilation as recorded in compile cache entries, or None if it cannot be read'''
+        try:
+            if kind == 'source':
+                return DependencyGraph.digest(read_source_file(path))
+            elif kind == 'folder':
+                return list_ksp_files(path) if os.path.isdir(path) else None
+            else:
+                with open(path, 'rb') as f:
+                    return hashlib.sha1(f.read()).hexdigest()
+        except (IOError, OSError, UnicodeDecodeError):
+            return None
+
+    def store_in_compile_cache(self, key):
+        '''Stores the result of this compilation in the compile cache, unless it depends on something that cannot be checked'''
+        graph = self.dependency_graph
+
+        # read<< >> blocks can depend on anything (eg. the current time), and files imported from URLs are not checked
+        if graph.uses_python or any(path is not None and not os.path.isabs(path) for path in graph.file_digests):
+            self.stats['compile cache'] = 'not stored'
+            return
+
+        dependencies = [('source', path, digest) for (path, digest) in graph.file_digests.items() if path is not None]
+        dependencies += [('folder', path, self.dependency_fingerprint('folder', path)) for path in graph.folders]
+        data_files = set(graph.data_files)
+
+        if self.compact_variables and self.compaction_map_file:
+            data_files.add(os.path.abspath(self.compaction_map_file))
+
+        dependencies += [('file', path, self.dependency_fingerprint('file', path)) for path in data_files]
+
+        entry = CompileCacheEntry(self.compiled_code, list(self.output_files), self.short2original, self.compiler_options(), dependencies)
+        self.compile_cache.store(key, entry)
+
+        self.stats['compile cache'] = 'stored'
+        self.stats['compile fingerprint'] = entry.fingerprint(key)
+
+    def use_cached_result(self, entry, key):
+        '''Takes the result of an earlier compilation from a compile cache entry instead of compiling'''
+        for name, value in entry.effective_options.items():
+            setattr(self, name, value)
+
+        self.compiled_code = entry.compiled_code
+        self.output_files = list(entry.output_files)
+        self.short2original = entry.short2original
+        self.add_compiled_date()
+
+        self.stats['compile cache'] = 'hit'
+        self.stats['compile fingerprint'] = entry.fingerprint(key)
+
+    def add_evaluator_stats(self, before, after):
+        '''Adds the compile-time expression evaluations done during this compilation to the stats'''
+        hits, misses, literals = [after[key] - before[key] for key in ('hits', 'misses', 'literals')]
+        total = hits + misses + literals
+
+        self.stats['evaluated expressions'] = total
+        self.stats['expressions found in cache'] = hits
+        self.stats['integer literals (not parsed)'] = literals
+
+        if total:
+            self.stats['expression cache hit rate'] = '%.1f%%' % (100.0 * (hits + literals) / total)
+
     def abort_compilation(self):
         self.abort_requested = True
         utils.log_message('Compilation aborted!')
@@ -2633,7 +3924,13 @@ def main():
                             help = 'remove indents and empty lines in compiled code')
     arg_parser.add_argument('-v', '--compact_variables',
                             dest = 'compact_variables', action = 'store_true', default = False,
-                            help = 'shorten and obfuscate variable names in compiled code')
+                            help = 'shorten and obfuscate variable names in compiled code (a reverse map for decoding is written next to the output file)')
+    arg_parser.add_argument('--names_map',
+                            dest = 'names_map', action = 'store', default = None,
+                            help = 'keep the names chosen by --compact_variables in this file, so that they stay the same across builds (a reverse map for decoding is written next to it)')
+    arg_parser.add_argument('--shortest_names',
+                            dest = 'shortest_names', action = 'store_true', default = False,
+                            help = 'let --compact_variables give the shortest names to the most used variables (names can change between builds, use preserve_names for persistent variables)')
     arg_parser.add_argument('-d', '--combine_callbacks',
                             dest = 'combine_callbacks', action = 'store_true', default = False,
                             help = 'combines duplicate callbacks - but not functions or macros')
@@ -2643,6 +3940,15 @@ def main():
     arg_parser.add_argument('-o', '--optimize',
                             dest = 'optimize', action = 'store_true', default = False,
                             help = 'optimize the compiled code')
+    arg_parser.add_argument('--eliminate_common_subexpressions',
+                            dest = 'eliminate_common_subexpressions', action = 'store_true', default = False,
+                            help = 'with --optimize, compute repeated subexpressions only once and keep their values in temporary variables')
+    arg_parser.add_argument('--lower_select_statements',
+                            dest = 'lower_select_statements', action = 'store_true', default = False,
+                            help = 'with --optimize, turn select statements with many integer cases into array lookups or trees of if statements')
+    arg_parser.add_argument('--outline_threshold',
+                            dest = 'outline_threshold', action = 'store', type = int, default = 0, metavar = 'LINES',
+                            help = 'invoke functions without parameters using call instead of inlining them, if their inlined copies would take more than LINES lines and calling them makes the compiled code shorter')
     arg_parser.add_argument('-b', '--extra_branch_optimization',
                             dest = 'additional_branch_optimization', action = 'store_true', default = False,
                             help = 'adds branch optimization checks earlier in compile process, allowing define constant based branching etc.')
@@ -2652,12 +3958,39 @@ def main():
     arg_parser.add_argument('-t', '--add_compile_date',
                             dest = 'add_compile_date', action = 'store_true', default = False,
                             help = 'adds the date and time comment atop the compiled code')
+    arg_parser.add_argument('--ignore_compile_date',
+                            dest = 'ignore_compile_date', action = 'store_true', default = False,
+                            help = 'do not rewrite output files whose content only differs in the date and time comment added by --add_compile_date')
     arg_parser.add_argument('-x', '--sanitize_exit_command',
                             dest = 'sanitize_exit_command', action = 'store_true', default = False,
                             help = 'adds a dummy no-op command before every exit function call')
     arg_parser.add_argument('-l', '--log',
                             dest = 'write_log_on_fail', action = 'store_true', default = False,
                             help = 'dumps the compiler output to a log file on failed compilation')
+    arg_parser.add_argument('-n', '--incremental',
+                            dest = 'incremental', action = 'store_true', default = False,
+                            help = 'keep parsed files and expanded macros in a cache file, so that recompiling after small changes is faster')
+    arg_parser.add_argument('--cache_file',
+                            dest = 'cache_file', action = 'store', default = None,
+                            help = 'path of the cache file used by --incremental (by default next to the source file)')
+    arg_parser.add_argument('--no_compile_cache',
+                            dest = 'no_compile_cache', action = 'store_true', default = False,
+                            help = 'always compile, instead of reusing the stored result of an earlier compilation with exactly the same inputs')
+    arg_parser.add_argument('--compile_cache_dir',
+                            dest = 'compile_cache_dir', action = 'store', default = None,
+                            help = 'folder in which compilation results are stored for reuse (by default in the cache folder of the user)')
+    arg_parser.add_argument('--memoize_python_reads',
+                            dest = 'memoize_python_reads', action = 'store_true', default = False,
+                            help = 'reuse the results of read<< >> blocks as long as their code and the files they open are unchanged')
+    arg_parser.add_argument('-s', '--stats',
+                            dest = 'stats', action = 'store_true', default = False,
+                            help = 'print the time spent in each compilation phase and other compiler statistics')
+    arg_parser.add_argument('-w', '--watch',
+                            dest = 'watch', action = 'store_true', default = False,
+                            help = 'keep running and recompile whenever the source file or any imported file changes')
+    arg_parser.add_argument('--poll_interval',
+                            dest = 'poll_interval', action = 'store', type = float, default = 0.5,
+                            help = 'seconds between two checks for changed files in --watch mode')
     arg_parser.add_argument('source_file', type = FileType('r', encoding = 'latin-1'))
     arg_parser.add_argument('output_file', nargs = '?')
 
@@ -2676,9 +4009,33 @@ def main():
     # read the source and compile it
     code = args.source_file.read()
 
-    t1 = datetime.now()
+    incremental_cache = None
+
+    if args.incremental:
+        cache_file = args.cache_file
+
+        if not cache_file:
+            source_name = os.path.basename(args.source_file.name) if basepath else 'stdin'
+            cache_file = os.path.join(basepath or os.getcwd(), '.%s.kspcache' % source_name)
+
+        incremental_cache = IncrementalCache.load(cache_file)
+    elif args.watch:
+        # when watching, keep the results of the previous compilation in memory only
+        incremental_cache = IncrementalCache()
+
+    # the compile cache is only used for single compilations, --incremental and --watch keep their own state between compilations
+    compile_cache = None
+
+    if not (args.no_compile_cache or args.incremental or args.watch):
+        compile_cache = CompileCache(args.compile_cache_dir or CompileCache.default_path())
 
-    compiler = KSPCompiler(code,
+    read_cache = None
+
+    if args.memoize_python_reads:
+        read_cache = incremental_cache.python_read_cache if incremental_cache else PythonReadCache()
+
+    def create_compiler(code):
+        return KSPCompiler(code,
                            basepath,
                            compact                        = args.compact,
                            combine_callbacks              = args.combine_callbacks,
@@ -2690,46 +4047,130 @@ def main():
                            add_compiled_date_comment      = args.add_compile_date,
                            force_compiler_arguments       = args.force_compiler_arguments,
                            write_log_on_fail              = args.write_log_on_fail,
-                           compiled_code_tab_size         = args.num_spaces)
+                           compiled_code_tab_size         = args.num_spaces,
+                           incremental_cache              = incremental_cache,
+                           python_read_cache              = read_cache,
+                           compaction_map_file            = args.names_map,
+                           shortest_names                 = args.shortest_names,
+                           compile_cache                  = compile_cache,
+                           eliminate_common_subexpressions = args.eliminate_common_subexpressions,
+                           lower_select_statements        = args.lower_select_statements,
+                           outline_threshold              = args.outline_threshold)
 
-    compiler.compile(callback = utils.compile_on_progress)
+    def compile_and_save(compiler):
+        t1 = datetime.now()
 
-    # write the compiled code to output
-    code = compiler.compiled_code.replace('\r', '')
-    paths = []
-    out_is_dir = False
+        compiler.compile(callback = utils.compile_on_progress)
 
-    if args.output_file:
-        # we don't care about any paths from save_compiled_source pragmas in case we specified an output file argument
-        compiler.output_files.clear()
-        compiler.output_files.append(args.output_file)
+        if compiler.stats.get('compile cache') == 'hit':
+            utils.log_message('Nothing changed since an earlier compilation, reusing its result from the compile cache.')
 
-    for p in compiler.output_files:
-        path = p
+        if incremental_cache:
+            if incremental_cache.path:
+                incremental_cache.save()
 
-        if not os.path.isabs(path):
-            path = os.path.join(basepath, path)
+            changed = sorted(f or '<main script>' for f in incremental_cache.changed_files)
+            affected = sorted(f or '<main script>' for f in incremental_cache.affected_files - incremental_cache.changed_files)
 
-        if os.path.isdir(path):
-            out_is_dir = True
-        else:
-            with io.open(path, 'w', encoding = 'latin-1') as o:
-                o.write(code)
+            utils.log_message('Changed files: %s' % (', '.join(changed) or 'none'))
 
-            paths.append(path)
+            if affected:
+                utils.log_message('Files affected through imports: %s' % ', '.join(affected))
 
-    delta = utils.calc_time_diff(datetime.now() - t1)
+            utils.log_message('Reused %d parsed files and %d macro expansions. Time spent per phase:' %
+                              (incremental_cache.import_cache.hits, incremental_cache.expansion_cache.hits))
 
-    if len(paths) > 0 and out_is_dir == False:
-        utils.log_message("Successfully compiled in %s! Compiled code was saved to:" % delta)
+            for line in format_phase_timings(compiler.phase_timings, incremental_cache.full_phase_timings):
+                utils.log_message(line)
+        elif args.stats:
+            utils.log_message('Time spent per phase:')
 
-        for p in paths:
-            utils.log_message("    %s" % p)
-    else:
-        if out_is_dir:
-            utils.log_message("The output path for the compiled code cannot be a folder, however compilation ended successfully in %s!" % delta)
+            for line in format_phase_timings(compiler.phase_timings):
+                utils.log_message(line)
+
+        if args.stats:
+            utils.log_message('Compiler statistics:')
+
+            for name, value in compiler.stats.items():
+                utils.log_message('    %-34s %8s' % (name, value))
+
+        # write the compiled code to output
+        code = compiler.compiled_code.replace('\r', '')
+        paths = []
+        out_is_dir = False
+
+        if args.output_file:
+            # we don't care about any paths from save_compiled_source pragmas in case we specified an output file argument
+            compiler.output_files.clear()
+            compiler.output_files.append(args.output_file)
+
+        for p in compiler.output_files:
+            path = p
+
+            if not os.path.isabs(path):
+                path = os.path.join(basepath, path)
+
+            if os.path.isdir(path):
+                out_is_dir = True
+            else:
+                paths.append(path)
+
+        results = write_compiled_code(paths, code, ignore_date_header = args.ignore_compile_date, short2original = compiler.short2original)
+        delta = utils.calc_time_diff(datetime.now() - t1)
+
+        if len(paths) > 0 and out_is_dir == False:
+            utils.log_message("Successfully compiled in %s! Compiled code was saved to:" % delta)
+
+            for p, changed in results:
+                utils.log_message("    %s%s" % (p, '' if changed else ' (unchanged, not rewritten)'))
         else:
-            utils.log_message("The output file for the compiled code was not defined, however compilation ended successfully in %s!" % delta)
+            if out_is_dir:
+                utils.log_message("The output path for the compiled code cannot be a folder, however compilation ended successfully in %s!" % delta)
+            else:
+                utils.log_message("The output file for the compiled code was not defined, however compilation ended successfully in %s!" % delta)
+
+    if not args.watch:
+        compile_and_save(create_compiler(code))
+        return
+
+    # watch mode: recompile whenever the source file or any of the files it imports changes
+    from file_watcher import FileWatcher
+
+    if not basepath:
+        arg_parser.error('--watch needs a source file, it cannot be used when reading the source from stdin')
+
+    source_path = os.path.abspath(args.source_file.name)
+    args.source_file.close()
+
+    watcher = FileWatcher(poll_interval = args.poll_interval)
+    watched_files = set()
+    watched_folders = set()
+
+    try:
+        while True:
+            compiler = create_compiler(code)
+
+            try:
+                compile_and_save(compiler)
+            except Exception as e:
+                utils.log_message('Error - compilation aborted!\n\n%s\n' % (e.message if isinstance(e, ParseException) else e))
+
+            # keep watching the files of earlier compilations too, so that fixing a broken import triggers a recompile
+            if compiler.dependency_graph:
+                watched_files.update(f for f in compiler.dependency_graph.files() if f and os.path.isabs(f))
+                watched_folders.update(compiler.dependency_graph.folders)
+
+            watched_files.add(source_path)
+            watcher.watch(watched_files, watched_folders)
+            utils.log_message('Watching %d files and %d folders for changes (press Ctrl+C to stop)...' % (len(watched_files), len(watched_folders)))
+
+            changed = watcher.wait_for_change()
+            utils.log_message('Changed: %s' % ', '.join(changed))
+
+            with io.open(source_path, 'r', encoding = 'latin-1') as f:
+                code = f.read()
+    except KeyboardInterrupt:
+        utils.log_message('Stopped watching.')
 
 if __name__ == "__main__":
     main()
@@ -15,6 +15,7 @@
 from ksp_ast import *
 from ksp_ast_processing import ASTVisitor, ASTModifier, flatten
 import ksp_builtins
+from call_graph import CallGraph
 import re
 import math
 
@@ -534,10 +535,11 @@ class ASTVisitorFindUsedFunctions(ASTVisitor):
 
     def __init__(self, ast, used_functions):
         ASTVisitor.__init__(self, visit_expressions = False)
-        self.call_graph = {}
+        self.call_graph = CallGraph()
         self.traverse(ast)
 
-        self.mark_used_functions_using_depth_first_traversal(self.call_graph, visited = used_functions)
+        # None represents the source of a normal callback (a callback invoking a function as opposed to a function invoking a function)
+        used_functions.update(self.call_graph.reachable(self.call_graph.successors(None)))
 
     def visitFunctionDef(self, parent, node):
         self.visit_children(parent, node, node.name.identifier)
@@ -550,39 +552,11 @@ class ASTVisitorFindUsedFunctions(ASTVisitor):
         return False
 
     def visitFunctionCall(self, parent, node, top_level):
-        target = node.function_name.identifier
-
         if node.using_call_keyword:
-            source = top_level
-
-            if not source in self.call_graph:
-                self.call_graph[source] = []
-
-            if not target in self.call_graph:
-                self.call_graph[target] = []
-
-            self.call_graph[source].append(target)
+            self.call_graph.add_edge(top_level, node.function_name.identifier)
 
         return False
 
-    def mark_used_functions_using_depth_first_traversal(self, call_graph, start_node = None, visited = None):
-        ''' Make a depth-first traversal of call graph and set the used attribute of functions invoked directly or indirectly from some callback.
-            The graph is represented by a dictionary where graph[f1] == f1 means that the function with name f1 calls the function with name f2 (the names are strings).'''
-        if visited is None:
-            visited = set()
-
-        nodes_to_visit = set()
-
-        if start_node is None:
-            nodes_to_visit = set(call_graph.get(None, []))  # None represents the source of a normal callback (a callback invoking a function as opposed to a function invoking a function)
-        else:
-            if start_node not in visited:
-                visited.add(start_node)
-                nodes_to_visit = set([x for x in call_graph[start_node] if x is not None])
-
-        for n in nodes_to_visit:
-            self.mark_used_functions_using_depth_first_traversal(call_graph, n, visited)
-
 class ASTVisitorCheckDeclarations(ASTVisitor):
     def __init__(self, ast):
         ASTVisitor.__init__(self)
@@ -816,9 +790,9 @@ class ASTModifierSimplifyExpressions(ASTModifier):
 
                 pass
             else:
-                condition = self.modify(condition, *args, **kwargs)
+                condition = yield (condition, args, kwargs)
 
-            stmts = flatten([self.modify(s, *args, **kwargs) for s in stmts])
+            stmts = flatten((yield from self._modify_list(stmts, args, kwargs)))
             temp.append((condition, stmts))
 
         if not temp:
@@ -839,7 +813,7 @@ class ASTModifierRemoveUnusedBranches(ASTModifier):
         return isinstance(node, BinOp) and isinstance(node.left, Integer) and isinstance(node.right, Integer) and node.left.value == 1 and node.right.value == 1
 
     def modifyIfStmt(self, node):
-        statements = ASTModifier.modifyIfStmt(self, node)
+        statements = yield from self._modifyIfStmt(node)
 
         if len(statements) == 1:
             node = statements[0]
@@ -877,10 +851,10 @@ class ASTModifierRemoveUnusedBranches(ASTModifier):
 
                 return [node]
         else:
-            return flatten([self.modify(stmt) for stmt in statements])
+            return flatten((yield from self._modify_list(statements, (), {})))
 
     def modifySelectStmt(self, node):
-        statements = ASTModifier.modifySelectStmt(self, node)
+        statements = yield from self._modifySelectStmt(node)
 
         if len(statements) == 1:
             node = statements[0]
@@ -905,10 +879,10 @@ class ASTModifierRemoveUnusedBranches(ASTModifier):
 
             return [node]
         else:
-            return flatten([self.modify(stmt) for stmt in statements])
+            return flatten((yield from self._modify_list(statements, (), {})))
 
     def modifyWhileStmt(self, node):
-        statements = ASTModifier.modifyWhileStmt(self, node)
+        statements = yield from self._modifyWhileStmt(node)
 
         if len(statements) == 1:
             node = statements[0]
@@ -922,7 +896,7 @@ class ASTModifierRemoveUnusedBranches(ASTModifier):
                 pass
             return [node]
         else:
-            return flatten([self.modify(stmt) for stmt in statements])
+            return flatten((yield from self._modify_list(statements, (), {})))
 
 class ASTModifierRemoveUnusedFunctions(ASTModifier):
     '''Remove unused functions. Used if optimize mode is selected'''
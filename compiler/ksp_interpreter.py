@@ -0,0 +1,647 @@
+# ksp-compiler - a compiler for the Kontakt script language
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''Reference interpreter for the native KSP that the compiler emits (the final AST, after all compiler passes).
+
+   It runs the init callback and any other callback on synthetic events, with stubs in place of the engine builtins,
+   and counts what it does: executed statements, builtin calls and the cost of every operation according to a
+   configurable cost model. The numbers are not Kontakt's real timings, but they tell whether a compiler change makes
+   the compiled code do more or less work, which is what optimizer benchmarks and regression tests need.'''
+
+import collections
+import math
+
+import ksp_builtins
+from ksp_ast import *
+
+
+class KSPRuntimeError(Exception):
+    def __init__(self, node, msg):
+        Exception.__init__(self, '%s (line %s)' % (msg, node.lineno if node is not None and node.lexinfo else '?'))
+        self.node = node
+
+
+class ExitCallback(Exception):
+    '''Raised by the exit() builtin to leave the running callback'''
+    pass
+
+
+class CostModel(object):
+    '''Cost of each kind of operation. Costs not mentioned in costs keep their default, builtin_costs gives
+       the cost of calling specific builtin functions (other builtins cost costs['builtin call']).'''
+
+    default_costs = {
+        'statement':         1,    # every executed statement, on top of the costs of what it does
+        'assignment':        1,
+        'declaration':       1,
+        'variable read':     1,
+        'array access':      2,    # reading or writing an array element (instead of 'variable read')
+        'constant':          0,    # literals
+        'arithmetic':        1,    # + - * / mod and the bitwise operators
+        'comparison':        1,
+        'logic':             1,    # and, or, xor, not
+        'string operation':  3,    # &
+        'branch':            1,    # every condition tested by an if, every case tested by a select
+        'loop iteration':    1,
+        'call':              5,    # 'call' of a user function
+        'builtin call':      10,
+    }
+
+    default_builtin_costs = {
+        'inc': 1,
+        'dec': 1,
+        'abs': 1,
+        'sh_left': 1,
+        'sh_right': 1,
+        'in_range': 2,
+        'int_to_real': 1,
+        'real_to_int': 1,
+        'int': 1,
+        'real': 1,
+        'get_ui_id': 2,
+    }
+
+    def __init__(self, costs = None, builtin_costs = None):
+        self.costs = dict(self.default_costs)
+        self.costs.update(costs or {})
+        self.builtin_costs = dict(self.default_builtin_costs)
+        self.builtin_costs.update(builtin_costs or {})
+
+    def builtin_cost(self, name):
+        return self.builtin_costs.get(name, self.costs['builtin call'])
+
+
+class Event(object):
+    '''A synthetic event: the values of the builtin variables seen by the callback it triggers,
+       eg. Event({'$EVENT_NOTE': 60, '$EVENT_VELOCITY': 100})'''
+
+    def __init__(self, values = None, arrays = None):
+        self.values = dict(values or {})
+        self.arrays = dict(arrays or {})   # eg. {'%CC': {1: 64}}
+
+    @classmethod
+    def note(cls, note, velocity = 100, event_id = 1):
+        return cls({'$EVENT_NOTE': note, '$EVENT_VELOCITY': velocity, '$EVENT_ID': event_id})
+
+    @classmethod
+    def controller(cls, number, value):
+        return cls({'$CC_NUM': number}, {'%CC': {number: value}})
+
+
+def _div(a, b):
+    if b == 0:
+        return 0
+
+    if type(a) is int and type(b) is int:
+        # division with truncation (a // b rounds towards minus infinity)
+        return toint(int(math.copysign(abs(a) // abs(b), a * b)))
+
+    return a / b
+
+def _mod(a, b):
+    if b == 0:
+        return 0
+
+    if type(a) is int:
+        result = abs(a) % abs(b)
+        return -result if a < 0 else result
+
+    return math.fmod(a, b)
+
+def _number(a):
+    return toint(a) if type(a) is int else a
+
+arithmetic_operators = {
+    '+':     lambda a, b: _number(a + b),
+    '-':     lambda a, b: _number(a - b),
+    '*':     lambda a, b: _number(a * b),
+    '/':     _div,
+    'mod':   _mod,
+    '.and.': lambda a, b: a & b,
+    '.or.':  lambda a, b: a | b,
+    '.xor.': lambda a, b: toint(a ^ b),
+}
+
+comparison_operators = {
+    '=':  lambda a, b: a == b,
+    '#':  lambda a, b: a != b,
+    '<':  lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>':  lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+logic_operators = {
+    'and': lambda a, b: bool(a) and bool(b),
+    'or':  lambda a, b: bool(a) or bool(b),
+    'xor': lambda a, b: bool(a) != bool(b),
+}
+
+
+class KSPInterpreter(object):
+    '''Executes a native KSP module.
+
+       builtins maps builtin function names to Python functions taking the interpreter and the parameter nodes of the
+       call, and replaces or extends the stubs of default_builtins. Builtins without a stub do nothing and return 0.
+       Execution stops with a KSPRuntimeError after max_statements statements and loop iterations, so that an endless
+       loop cannot hang a test.'''
+
+    def __init__(self, module, cost_model = None, builtins = None, max_statements = 10000000):
+        self.module = module
+        self.cost_model = cost_model or CostModel()
+        self.costs = self.cost_model.costs
+        self.builtins = dict(default_builtins)
+        self.builtins.update(builtins or {})
+        self.max_statements = max_statements
+
+        self.callbacks = {}
+        self.functions = {}
+
+        for block in module.blocks:
+            if isinstance(block, FunctionDef):
+                self.functions[block.name.identifier] = block
+            elif isinstance(block, Callback):
+                variable = str(block.variable) if block.variable else None
+                self.callbacks.setdefault((block.name, variable), block)
+
+        self.reset_counters()
+        self.reset_state()
+
+    def reset_state(self):
+        self.variables = {}          # name (with prefix) -> value, or list of values for arrays
+        self.control_pars = {}       # (ui id, control parameter) -> value
+        self.ui_ids = {}             # name of UI control -> ui id
+        self.pgs_keys = {}           # key name -> list of values
+        self.messages = []
+        self.event = Event()
+        self.next_event_id = 1000
+        self.random_state = 1
+
+    def reset_counters(self):
+        self.executed_statements = 0
+        self.steps = 0                                # executed statements and loop iterations, for max_statements
+        self.statements = collections.Counter()       # statement class name -> count
+        self.operations = collections.Counter()       # cost model key -> count
+        self.builtin_calls = collections.Counter()    # builtin name -> count
+        self.function_calls = collections.Counter()   # user function name -> count
+        self.cost = 0
+        self.runtime_errors = []
+
+    def report(self):
+        '''Returns the counters as an ordered dictionary'''
+        return collections.OrderedDict([
+            ('executed statements', self.executed_statements),
+            ('builtin calls', sum(self.builtin_calls.values())),
+            ('function calls', sum(self.function_calls.values())),
+            ('cost', self.cost),
+            ('statements by type', dict(self.statements)),
+            ('calls by builtin', dict(self.builtin_calls)),
+            ('operations', dict(self.operations)),
+        ])
+
+    def count(self, kind, n = 1):
+        self.operations[kind] += n
+        self.cost += self.costs[kind] * n
+
+    def error(self, node, msg):
+        '''Records a problem Kontakt would only report at run time (and then carry on)'''
+        self.runtime_errors.append('%s (line %s)' % (msg, node.lineno if node.lexinfo else '?'))
+
+    # ---------------------------------------------------------------- running callbacks
+
+    def has_callback(self, name, variable = None):
+        return (name, variable) in self.callbacks
+
+    def run_init(self):
+        return self.run_callback('init')
+
+    def run_callback(self, name, variable = None, event = None):
+        '''Runs a callback, eg. run_callback('note', event = Event.note(60)) or run_callback('ui_control', '$knob').
+           Returns False if the module has no such callback.'''
+        callback = self.callbacks.get((name, variable))
+
+        if callback is None:
+            return False
+
+        self.event = event or Event()
+
+        try:
+            self.execute_block(callback.lines)
+        except ExitCallback:
+            pass
+
+        return True
+
+    def run_note(self, note, velocity = 100):
+        '''Runs the note callback and then the release callback for a new note event'''
+        self.next_event_id += 1
+        event = Event.note(note, velocity, self.next_event_id)
+        self.run_callback('note', event = event)
+        self.run_callback('release', event = event)
+
+    # ---------------------------------------------------------------- statements
+
+    def execute_block(self, lines):
+        for stmt in lines:
+            self.execute(stmt)
+
+    def step(self, node):
+        self.steps += 1
+
+        if self.steps > self.max_statements:
+            raise KSPRuntimeError(node, 'Statement limit of %d exceeded' % self.max_statements)
+
+    def execute(self, stmt):
+        self.executed_statements += 1
+        self.step(stmt)
+
+        self.statements[stmt.__class__.__name__] += 1
+        self.count('statement')
+
+        t = type(stmt)
+
+        if t is AssignStmt:
+            self.assign(stmt.varref, self.evaluate(stmt.expression))
+        elif t is FunctionCall:
+            self.call(stmt)
+        elif t is IfStmt:
+            for (condition, stmts) in stmt.condition_stmts_tuples:
+                if condition is None:
+                    self.execute_block(stmts)
+                    break
+
+                self.count('branch')
+
+                if self.evaluate(condition):
+                    self.execute_block(stmts)
+                    break
+        elif t is SelectStmt:
+            value = self.evaluate(stmt.expression)
+
+            for ((start, stop), stmts) in stmt.range_stmts_tuples:
+                self.count('branch')
+
+                if stop is None:
+                    matches = value == self.evaluate(start)
+                else:
+                    matches = self.evaluate(start) <= value <= self.evaluate(stop)
+
+                if matches:
+                    self.execute_block(stmts)
+                    break
+        elif t is WhileStmt:
+            while self.evaluate(stmt.condition):
+                self.step(stmt)
+                self.count('loop iteration')
+                self.execute_block(stmt.statements)
+        elif t is DeclareStmt:
+            self.declare(stmt)
+        else:
+            raise KSPRuntimeError(stmt, 'Cannot execute %s, it is not part of native KSP' % stmt.__class__.__name__)
+
+    def declare(self, stmt):
+        self.count('declaration')
+
+        name = str(stmt.variable)
+        prefix = stmt.variable.prefix
+        default = '' if prefix in '@!' else 0.0 if prefix in '~?' else 0
+
+        if stmt.isUIDeclaration():
+            self.ui_ids[name] = len(self.ui_ids) + 1
+
+        if stmt.size is not None:
+            size = self.evaluate(stmt.size)
+            value = [default] * size
+
+            if isinstance(stmt.initial_value, RawArrayInitializer):
+                initial_values = [self.parse_raw_value(v, default) for v in stmt.initial_value.raw_text.split(',')]
+            elif type(stmt.initial_value) is list:
+                initial_values = [self.evaluate(v) for v in stmt.initial_value]
+            elif stmt.initial_value is not None:
+                initial_values = [self.evaluate(stmt.initial_value)]
+            else:
+                initial_values = []
+
+            value[:len(initial_values)] = initial_values[:size]
+        elif stmt.initial_value is not None:
+            value = self.evaluate(stmt.initial_value)
+        else:
+            value = default
+
+        self.variables[name] = value
+
+    @staticmethod
+    def parse_raw_value(text, default):
+        text = text.strip()
+
+        try:
+            return type(default)(text.strip('"')) if type(default) is str else int(text) if type(default) is int else float(text)
+        except ValueError:
+            return default
+
+    def call(self, stmt):
+        name = stmt.function_name.identifier
+
+        if name in self.functions:
+            self.count('call')
+            self.function_calls[name] += 1
+            self.execute_block(self.functions[name].lines)
+            return 0
+
+        return self.call_builtin(stmt, name)
+
+    def call_builtin(self, node, name):
+        if name not in ksp_builtins.functions and name not in self.builtins:
+            raise KSPRuntimeError(node, 'Unknown function: %s' % name)
+
+        self.builtin_calls[name] += 1
+        self.operations['builtin call'] += 1
+        self.cost += self.cost_model.builtin_cost(name)
+
+        stub = self.builtins.get(name)
+
+        if stub is None:
+            for p in node.parameters:
+                self.evaluate(p)
+
+            return 0
+
+        return stub(self, node.parameters)
+
+    # ---------------------------------------------------------------- variables
+
+    def array_and_index(self, varref):
+        name = str(varref.identifier)
+
+        if name in self.variables:
+            array = self.variables[name]
+        elif name in ksp_builtins.variables:
+            array = self.event.arrays.setdefault(name, {})
+        else:
+            raise KSPRuntimeError(varref, 'Variable not declared: %s' % name)
+
+        index = self.evaluate(varref.subscripts[0])
+
+        if type(array) is list and not 0 <= index < len(array):
+            self.error(varref, 'Array index out of bounds: %s[%d]' % (name, index))
+            return None, index
+
+        return array, index
+
+    def read(self, varref):
+        if varref.subscripts:
+            self.count('array access')
+            array, index = self.array_and_index(varref)
+
+            if array is None:
+                return 0
+            elif type(array) is dict:
+                return array.get(index, 0)
+            else:
+                return array[index]
+
+        self.count('variable read')
+        name = str(varref.identifier)
+        value = self.variables.get(name)
+
+        if value is not None:
+            return value
+        elif name in ksp_builtins.variables:
+            return self.event.values.get(name, 0)
+        elif name in ksp_builtins.constants:
+            return builtin_constant_value(name)
+        elif not varref.identifier.prefix:
+            return name   # the compiler adds prefixes to all variables, so this is a key name, eg. of pgs_set_key_val
+        else:
+            raise KSPRuntimeError(varref, 'Variable not declared: %s' % name)
+
+    def assign(self, varref, value):
+        self.count('assignment')
+
+        if varref.subscripts:
+            self.count('array access')
+            array, index = self.array_and_index(varref)
+
+            if array is not None:
+                array[index] = value
+        else:
+            name = str(varref.identifier)
+
+            if name in self.variables:
+                self.variables[name] = value
+            elif name in ksp_builtins.variables:
+                self.event.values[name] = value
+            else:
+                raise KSPRuntimeError(varref, 'Variable not declared: %s' % name)
+
+    # ---------------------------------------------------------------- expressions
+
+    def evaluate(self, expr):
+        t = type(expr)
+
+        if t is VarRef:
+            return self.read(expr)
+        elif t is BinOp:
+            op = expr.op
+            a = self.evaluate(expr.left)
+            b = self.evaluate(expr.right)   # KSP doesn't short-circuit 'and' and 'or'
+
+            if op in comparison_operators:
+                self.count('comparison')
+                return comparison_operators[op](a, b)
+            elif op in arithmetic_operators:
+                self.count('arithmetic')
+                return arithmetic_operators[op](a, b)
+            elif op in logic_operators:
+                self.count('logic')
+                return logic_operators[op](a, b)
+            elif op == '&':
+                self.count('string operation')
+                return to_string(a) + to_string(b)
+        elif t is Integer or t is Boolean:
+            self.count('constant')
+            return expr.value
+        elif t is Real:
+            self.count('constant')
+            return float(expr.value)
+        elif t is String:
+            self.count('constant')
+            return expr.value[1:-1]
+        elif t is UnaryOp:
+            a = self.evaluate(expr.right)
+
+            if expr.op == '-':
+                self.count('arithmetic')
+                return _number(-a)
+            elif expr.op == '.not.':
+                self.count('arithmetic')
+                return toint(~a)
+            elif expr.op == 'not':
+                self.count('logic')
+                return not a
+        elif t is FunctionCall:
+            return self.call(expr)
+        elif t is ID:
+            return self.read(VarRef(expr.lexinfo, expr))
+
+        raise KSPRuntimeError(expr, 'Cannot evaluate %s' % expr.__class__.__name__)
+
+
+def to_string(value):
+    if type(value) is float:
+        return '%.5f' % value
+
+    return str(value)
+
+_builtin_constant_values = {}
+
+def builtin_constant_value(name):
+    '''Returns a distinct, stable integer for every builtin constant'''
+    if not _builtin_constant_values:
+        for i, constant in enumerate(sorted(ksp_builtins.constants)):
+            _builtin_constant_values[constant] = i + 1
+
+    return _builtin_constant_values.get(name, 0)
+
+
+# ---------------------------------------------------------------- builtin stubs
+
+def _values(interpreter, parameters):
+    return [interpreter.evaluate(p) for p in parameters]
+
+def _inc_by(step):
+    def func(interpreter, parameters):
+        varref = parameters[0]
+        interpreter.assign(varref, toint(interpreter.evaluate(varref) + step))
+        return 0
+
+    return func
+
+def _message(interpreter, parameters):
+    interpreter.messages.append(' '.join(to_string(v) for v in _values(interpreter, parameters)))
+    return 0
+
+def _exit(interpreter, parameters):
+    raise ExitCallback()
+
+def _play_note(interpreter, parameters):
+    _values(interpreter, parameters)
+    interpreter.next_event_id += 1
+    return interpreter.next_event_id
+
+def _random(interpreter, parameters):
+    low, high = _values(interpreter, parameters)
+    # a fixed linear congruential generator, so that runs are repeatable
+    interpreter.random_state = (interpreter.random_state * 1103515245 + 12345) & 0x7FFFFFFF
+    return low + interpreter.random_state % (high - low + 1) if high >= low else low
+
+def _num_elements(interpreter, parameters):
+    value = interpreter.variables.get(str(parameters[0].identifier))
+    return len(value) if type(value) is list else 0
+
+def _get_ui_id(interpreter, parameters):
+    return interpreter.ui_ids.get(str(parameters[0].identifier), 0)
+
+def _set_control_par(interpreter, parameters):
+    ui_id, par, value = _values(interpreter, parameters)[:3]
+    interpreter.control_pars[(ui_id, par)] = value
+    return 0
+
+def _get_control_par(interpreter, parameters):
+    ui_id, par = _values(interpreter, parameters)[:2]
+    return interpreter.control_pars.get((ui_id, par), 0)
+
+def _get_control_par_str(interpreter, parameters):
+    ui_id, par = _values(interpreter, parameters)[:2]
+    return interpreter.control_pars.get((ui_id, par), '')
+
+def _search(interpreter, parameters):
+    array = interpreter.variables.get(str(parameters[0].identifier), [])
+    value = interpreter.evaluate(parameters[1])
+    return array.index(value) if value in array else -1
+
+def _array_equal(interpreter, parameters):
+    return interpreter.variables.get(str(parameters[0].identifier)) == interpreter.variables.get(str(parameters[1].identifier))
+
+def _sort(interpreter, parameters):
+    array = interpreter.variables.get(str(parameters[0].identifier), [])
+    array.sort(reverse = bool(interpreter.evaluate(parameters[1])))
+    return 0
+
+def _pgs_create_key(interpreter, parameters):
+    key, size = _values(interpreter, parameters)
+    interpreter.pgs_keys[key] = [0] * size
+    return 0
+
+def _pgs_key_exists(interpreter, parameters):
+    return int(_values(interpreter, parameters)[0] in interpreter.pgs_keys)
+
+def _pgs_set_key_val(interpreter, parameters):
+    key, index, value = _values(interpreter, parameters)
+    values = interpreter.pgs_keys.get(key)
+
+    if values is not None and 0 <= index < len(values):
+        values[index] = value
+
+    return 0
+
+def _pgs_get_key_val(interpreter, parameters):
+    key, index = _values(interpreter, parameters)
+    values = interpreter.pgs_keys.get(key)
+
+    return values[index] if values is not None and 0 <= index < len(values) else 0
+
+def _function(func):
+    return lambda interpreter, parameters: func(*_values(interpreter, parameters))
+
+default_builtins = {
+    'inc':                  _inc_by(1),
+    'dec':                  _inc_by(-1),
+    'message':              _message,
+    'exit':                 _exit,
+    'play_note':            _play_note,
+    'random':               _random,
+    'num_elements':         _num_elements,
+    'get_ui_id':            _get_ui_id,
+    'set_control_par':      _set_control_par,
+    'set_control_par_str':  _set_control_par,
+    'get_control_par':      _get_control_par,
+    'get_control_par_str':  _get_control_par_str,
+    'search':               _search,
+    'array_equal':          _array_equal,
+    'sort':                 _sort,
+    'pgs_create_key':       _pgs_create_key,
+    'pgs_key_exists':       _pgs_key_exists,
+    'pgs_set_key_val':      _pgs_set_key_val,
+    'pgs_get_key_val':      _pgs_get_key_val,
+    'abs':                  _function(abs),
+    'in_range':             _function(lambda x, low, high: low <= x <= high),
+    'sh_left':              _function(lambda x, n: toint(x << (n % 32))),
+    'sh_right':             _function(lambda x, n: toint(x >> (n % 32))),
+    'int_to_real':          _function(float),
+    'real':                 _function(float),
+    'real_to_int':          _function(lambda x: toint(int(x))),
+    'int':                  _function(lambda x: toint(int(x))),
+}
+
+
+def run_script(module, events = (), cost_model = None, builtins = None):
+    '''Runs the init callback of module followed by the given events, which are (callback name, control variable,
+       Event) tuples, and returns the interpreter'''
+    interpreter = KSPInterpreter(module, cost_model = cost_model, builtins = builtins)
+    interpreter.run_init()
+
+    for (name, variable, event) in events:
+        interpreter.run_callback(name, variable, event)
+
+    return interpreter
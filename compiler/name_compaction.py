@@ -0,0 +1,158 @@
+# ksp-compiler - a compiler for the Kontakt script language
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''Mapping between variable names and the short names they are replaced with by the compact_variables option.
+
+   The mapping can be saved to a file per project, so that every name keeps its short name across builds.
+   Next to it a reverse map file (short name -> original name) is written, which is all that is needed
+   to decode compiled code again. A reverse map is also written next to every compiled code file.'''
+
+import hashlib
+import itertools
+import json
+import os
+
+
+def compress_variable_name(name, attempt = 0):
+    '''Returns a 5 character hash of name. Later attempts hash the name together with the attempt number,
+       which gives a different but equally deterministic candidate in case of a collision.'''
+    symbols = 'abcdefghijklmnopqrstuvwxyz012345'
+    hash = hashlib.new('sha1')
+    hash.update((name if attempt == 0 else '%s#%d' % (name, attempt)).encode('utf-8'))
+
+    return ''.join((symbols[ch & 0x1F] for ch in hash.digest()[:5]))
+
+
+def reverse_map_path(path):
+    '''Returns the path of the reverse map file that belongs to the compaction map file at path'''
+    return os.path.splitext(path)[0] + '.reverse.json'
+
+
+def output_reverse_map_path(path):
+    '''Returns the path of the reverse map file written next to the compiled code file at path, which lets the compiled
+       code be decoded without the script it was compiled from'''
+    (folder, name) = os.path.split(path)
+    return os.path.join(folder, '.%s.kspnames.reverse.json' % name)
+
+
+def write_json(path, data):
+    '''Writes data to a temporary file first and then renames it, so that readers never see a partially written file'''
+    temp_path = path + '.tmp'
+
+    with open(temp_path, 'w', encoding = 'utf-8') as f:
+        json.dump(data, f, indent = 0, sort_keys = True)
+
+    os.replace(temp_path, path)
+
+
+def save_reverse_map(path, short2original):
+    '''Writes the reverse map file (short name -> original name) used to decode compiled code'''
+    write_json(path, {'version': NameCompactionMap.format_version, 'names': short2original})
+
+
+def load_reverse_map(path):
+    '''Loads a reverse map file and returns it as a dictionary from short name to original name (empty if there is none)'''
+    try:
+        with open(path, 'r', encoding = 'utf-8') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    return data.get('names', {}) if isinstance(data, dict) else {}
+
+
+class NameCompactionMap(object):
+    '''Maps (prefixed) variable names to short names consisting of the prefix followed by a hash of the name.
+
+       Names that are already in the map keep their short name. A new name gets the hash of its own name, unless that
+       is a builtin or already taken by another name, in which case the next attempt of compress_variable_name is used,
+       and so on. New names are added in sorted order, so the result only depends on the names and not on the order
+       in which the compiler encounters them.'''
+
+    format_version = 1
+
+    def __init__(self, path = None):
+        self.path = path
+        self.original2short = {}
+        self.short2original = {}
+        self.added = 0                  # number of names that got a new short name since the map was loaded
+        self.collisions = 0             # number of times a candidate short name was already taken
+
+    @classmethod
+    def load(cls, path):
+        '''Loads the map saved at path. An empty map is returned if there is none or the file cannot be read'''
+        names_map = cls(path)
+
+        try:
+            with open(path, 'r', encoding = 'utf-8') as f:
+                data = json.load(f)
+
+            if data.get('version') == cls.format_version:
+                for original, short in data['names'].items():
+                    names_map.original2short[original] = short
+                    names_map.short2original[short] = original
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            pass
+
+        return names_map
+
+    def save(self, path = None):
+        '''Saves the map, together with its reverse map file'''
+        path = path or self.path
+
+        write_json(path, {'version': self.format_version, 'names': self.original2short})
+        save_reverse_map(reverse_map_path(path), self.short2original)
+
+    def add_names(self, names, reserved = ()):
+        '''Makes sure that every name in names has a short name. Short names in reserved (eg. builtins) are never used.'''
+        for name in sorted(set(names) - set(self.original2short)):
+            attempt = 0
+
+            while True:
+                short = '%s%s' % (name[0], compress_variable_name(name, attempt))
+
+                if short not in reserved and short not in self.short2original:
+                    break
+
+                self.collisions += 1
+                attempt += 1
+
+            self.original2short[name] = short
+            self.short2original[short] = name
+            self.added += 1
+
+    def __len__(self):
+        return len(self.original2short)
+
+
+def shortest_names(reserved = ()):
+    '''Yields all legal names (without prefix) from short to long, ie. a, b, ..., z, aa, ab, ..., skipping the reserved ones'''
+    first_symbols = 'abcdefghijklmnopqrstuvwxyz'
+    symbols = first_symbols + '0123456789_'
+
+    for length in itertools.count(1):
+        for first in first_symbols:
+            for rest in itertools.product(symbols, repeat = length - 1):
+                name = first + ''.join(rest)
+
+                if name not in reserved:
+                    yield name
+
+
+def rank_names_by_frequency(counts, reserved = ()):
+    '''Maps every (prefixed) name in counts, a dictionary from name to number of occurrences, to its prefix followed by
+       a short name. The most frequent names get the shortest names, ties are broken by name. The short names are unique
+       even without their prefix, and never one of the reserved names (which are given without prefix as well).'''
+    names = shortest_names(reserved)
+
+    return dict((name, name[0] + next(names)) for name in sorted(counts, key = lambda n: (-counts[n], n)))
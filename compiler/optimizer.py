@@ -0,0 +1,1709 @@
+# ksp-compiler - a compiler for the Kontakt script language
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''Dataflow optimizations of the native KSP AST, used if optimize mode is selected, together with the merging of
+   identical functions and the peephole rules applied to the AST just before the compiled code is generated.
+
+   They run after functions have been inlined, and every callback and every function invoked with 'call' is optimized
+   on its own: nothing is assumed about the values of variables when a callback starts, and anything may have changed
+   after a 'call' or a wait(), since other callbacks can run in between. UI and persistent variables are never touched,
+   since Kontakt can change them behind the script's back.'''
+
+import copy
+import io
+import re
+from collections import OrderedDict
+from ksp_ast import *
+from ksp_ast_processing import ASTVisitor, ASTModifier, flatten
+import ksp_builtins
+import ksp_compiler_extras as comp_extras
+
+# builtins that let other callbacks run before they return
+suspending_functions = set(name for name in ksp_builtins.functions if name.startswith('wait'))
+
+# builtins that make a variable persistent, which means that Kontakt may change its value when the instrument is loaded
+persistence_functions = set(['make_persistent', 'make_instr_persistent', 'read_persistent_var', '_read_persistent_var'])
+
+def is_reference_parameter_kind(kind):
+    '''True for the kinds of builtin parameters (as written in ksp_builtins_data) that stand for the variable itself,
+       which the builtin may read or assign to as it likes, rather than for its value'''
+    return 'variable' in kind or 'array' in kind or kind.startswith('return-') or kind == 'list'
+
+def is_reference_parameter(function_name, index, num_parameters):
+    '''True if parameter number index of a call of the builtin function_name with num_parameters parameters may be
+       passed by reference (or if that is not known)'''
+    if function_name in ('inc', 'dec'):
+        return True
+
+    signatures = [params for (params, return_type) in ksp_builtins.function_signatures.get(function_name, [])
+                  if len(params) == num_parameters]
+
+    if not signatures:
+        return True
+
+    return any(is_reference_parameter_kind(params[index]) for params in signatures)
+
+
+class ASTVisitorFindOpaqueVariables(ASTVisitor):
+    '''Finds the variables the optimizations must leave alone: UI controls, persistent variables and constants'''
+
+    def __init__(self, ast):
+        ASTVisitor.__init__(self, visit_expressions = False)
+        self.opaque_variables = set()
+        self.traverse(ast)
+
+    def visitDeclareStmt(self, parent, node, *args):
+        if node.isUIDeclaration() or 'const' in node.modifiers:
+            self.opaque_variables.add(str(node.variable))
+
+        return False
+
+    def visitFunctionCall(self, parent, node, *args):
+        if node.function_name.identifier in persistence_functions:
+            for p in node.parameters:
+                if isinstance(p, VarRef):
+                    self.opaque_variables.add(str(p.identifier))
+
+        return False
+
+
+class ASTVisitorFindAssignments(ASTVisitor):
+    '''Collects the variables that a list of statements may assign to, and whether it contains a 'call' or a builtin
+       that lets other callbacks run (after which any variable may have changed)'''
+
+    def __init__(self, statements):
+        ASTVisitor.__init__(self)
+        self.assigned = set()
+        self.called_functions = set()
+        self.has_barrier = False
+
+        for stmt in statements:
+            self.traverse(stmt)
+
+    def visitAssignStmt(self, parent, node, *args):
+        self.assigned.add(str(node.varref.identifier))
+
+    def visitFunctionCall(self, parent, node, *args):
+        name = node.function_name.identifier
+        self.called_functions.add(name)
+
+        if node.using_call_keyword or name not in ksp_builtins.functions or name in suspending_functions:
+            self.has_barrier = True
+        else:
+            for (i, p) in enumerate(node.parameters):
+                if isinstance(p, VarRef) and is_reference_parameter(name, i, len(node.parameters)):
+                    self.assigned.add(str(p.identifier))
+
+
+class ASTModifierUnshareExpressions(ASTModifier):
+    '''Copies the expression nodes that occur in more than one place in the AST, so that the optimizations can change
+       or replace a node without affecting the other places. Inlining functions makes nodes shared: every use of a
+       parameter gets the node of the argument, and every use of a taskfunc local the same frame address.'''
+
+    def __init__(self, module_ast):
+        ASTModifier.__init__(self)
+        self.seen = set()
+        self.nodes_copied = 0
+        self.traverse(module_ast)
+
+    def unshared(self, node):
+        if id(node) in self.seen:
+            node = copy.copy(node)
+            self.nodes_copied += 1
+
+        self.seen.add(id(node))
+
+        return node
+
+    def modifyBinOp(self, node, *args, **kwargs):
+        return (yield from self._modifyBinOp(self.unshared(node), *args, **kwargs))
+
+    def modifyUnaryOp(self, node, *args, **kwargs):
+        return (yield from self._modifyUnaryOp(self.unshared(node), *args, **kwargs))
+
+    def modifyVarRef(self, node, *args, **kwargs):
+        return (yield from self._modifyVarRef(self.unshared(node), *args, **kwargs))
+
+    def modifyFunctionCall(self, node, *args, **kwargs):
+        if not node.is_procedure:
+            node = self.unshared(node)
+
+        return (yield from self._modifyFunctionCall(node, *args, **kwargs))
+
+    def modifyID(self, node, *args, **kwargs):
+        return self.unshared(node)
+
+
+def fact_key(fact):
+    '''Facts are either literal nodes (the variable has that value) or variable names (the variable has the same value
+       as that variable). Returns something that compares equal for equal facts.'''
+    if type(fact) is str:
+        return fact
+
+    return (type(fact), fact.value)
+
+def meet(states):
+    '''Returns the facts that hold in all of the given states'''
+    first = states[0]
+
+    return dict((name, fact) for (name, fact) in first.items()
+                if all(name in s and fact_key(s[name]) == fact_key(fact) for s in states[1:]))
+
+def fold(expr):
+    '''Returns expr evaluated to a literal if it only consists of literals, otherwise expr itself'''
+    if isinstance(expr, (Integer, Real)):
+        return expr
+
+    try:
+        value = comp_extras.evaluate_expression(expr)
+    except SyntaxError:
+        return expr
+
+    if type(value) is int:
+        return Integer(expr.lexinfo, value)
+    elif type(value) is Decimal:
+        return Real(expr.lexinfo, value)
+
+    return expr
+
+
+class ASTModifierPropagateConstants(ASTModifier):
+    '''Replaces reads of variables by their values where these are known at compile time (constant propagation), and by
+       other variables holding the same value (copy propagation).
+
+       The statements are traversed in execution order while keeping track of the facts known about scalar variables.
+       Where control flow joins after an if or select statement, only the facts that hold on every path are kept. Before
+       a while loop, the facts about variables assigned in the loop are dropped, so that the remaining ones hold on every
+       iteration. Only integer and real literals are propagated: copying string literals would make the code longer.
+       Assignments that give a variable the value it is already known to have are removed.'''
+
+    def __init__(self, module_ast):
+        ASTModifier.__init__(self)
+        self.opaque_variables = ASTVisitorFindOpaqueVariables(module_ast).opaque_variables
+        self.state = {}
+        self.constants_propagated = 0
+        self.copies_propagated = 0
+        self.redundant_assignments_removed = 0
+        self.traverse(module_ast)
+
+    def is_tracked(self, name):
+        return name[:1] in '$~@' and name not in self.opaque_variables and name not in ksp_builtins.variables
+
+    def kill(self, name):
+        '''Forgets what is known about a variable (and about variables known to be copies of it)'''
+        state = self.state
+        state.pop(name, None)
+
+        for other in [other for (other, fact) in state.items() if fact == name]:
+            del state[other]
+
+    def has_value(self, name, expr):
+        '''True if the variable is known to hold the value of expr already'''
+        if isinstance(expr, VarRef) and not expr.subscripts:
+            other = str(expr.identifier)
+            return other == name or self.state.get(name) == other or self.state.get(other) == name
+
+        fact = self.state.get(name)
+
+        return isinstance(expr, (Integer, Real)) and fact is not None and type(fact) is not str and fact_key(fact) == fact_key(expr)
+
+    def modifyCallback(self, node, *args, **kwargs):
+        self.state = {}
+        node.lines = flatten((yield from self._modify_list(node.lines, args, kwargs)))
+        self.state = {}
+
+        return node
+
+    def modifyFunctionDef(self, node, *args, **kwargs):
+        self.state = {}
+        node.lines = flatten((yield from self._modify_list(node.lines, args, kwargs)))
+        self.state = {}
+
+        return node
+
+    def modifyDeclareStmt(self, node, *args, **kwargs):
+        # declarations are left as they are, and the values they give are not tracked: the init callback only runs
+        # once, so there is little to gain, and declared values are easier to find in the compiled code
+        return [node]
+
+    def modifyAssignStmt(self, node, *args, **kwargs):
+        node.expression = fold((yield (node.expression, args, kwargs)))
+        node.varref.subscripts = yield from self._modify_list(node.varref.subscripts, args, kwargs)
+
+        name = str(node.varref.identifier)
+
+        if not node.varref.subscripts and self.is_tracked(name) and self.has_value(name, node.expression):
+            self.redundant_assignments_removed += 1
+            return []
+
+        self.kill(name)
+
+        if not node.varref.subscripts and self.is_tracked(name):
+            value = node.expression
+
+            if isinstance(value, (Integer, Real)):
+                self.state[name] = value
+            elif isinstance(value, VarRef) and not value.subscripts and self.is_tracked(str(value.identifier)) and str(value.identifier) != name:
+                self.state[name] = str(value.identifier)
+
+        return [node]
+
+    def modifyFunctionCall(self, node, *args, **kwargs):
+        name = node.function_name.identifier
+        parameters = []
+        assigned = []
+
+        for (i, p) in enumerate(node.parameters):
+            if isinstance(p, VarRef) and is_reference_parameter(name, i, len(node.parameters)):
+                # the builtin needs the variable itself, and may assign to it
+                p.subscripts = yield from self._modify_list(p.subscripts, args, kwargs)
+                assigned.append(str(p.identifier))
+            else:
+                p = yield (p, args, kwargs)
+
+            parameters.append(p)
+
+        node.parameters = parameters
+
+        if node.using_call_keyword or name not in ksp_builtins.functions or name in suspending_functions:
+            self.state.clear()
+        else:
+            for var in assigned:
+                self.kill(var)
+
+        if node.is_procedure:
+            return [node]
+        else:
+            return node
+
+    def modifyVarRef(self, node, *args, **kwargs):
+        node.subscripts = yield from self._modify_list(node.subscripts, args, kwargs)
+
+        if node.subscripts:
+            return node
+
+        fact = self.state.get(str(node.identifier))
+
+        if fact is None:
+            return node
+        elif type(fact) is str:
+            self.copies_propagated += 1
+            return VarRef(node.lexinfo, ID(node.lexinfo, fact))
+        else:
+            self.constants_propagated += 1
+            return fact.__class__(node.lexinfo, fact.value)
+
+    def modifyIfStmt(self, node, *args, **kwargs):
+        condition_stmts_tuples = []
+        branch_states = []
+
+        for (condition, stmts) in node.condition_stmts_tuples:
+            if condition is not None:
+                condition = yield (condition, args, kwargs)
+
+            state = self.state
+            self.state = dict(state)
+            stmts = flatten((yield from self._modify_list(stmts, args, kwargs)))
+            branch_states.append(self.state)
+            self.state = state
+            condition_stmts_tuples.append((condition, stmts))
+
+        if not condition_stmts_tuples or condition_stmts_tuples[-1][0] is not None:
+            branch_states.append(self.state)   # no else branch: none of the branches may be taken
+
+        node.condition_stmts_tuples = condition_stmts_tuples
+        self.state = meet(branch_states)
+
+        return [node]
+
+    def modifySelectStmt(self, node, *args, **kwargs):
+        node.expression = yield (node.expression, args, kwargs)
+        range_stmts_tuples = []
+        branch_states = [self.state]   # no case may match
+
+        for ((start, stop), stmts) in node.range_stmts_tuples:
+            state = self.state
+            self.state = dict(state)
+            stmts = flatten((yield from self._modify_list(stmts, args, kwargs)))
+            branch_states.append(self.state)
+            self.state = state
+            range_stmts_tuples.append(((start, stop), stmts))
+
+        node.range_stmts_tuples = range_stmts_tuples
+        self.state = meet(branch_states)
+
+        return [node]
+
+    def modifyWhileStmt(self, node, *args, **kwargs):
+        assignments = ASTVisitorFindAssignments(node.statements + [node.condition])
+
+        if assignments.has_barrier:
+            self.state.clear()
+        else:
+            for name in assignments.assigned:
+                self.kill(name)
+
+        # what is known now holds at the start of every iteration, and when the loop ends
+        state = self.state
+        self.state = dict(state)
+        node.condition = yield (node.condition, args, kwargs)
+        node.statements = flatten((yield from self._modify_list(node.statements, args, kwargs)))
+        self.state = state
+
+        return [node]
+
+
+class ASTVisitorFindReads(ASTVisitor):
+    '''Collects the names of the variables and arrays read by some expressions (or statements)'''
+
+    def __init__(self, nodes):
+        ASTVisitor.__init__(self)
+        self.read = set()
+
+        for node in nodes:
+            self.traverse(node)
+
+    def visitVarRef(self, parent, node, *args):
+        self.read.add(str(node.identifier))
+
+
+class ASTVisitorFindElementReads(ASTVisitorFindReads):
+    '''Also collects the array elements read with a literal offset from a variable, eg. %p[$fp + 2], as
+       (array name, (variable name, offset)) in elements, and the names of the arrays read in any other way in whole'''
+
+    def __init__(self, nodes):
+        self.elements = set()
+        self.whole = set()
+        ASTVisitorFindReads.__init__(self, nodes)
+
+    def visitVarRef(self, parent, node, *args):
+        ASTVisitorFindReads.visitVarRef(self, parent, node, *args)
+        base_offset = DeadStoreElimination.base_offset(node.subscripts[0]) if len(node.subscripts) == 1 else None
+
+        if base_offset is not None:
+            self.elements.add((str(node.identifier), base_offset))
+        else:
+            self.whole.add(str(node.identifier))
+
+
+class DeadStoreElimination(object):
+    '''Removes assignments whose value is never read because the variable is always assigned again first.
+
+       Every callback and function invoked with 'call' is traversed backwards, keeping track of the dead variables: the
+       ones that are assigned on every path from the current statement on before they are read. Whatever a variable
+       holds when a callback ends may be read by another callback, so nothing is dead at the end of a callback or
+       function, and neither is anything before a 'call', a wait() or exit(). After an if or select statement, only the
+       variables that are dead in every branch (and after no branch is taken) stay dead, and those dead at the start of
+       a while loop are the ones dead after it that neither its condition nor its body keeps alive.
+
+       To keep this linear in the size of the code, every statement list is first summarized bottom-up by the store
+       keys it makes dead and the ones it keeps alive (as bit masks, see summarize), and the lists are then processed
+       top-down with the dead store keys after each of them derived from these summaries, so that the body of a loop is
+       never analyzed more than once and nothing recurses on the nesting depth.
+
+       Arrays are handled conservatively: an element is only dead if it is assigned again with the same literal index,
+       or the same literal offset from an unchanged variable like the elements %p[$sp - n] and %p[$fp + n] of the
+       stack frames of taskfuncs, and every other use of the array keeps all of its elements alive. Since nothing is
+       dead before a 'call' or at the end of a function, the stores of the arguments of a taskfunc and of its results
+       are never removed, only those overwritten within the same callback or function between such calls. An assignment is only removed if its
+       expression has no side effects, ie. only uses operators and the builtins in pure_functions.'''
+
+    def __init__(self, module_ast):
+        self.opaque_variables = ASTVisitorFindOpaqueVariables(module_ast).opaque_variables
+        self.stores_removed = 0
+
+        for block in module_ast.blocks:
+            if isinstance(block, (Callback, FunctionDef)):
+                self.process_block(block)
+
+    def is_tracked(self, name):
+        return name not in self.opaque_variables and name not in ksp_builtins.variables
+
+    def store_key(self, varref):
+        '''Returns what an assignment to varref makes dead: the variable name, (array name, index) for an array element
+           with a literal index, or None'''
+        name = str(varref.identifier)
+
+        if not self.is_tracked(name):
+            return None
+        elif not varref.subscripts and name[:1] in '$~@':
+            return name
+        elif len(varref.subscripts) == 1 and isinstance(varref.subscripts[0], Integer) and name[:1] in '%?!':
+            return (name, varref.subscripts[0].value)
+        elif len(varref.subscripts) == 1 and name[:1] == '%':
+            base_offset = self.base_offset(varref.subscripts[0])
+            if base_offset is not None:
+                return (name, base_offset)
+
+        return None
+
+    @staticmethod
+    def base_offset(subscript):
+        '''Returns (variable name, offset) for a subscript like $fp + 2 or $sp - 1, as used for the stack frames of
+           taskfuncs, or None'''
+        if isinstance(subscript, BinOp) and subscript.op in ('+', '-') and isinstance(subscript.left, VarRef) and \
+           not subscript.left.subscripts and str(subscript.left.identifier)[:1] == '$' and isinstance(subscript.right, Integer):
+            return (str(subscript.left.identifier), subscript.right.value if subscript.op == '+' else -subscript.right.value)
+
+        return None
+
+    def process_block(self, block):
+        lists = statement_lists([block])
+
+        # give every store key of the block a bit, and every variable the mask of its keys
+        # (and every variable used as the base of a subscript, like $fp in %p[$fp + 2], the mask of the keys that it
+        # makes refer to other elements when it is assigned)
+        self.key_bits = {}
+        self.name_masks = {}
+        self.base_masks = {}
+        for stmts in lists:
+            for stmt in stmts:
+                if isinstance(stmt, AssignStmt):
+                    key = self.store_key(stmt.varref)
+                    if key is not None and key not in self.key_bits:
+                        bit = 1 << len(self.key_bits)
+                        self.key_bits[key] = bit
+                        name = key[0] if type(key) is tuple else key
+                        self.name_masks[name] = self.name_masks.get(name, 0) | bit
+                        if type(key) is tuple and type(key[1]) is tuple:
+                            self.base_masks[key[1][0]] = self.base_masks.get(key[1][0], 0) | bit
+        self.all_keys = (1 << len(self.key_bits)) - 1
+
+        # bottom-up: the summary of every compound statement, from the summaries of the lists nested in it
+        self.summaries = {}
+        list_summaries = {}
+        for stmts in reversed(lists):
+            summary = (0, 0)
+            for stmt in reversed(stmts):
+                summary = self.then(self.summarize(stmt, list_summaries), summary)
+            list_summaries[id(stmts)] = summary
+
+        # top-down: remove the dead stores of every list, given the keys dead after it
+        dead_after = {}
+        for stmts in lists:
+            self.process_statements(stmts, dead_after.get(id(stmts), 0), dead_after)
+
+    def read_mask(self, nodes):
+        '''Returns the mask of the store keys of the variables read in nodes'''
+        reads = ASTVisitorFindElementReads(nodes)
+        mask = 0
+        for name in reads.whole:
+            mask |= self.name_masks.get(name, 0)
+        for (name, (base, offset)) in reads.elements:
+            # elements at other offsets from the same variable are other elements
+            mask |= self.name_masks.get(name, 0) & ~self.base_masks.get(base, 0) | self.key_bits.get((name, (base, offset)), 0)
+        return mask
+
+    def base_mask(self, names):
+        '''Returns the mask of the store keys that refer to other elements after the given variables are assigned'''
+        mask = 0
+        for name in names:
+            mask |= self.base_masks.get(name, 0)
+        return mask
+
+    @staticmethod
+    def apply(summary, dead):
+        '''Returns the keys dead before the code summarized by summary, given those dead after it'''
+        (gen, kill) = summary
+        return (dead & ~kill) | gen
+
+    @staticmethod
+    def then(first, second):
+        '''Returns the summary of the code summarized by first followed by the code summarized by second'''
+        gen = first[0] | (second[0] & ~first[1])
+        return (gen, (first[1] | second[1]) & ~gen)
+
+    def summarize(self, stmt, list_summaries):
+        '''Returns (gen, kill) for the statement: the masks of the store keys it makes dead and of the ones it keeps
+           alive, so that the keys dead before it are (dead & ~kill) | gen given those dead after it. Removing dead
+           assignments only makes more keys dead, so the summary stays valid after process_statements.'''
+        if isinstance(stmt, AssignStmt):
+            nodes = [stmt.expression] + stmt.varref.subscripts
+            if ASTVisitorFindAssignments(nodes).has_barrier:
+                return (0, self.all_keys)
+            kill = self.read_mask(nodes) | self.base_mask([str(stmt.varref.identifier)])
+            return (self.key_bits.get(self.store_key(stmt.varref), 0) & ~kill, kill)
+        elif isinstance(stmt, FunctionCall):
+            assignments = ASTVisitorFindAssignments([stmt])
+            if stmt.function_name.identifier == 'exit' or assignments.has_barrier:
+                return (0, self.all_keys)
+            return (0, self.read_mask([stmt]) | self.base_mask(assignments.assigned))
+        elif isinstance(stmt, IfStmt):
+            conditions = [condition for (condition, branch) in stmt.condition_stmts_tuples if condition is not None]
+            branches = [list_summaries[id(branch)] for (condition, branch) in stmt.condition_stmts_tuples]
+            if not stmt.condition_stmts_tuples or stmt.condition_stmts_tuples[-1][0] is not None:
+                branches.append((0, 0))   # no else branch: none of the branches may be taken
+            summary = self.joined(branches, conditions)
+        elif isinstance(stmt, SelectStmt):
+            branches = [(0, 0)] + [list_summaries[id(branch)] for (r, branch) in stmt.range_stmts_tuples]
+            summary = self.joined(branches, [stmt.expression])
+        elif isinstance(stmt, WhileStmt):
+            # the keys dead at the start of every iteration are the ones dead after the loop that neither the
+            # condition nor the body keeps alive
+            if ASTVisitorFindAssignments([stmt.condition]).has_barrier:
+                summary = (0, self.all_keys)
+            else:
+                summary = (0, self.read_mask([stmt.condition]) | list_summaries[id(stmt.statements)][1])
+        elif isinstance(stmt, DeclareStmt):
+            return (0, self.read_mask([stmt]) | self.name_masks.get(str(stmt.variable), 0) | self.base_mask([str(stmt.variable)]))
+        else:
+            return (0, self.all_keys)
+
+        self.summaries[id(stmt)] = summary
+        return summary
+
+    def joined(self, branches, conditions):
+        '''Returns the summary of evaluating the conditions and then taking one of the branches'''
+        if ASTVisitorFindAssignments(conditions).has_barrier:
+            return (0, self.all_keys)
+
+        gen = self.all_keys
+        kill = 0
+        for (branch_gen, branch_kill) in branches:
+            gen &= branch_gen
+            kill |= branch_kill
+
+        return self.then((0, self.read_mask(conditions)), (gen, kill))
+
+    def process_statements(self, stmts, dead, dead_after):
+        '''Removes the dead assignments from stmts, given the keys dead after them, and records in dead_after the keys
+           dead after each of the statement lists nested in stmts'''
+        kept = []
+
+        for stmt in reversed(stmts):
+            if isinstance(stmt, AssignStmt):
+                nodes = [stmt.expression] + stmt.varref.subscripts
+                bit = self.key_bits.get(self.store_key(stmt.varref), 0)
+
+                if dead & bit and not has_side_effects(nodes):
+                    self.stores_removed += 1
+                    continue
+                elif ASTVisitorFindAssignments(nodes).has_barrier:
+                    dead = 0
+                else:
+                    dead = (dead | bit) & ~(self.read_mask(nodes) | self.base_mask([str(stmt.varref.identifier)]))
+            elif isinstance(stmt, IfStmt):
+                for (condition, branch) in stmt.condition_stmts_tuples:
+                    dead_after[id(branch)] = dead
+                dead = self.apply(self.summaries[id(stmt)], dead)
+            elif isinstance(stmt, SelectStmt):
+                for (r, branch) in stmt.range_stmts_tuples:
+                    dead_after[id(branch)] = dead
+                dead = self.apply(self.summaries[id(stmt)], dead)
+            elif isinstance(stmt, WhileStmt):
+                dead = self.apply(self.summaries[id(stmt)], dead)
+                dead_after[id(stmt.statements)] = dead
+            else:
+                dead = self.apply(self.summarize(stmt, None), dead)
+
+            kept.append(stmt)
+
+        stmts[:] = reversed(kept)
+
+
+# parameter kinds of builtins that stand for plain values (see ksp_builtins_data)
+value_parameter_kinds = set(['value', 'real-value', 'int-or-real-value', 'integer', 'number', 'amount', 'expression'])
+
+def find_pure_functions():
+    '''Returns the names of the builtins that only compute a result from their parameters: the ones the compiler
+       evaluates itself, and those that take plain values and return a number, except for the ones that read the
+       state of the engine (get_... and mf_...) and inc/dec'''
+    pure = set(ksp_builtins.functions_evaluated_with_optimize_code)
+
+    for (name, signatures) in ksp_builtins.function_signatures.items():
+        if name.startswith(('get_', 'mf_')) or name in ('inc', 'dec'):
+            continue
+
+        if all(return_type in ('integer', 'real') and params and all(p in value_parameter_kinds for p in params)
+               for (params, return_type) in signatures):
+            pure.add(name)
+
+    return pure
+
+pure_functions = find_pure_functions()
+
+def find_engine_read_functions():
+    '''Returns the names of the get_... and mf_get_... builtins that return a number and only take plain values. Their
+       result depends on the state of the engine (UI controls, events, zones...), which cannot change while a callback
+       runs, except through a builtin that is not in ui_preserving_functions, an assignment to a UI control or other
+       opaque variable, or another callback running during a 'call' or wait().'''
+    engine_reads = set()
+
+    for (name, signatures) in ksp_builtins.function_signatures.items():
+        if name.startswith(('get_', 'mf_get_')) and name not in pure_functions and \
+           all(return_type in ('integer', 'real') and not any(is_reference_parameter_kind(p) for p in params)
+               for (params, return_type) in signatures):
+            engine_reads.add(name)
+
+    return engine_reads
+
+engine_read_functions = find_engine_read_functions()
+
+# name of the pseudo variable that the value of an engine read depends on (see find_engine_read_functions)
+ENGINE_STATE = '<engine state>'
+
+# builtins that cannot change the value of a UI control, except one passed to them as a parameter
+ui_preserving_functions = pure_functions | set(['inc', 'dec', 'num_elements', 'message'])
+
+def has_side_effects(nodes):
+    '''True unless the expressions only consist of operators, variables, literals and the builtins in pure_functions'''
+    stack = list(nodes)
+
+    while stack:
+        node = stack.pop()
+
+        if isinstance(node, FunctionCall) and (node.using_call_keyword or node.function_name.identifier not in pure_functions):
+            return True
+        elif not isinstance(node, (BinOp, UnaryOp, VarRef, ID, FunctionCall, Integer, Real, String, Boolean)):
+            return True
+
+        stack.extend(n for n in node.get_childnodes() or [] if isinstance(n, Expr))
+
+    return False
+
+# builtin operators that can be moved into a temporary variable (comparisons and logical operators give booleans, which cannot be stored)
+storable_operators = set(['+', '-', '*', '/', 'mod', '.and.', '.or.', '.xor.', '.not.', '&'])
+
+prefix_types = {'$': 'integer', '%': 'integer', '~': 'real', '?': 'real', '@': 'string', '!': 'string'}
+type_prefixes = {'integer': '$', 'real': '~', 'string': '@'}
+
+def statement_lists(blocks):
+    '''Returns all lists of statements in the given blocks (the bodies of callbacks, functions and compound statements),
+       every list before the ones nested in it'''
+    lists = []
+    stack = [b.lines for b in blocks if isinstance(b, (Callback, FunctionDef))]
+
+    while stack:
+        stmts = stack.pop()
+        lists.append(stmts)
+
+        for stmt in stmts:
+            if isinstance(stmt, IfStmt):
+                stack.extend(s for (c, s) in stmt.condition_stmts_tuples)
+            elif isinstance(stmt, SelectStmt):
+                stack.extend(s for (r, s) in stmt.range_stmts_tuples)
+            elif isinstance(stmt, WhileStmt):
+                stack.append(stmt.statements)
+
+    return lists
+
+
+class ValueInfo(object):
+    __slots__ = ('variables', 'candidate', 'cost', 'type')
+
+    def __init__(self, variables, candidate, cost, value_type):
+        self.variables = variables    # the variables (and arrays) the value depends on
+        self.candidate = candidate    # whether it is worth keeping in a temporary variable
+        self.cost = cost              # cost of computing it according to the default cost model
+        self.type = value_type        # 'integer', 'real', 'string', 'boolean' or None
+
+
+class ASTModifierReplaceNodes(ASTModifier):
+    '''Replaces expression nodes by other nodes, given a dictionary from id(node) to its replacement'''
+
+    def __init__(self, replacements):
+        ASTModifier.__init__(self)
+        self.replacements = replacements
+
+    def modifyBinOp(self, node, *args, **kwargs):
+        if id(node) in self.replacements:
+            return self.replacements[id(node)]
+
+        return (yield from self._modifyBinOp(node, *args, **kwargs))
+
+    def modifyUnaryOp(self, node, *args, **kwargs):
+        if id(node) in self.replacements:
+            return self.replacements[id(node)]
+
+        return (yield from self._modifyUnaryOp(node, *args, **kwargs))
+
+    def modifyVarRef(self, node, *args, **kwargs):
+        if id(node) in self.replacements:
+            return self.replacements[id(node)]
+
+        return (yield from self._modifyVarRef(node, *args, **kwargs))
+
+    def modifyFunctionCall(self, node, *args, **kwargs):
+        if id(node) in self.replacements:
+            return self.replacements[id(node)]
+
+        return (yield from self._modifyFunctionCall(node, *args, **kwargs))
+
+
+class TemporaryVariables(object):
+    '''Base class of the optimizations that need variables of their own. Creates names that do not clash with the
+       declared variables (whatever their prefix) and declares the variables at the start of the init callback.'''
+
+    temporary_name = 'tmp'
+
+    def __init__(self, existing_names = ()):
+        self.existing_names = set(name.lstrip('$%@!?~').lower() for name in existing_names)
+        self.temporaries = {}    # type -> list of names of the temporary variables of that type
+        self.declarations = []   # declarations of other variables (eg. arrays) to add to the init callback
+
+    def unused_name(self, prefix, name):
+        '''Returns prefix + _ + name + the lowest number that makes it unique, and reserves it'''
+        n = 1
+
+        while ('_%s%d' % (name, n)).lower() in self.existing_names:
+            n += 1
+
+        self.existing_names.add(('_%s%d' % (name, n)).lower())
+
+        return '%s_%s%d' % (prefix, name, n)
+
+    def declare_temporaries(self, module_ast):
+        on_init = module_ast.on_init
+        declarations = [DeclareStmt(on_init.lexinfo, ID(on_init.lexinfo, name), [])
+                        for value_type in ('integer', 'real', 'string') for name in self.temporaries.get(value_type, [])]
+        on_init.lines = declarations + self.declarations + on_init.lines
+
+    def temporary_names(self):
+        return [name for names in self.temporaries.values() for name in names] + [str(d.variable) for d in self.declarations]
+
+    def temporary(self, value_type, index):
+        '''Returns the name of the temporary variable number index of a type'''
+        names = self.temporaries.setdefault(value_type, [])
+
+        while len(names) <= index:
+            names.append(self.unused_name(type_prefixes[value_type], self.temporary_name))
+
+        return names[index]
+
+
+class ValueNumbering(TemporaryVariables):
+    '''Base class of the optimizations that keep the values of expressions in temporary variables. Gives equal numbers
+       to expressions that compute the same value from the same variables (as long as none of them is assigned in
+       between).'''
+
+    def __init__(self, module_ast, existing_names = ()):
+        from ksp_interpreter import CostModel
+        TemporaryVariables.__init__(self, existing_names)
+        self.cost_model = CostModel()
+        self.costs = self.cost_model.costs
+        self.opaque_variables = ASTVisitorFindOpaqueVariables(module_ast).opaque_variables
+        self.numbers = {}        # structural key -> value number
+        self.info = []           # value number -> ValueInfo
+
+    def operands(self, node):
+        t = type(node)
+
+        if t is BinOp:
+            return [node.left, node.right]
+        elif t is UnaryOp:
+            return [node.right]
+        elif t is VarRef:
+            return node.subscripts
+        elif t is FunctionCall:
+            name = node.function_name.identifier
+
+            if name in ksp_builtins.functions:
+                return [p for (i, p) in enumerate(node.parameters)
+                        if not (isinstance(p, VarRef) and is_reference_parameter(name, i, len(node.parameters)))]
+
+        return []
+
+    def changed_variables(self, assigned):
+        '''Returns the set of variables assigned, plus the state of the engine if a UI control, a persistent variable or
+           a builtin variable is among them'''
+        if any(name in self.opaque_variables or name in ksp_builtins.variables for name in assigned):
+            return assigned | set([ENGINE_STATE])
+
+        return assigned
+
+    def value_number(self, key, variables, candidate, cost, value_type):
+        vn = self.numbers.get(key)
+
+        if vn is None:
+            vn = self.numbers[key] = len(self.info)
+            self.info.append(ValueInfo(variables, candidate and value_type in type_prefixes, cost, value_type))
+
+        return vn
+
+    def number_node(self, node, operand_numbers):
+        '''Returns the value number of a node given those of its operands, or None if it has none'''
+        if None in operand_numbers:
+            return None
+
+        t = type(node)
+        info = self.info
+        costs = self.costs
+
+        if t is Integer:
+            return self.value_number(('i', node.value), frozenset(), False, costs['constant'], 'integer')
+        elif t is Real:
+            return self.value_number(('r', node.value), frozenset(), False, costs['constant'], 'real')
+        elif t is String:
+            return self.value_number(('s', node.value), frozenset(), False, costs['constant'], 'string')
+        elif t is VarRef:
+            name = str(node.identifier)
+
+            if name in ksp_builtins.variables or len(node.subscripts) > 1:
+                return None
+            elif name in ksp_builtins.constants:
+                return self.value_number(('c', name), frozenset(), False, costs['variable read'], prefix_types.get(name[0]))
+            elif not node.subscripts:
+                return self.value_number(('v', name), frozenset([name]), False, costs['variable read'], prefix_types.get(name[0]))
+            else:
+                sub = operand_numbers[0]
+                # an element with a literal index is as cheap to read as a temporary variable
+                return self.value_number(('e', name, sub), info[sub].variables | frozenset([name]), bool(info[sub].variables),
+                                         costs['array access'] + info[sub].cost, prefix_types.get(name[0]))
+        elif t is BinOp and node.op in storable_operators:
+            left, right = operand_numbers
+            cost = info[left].cost + info[right].cost + costs['string operation' if node.op == '&' else 'arithmetic']
+            value_type = 'string' if node.op == '&' else info[left].type or info[right].type
+
+            return self.value_number(('b', node.op, left, right), info[left].variables | info[right].variables, True, cost, value_type)
+        elif t is UnaryOp and node.op in storable_operators | set(['-']):
+            right = operand_numbers[0]
+            cost = info[right].cost + costs['arithmetic']
+
+            return self.value_number(('u', node.op, right), info[right].variables, True, cost, info[right].type)
+        elif t is FunctionCall and node.function_name.identifier == 'num_elements' and len(node.parameters) == 1:
+            # the size of an array never changes
+            return self.value_number(('n', str(node.parameters[0])), frozenset(), True, self.cost_model.builtin_cost('num_elements'), 'integer')
+        elif t is FunctionCall and node.function_name.identifier in pure_functions and len(operand_numbers) == len(node.parameters):
+            name = node.function_name.identifier
+            return_types = set(return_type for (params, return_type) in ksp_builtins.function_signatures.get(name, []))
+            value_type = return_types.pop() if len(return_types) == 1 else (info[operand_numbers[0]].type if operand_numbers else None)
+            variables = frozenset().union(*[info[n].variables for n in operand_numbers])
+            cost = sum(info[n].cost for n in operand_numbers) + self.cost_model.builtin_cost(name)
+
+            return self.value_number(('f', name) + tuple(operand_numbers), variables, True, cost, value_type)
+        elif t is FunctionCall and node.function_name.identifier in engine_read_functions and len(operand_numbers) == len(node.parameters):
+            name = node.function_name.identifier
+            value_type = set(return_type for (params, return_type) in ksp_builtins.function_signatures[name]).pop()
+            variables = frozenset([ENGINE_STATE]).union(*[info[n].variables for n in operand_numbers])
+            cost = sum(info[n].cost for n in operand_numbers) + self.cost_model.builtin_cost(name)
+
+            return self.value_number(('f', name) + tuple(operand_numbers), variables, True, cost, value_type)
+
+        return None
+
+    def number_expression(self, expr, occurrences):
+        '''Numbers expr and its subexpressions, and appends (value number, node) for every candidate to occurrences,
+           in the order they are evaluated'''
+        numbers = {}
+        stack = [(expr, False)]
+
+        while stack:
+            node, operands_done = stack.pop()
+            operands = self.operands(node)
+
+            if not operands_done:
+                stack.append((node, True))
+                stack.extend((operand, False) for operand in reversed(operands))
+            else:
+                vn = numbers[id(node)] = self.number_node(node, [numbers[id(operand)] for operand in operands])
+
+                if vn is not None and self.info[vn].candidate:
+                    occurrences.append((vn, node))
+
+        return numbers[id(expr)]
+
+
+
+class CommonSubexpressionEliminator(ValueNumbering):
+    '''Computes subexpressions that occur more than once in a basic block (a sequence of assignments and procedure
+       calls, together with the condition of an if or select statement that follows it) only once, keeping the value
+       in a temporary variable.
+
+       Only expressions without side effects are considered: operators, array elements and the builtins in
+       pure_functions applied to user variables and literals, as well as the engine reads in engine_read_functions
+       (eg. get_control_par). An occurrence can reuse an earlier value as long as no variable it depends on has been
+       assigned in between (or passed to a builtin that takes a variable), and there was no 'call' or wait() in
+       between. Engine reads also end with a builtin that is not in ui_preserving_functions or an assignment to a UI
+       control. Expressions are only replaced where the default cost model of the
+       interpreter says that this saves more than the extra assignment costs.
+
+       Temporary variables are only used within a basic block without calls or waits, so their values never need
+       to survive another callback or function running, and they are shared between all basic blocks. They are
+       declared in the init callback.'''
+
+    temporary_name = 'cse'
+
+    def __init__(self, module_ast, existing_names = ()):
+        ValueNumbering.__init__(self, module_ast, existing_names)
+        self.expressions_replaced = 0
+
+        for stmts in statement_lists(module_ast.blocks):
+            stmts[:] = self.process_statements(stmts)
+
+        self.declare_temporaries(module_ast)
+
+    def process_statements(self, stmts):
+        result = []
+        block = []
+
+        for stmt in stmts:
+            if isinstance(stmt, (AssignStmt, FunctionCall)):
+                block.append(stmt)
+            else:
+                result.extend(self.process_block(block, stmt if isinstance(stmt, (IfStmt, SelectStmt)) else None))
+                result.append(stmt)
+                block = []
+
+        result.extend(self.process_block(block, None))
+
+        return result
+
+    # ---------------------------------------------------------------- basic blocks
+
+    @staticmethod
+    def expressions(item):
+        '''Returns the expressions evaluated by an item of a basic block (a statement or the if/select that ends it)'''
+        if isinstance(item, AssignStmt):
+            return [item.expression] + item.varref.subscripts
+        elif isinstance(item, FunctionCall):
+            return [item]
+        elif isinstance(item, IfStmt):
+            return [item.condition_stmts_tuples[0][0]]
+        elif isinstance(item, SelectStmt):
+            return [item.expression]
+
+        return []
+
+    def assignments(self, item):
+        '''Returns the variables an item may assign to, or None if any variable may have changed after it'''
+        assigned = set()
+
+        if isinstance(item, AssignStmt):
+            assigned.add(str(item.varref.identifier))
+        elif item.function_name.identifier not in ui_preserving_functions:
+            # builtins like set_control_par can change the value of UI controls and the state of the engine
+            assigned |= self.opaque_variables | set([ENGINE_STATE])
+
+        calls = ASTVisitorFindAssignments([item.varref, item.expression] if isinstance(item, AssignStmt) else [item])
+
+        if calls.has_barrier:
+            return None
+
+        return self.changed_variables(assigned | calls.assigned)
+
+    def find_groups(self, items):
+        '''Returns a list of (value number, [(item index, node), ...]) for all values computed in the block, where all
+           occurrences in a list have the same value'''
+        groups = []
+        available = {}
+
+        for (i, item) in enumerate(items):
+            occurrences = []
+
+            for expr in self.expressions(item):
+                self.number_expression(expr, occurrences)
+
+            for (vn, node) in occurrences:
+                if vn not in available:
+                    available[vn] = []
+                    groups.append((vn, available[vn]))
+
+                available[vn].append((i, node))
+
+            if isinstance(item, (IfStmt, SelectStmt)):
+                break
+
+            assigned = self.assignments(item)
+
+            if assigned is None:
+                available.clear()
+            elif assigned:
+                info = self.info
+
+                for vn in [vn for vn in available if not info[vn].variables.isdisjoint(assigned)]:
+                    del available[vn]
+
+        return groups
+
+    def saving(self, vn, occurrences):
+        costs = self.costs
+        n = len(occurrences)
+
+        return (n - 1) * self.info[vn].cost - (costs['statement'] + costs['assignment'] + n * costs['variable read'])
+
+    def process_block(self, block, terminator):
+        items = block + ([terminator] if terminator is not None else [])
+        num_temporaries = {}
+
+        while True:
+            groups = [(self.saving(vn, occurrences), vn, occurrences) for (vn, occurrences) in self.find_groups(items)
+                      if len(occurrences) > 1]
+            groups = [g for g in groups if g[0] > 0]
+
+            if not groups:
+                break
+
+            saving, vn, occurrences = max(groups, key = lambda g: g[0])
+            value_type = self.info[vn].type
+            index = num_temporaries.get(value_type, 0)
+            num_temporaries[value_type] = index + 1
+            name = self.temporary(value_type, index)
+
+            replacements_by_item = {}
+
+            for (i, node) in occurrences:
+                replacements_by_item.setdefault(i, {})[id(node)] = VarRef(node.lexinfo, ID(node.lexinfo, name))
+
+            first_index, first_node = occurrences[0]
+
+            for (i, replacements) in replacements_by_item.items():
+                self.replace(items[i], replacements)
+
+            items.insert(first_index, AssignStmt(first_node.lexinfo, VarRef(first_node.lexinfo, ID(first_node.lexinfo, name)), first_node))
+            self.expressions_replaced += len(occurrences)
+
+        return items[:len(items) - 1] if terminator is not None else items
+
+    @staticmethod
+    def replace(item, replacements):
+        modifier = ASTModifierReplaceNodes(replacements)
+
+        if isinstance(item, AssignStmt):
+            item.expression = modifier.dispatch(item.expression)
+            item.varref.subscripts = [modifier.dispatch(s) for s in item.varref.subscripts]
+        elif isinstance(item, FunctionCall):
+            item.parameters = [modifier.dispatch(p) for p in item.parameters]
+        elif isinstance(item, IfStmt):
+            condition, stmts = item.condition_stmts_tuples[0]
+            item.condition_stmts_tuples[0] = (modifier.dispatch(condition), stmts)
+        elif isinstance(item, SelectStmt):
+            item.expression = modifier.dispatch(item.expression)
+
+
+class LoopInvariantCodeMotion(ValueNumbering):
+    '''Moves the computation of expressions whose value is the same in every iteration of a while loop (including for
+       loops, which have been turned into while loops) into temporary variables assigned just before the loop. This
+       includes the end value in the condition of a for loop, eg. num_elements(%array) - 1.
+
+       Only loops without 'call' and wait() are considered, since other callbacks could change any variable while
+       these run. An expression is invariant if it is free of side effects (see CommonSubexpressionEliminator) and
+       none of the variables it depends on is assigned in the loop or passed to a builtin that takes a variable. UI
+       controls and the state of the engine count as assigned if the loop calls any builtin that is not in
+       ui_preserving_functions. Array elements are only
+       moved if their index is a literal, so that an index that is only valid while the loop runs is never used.
+
+       Expressions are taken from the loop condition, the statements of the loop body and the first condition of the
+       if and select statements in it, since all of these are evaluated in every iteration. Inner loops are handled
+       first, so that an expression can move out of several loops.'''
+
+    temporary_name = 'inv'
+
+    def __init__(self, module_ast, existing_names = ()):
+        ValueNumbering.__init__(self, module_ast, existing_names)
+        self.expressions_moved = 0
+        self.loops_changed = 0
+
+        for block in module_ast.blocks:
+            if isinstance(block, (Callback, FunctionDef)):
+                # temporaries are only live during the loop they were made for, so each callback and function can reuse them
+                self.num_temporaries = {}
+                self.hoisted_assignments = set()
+
+                for stmts in reversed(statement_lists([block])):
+                    if any(isinstance(stmt, WhileStmt) for stmt in stmts):
+                        stmts[:] = self.process_statements(stmts)
+
+        self.declare_temporaries(module_ast)
+
+    def process_statements(self, stmts):
+        result = []
+
+        for stmt in stmts:
+            if isinstance(stmt, WhileStmt):
+                result.extend(self.process_loop(stmt))
+
+            result.append(stmt)
+
+        return result
+
+    def loop_expressions(self, loop):
+        '''Returns the expressions evaluated in every iteration of a loop, as (statement, expression) pairs'''
+        expressions = [(loop, loop.condition)]
+
+        for stmt in loop.statements:
+            if isinstance(stmt, AssignStmt):
+                expressions.extend((stmt, e) for e in [stmt.expression] + stmt.varref.subscripts)
+            elif isinstance(stmt, FunctionCall):
+                expressions.append((stmt, stmt))
+            elif isinstance(stmt, IfStmt):
+                expressions.append((stmt, stmt.condition_stmts_tuples[0][0]))
+            elif isinstance(stmt, SelectStmt):
+                expressions.append((stmt, stmt.expression))
+
+        return expressions
+
+    def find_invariants(self, expr, assigned):
+        '''Returns the largest subexpressions of expr that are invariant and worth moving, as (value number, node) pairs'''
+        numbers = {}
+        invariant = {}
+        found = []
+        stack = [(expr, False)]
+
+        while stack:
+            node, operands_done = stack.pop()
+            operands = self.operands(node)
+
+            if not operands_done:
+                stack.append((node, True))
+                stack.extend((operand, False) for operand in reversed(operands))
+                continue
+
+            vn = numbers[id(node)] = self.number_node(node, [numbers[id(operand)] for operand in operands])
+            invariant[id(node)] = (vn is not None and all(invariant[id(operand)] for operand in operands) and
+                                   self.info[vn].variables.isdisjoint(assigned) and
+                                   not (isinstance(node, VarRef) and node.subscripts and not isinstance(node.subscripts[0], Integer)))
+
+        # go down from the root, stopping at invariant nodes
+        stack = [expr]
+
+        while stack:
+            node = stack.pop()
+            vn = numbers[id(node)]
+
+            if invariant[id(node)] and self.info[vn].candidate and self.info[vn].cost > self.costs['variable read']:
+                found.append((vn, node))
+            else:
+                stack.extend(reversed(self.operands(node)))
+
+        return found
+
+    def process_loop(self, loop):
+        '''Returns the statements to insert before a loop, and replaces the invariant expressions in it'''
+        analysis = ASTVisitorFindAssignments([loop.condition] + loop.statements)
+
+        if analysis.has_barrier:
+            return []
+
+        assigned = self.changed_variables(set(analysis.assigned))
+
+        if not analysis.called_functions <= ui_preserving_functions:
+            assigned |= self.opaque_variables | set([ENGINE_STATE])
+
+        hoisted = []
+
+        # assignments to temporaries that were moved out of an inner loop can move further if their values are invariant here too
+        for stmt in list(loop.statements):
+            if id(stmt) in self.hoisted_assignments:
+                name = str(stmt.varref.identifier)
+
+                if not ASTVisitorFindAssignments([stmt.expression]).has_barrier and \
+                   self.find_invariants(stmt.expression, assigned - set([name])) == [(self.number_expression(stmt.expression, []), stmt.expression)]:
+                    loop.statements.remove(stmt)
+                    assigned.discard(name)
+                    hoisted.append(stmt)
+
+        temporaries = {}     # value number -> name of the temporary variable holding it
+        replacements = {}    # statement -> {id(node): replacement}
+
+        for (stmt, expr) in self.loop_expressions(loop):
+            for (vn, node) in self.find_invariants(expr, assigned):
+                if vn not in temporaries:
+                    value_type = self.info[vn].type
+                    index = self.num_temporaries.get(value_type, 0)
+                    self.num_temporaries[value_type] = index + 1
+                    temporaries[vn] = self.temporary(value_type, index)
+
+                    assignment = AssignStmt(node.lexinfo, VarRef(node.lexinfo, ID(node.lexinfo, temporaries[vn])), node)
+                    self.hoisted_assignments.add(id(assignment))
+                    hoisted.append(assignment)
+
+                replacements.setdefault(id(stmt), (stmt, {}))[1][id(node)] = VarRef(node.lexinfo, ID(node.lexinfo, temporaries[vn]))
+                self.expressions_moved += 1
+
+        for (stmt, nodes) in replacements.values():
+            if stmt is loop:
+                loop.condition = ASTModifierReplaceNodes(nodes).dispatch(loop.condition)
+            else:
+                CommonSubexpressionEliminator.replace(stmt, nodes)
+
+        if hoisted:
+            self.loops_changed += 1
+
+        return hoisted
+
+
+class SelectLowering(TemporaryVariables):
+    '''Replaces select statements with many cases, which Kontakt tests one by one, by code that needs fewer tests.
+
+       If every case assigns a literal integer to the same variable, and the cases together cover all values from the
+       lowest to the highest one, the select statement becomes a lookup in an array declared in the init callback:
+           if (in_range(x, lowest, highest))
+               y := %table[x - lowest]
+           end if
+       Otherwise the cases are sorted and tested with a balanced tree of if statements that halves the remaining
+       cases with each comparison. Only select statements whose cases are non-overlapping integer literals or
+       ranges, and that have at least min_cases cases, are changed, and only if the default cost model of the
+       interpreter expects the result to be cheaper (a lookup pays off from about 20 cases, a tree of if statements
+       from about 70). If the selected expression is not a simple variable it is assigned to a temporary variable
+       first, so that it is evaluated only once.
+
+       The expected number of tests saved assumes that the value of the selected expression is equally likely to
+       belong to each case. Kontakt tests the cases of a select statement in order, so the case k costs k tests.'''
+
+    temporary_name = 'sel'
+    min_cases = 8
+    max_table_size = 32768
+
+    def __init__(self, module_ast, existing_names = ()):
+        from ksp_interpreter import CostModel
+        TemporaryVariables.__init__(self, existing_names)
+        self.cost_model = CostModel()
+        self.costs = self.cost_model.costs
+        self.lookup_tables = 0
+        self.search_trees = 0
+        self.expected_tests_saved = 0.0
+
+        for stmts in statement_lists(module_ast.blocks):
+            if any(isinstance(stmt, SelectStmt) for stmt in stmts):
+                stmts[:] = flatten([self.lower(stmt) if isinstance(stmt, SelectStmt) else [stmt] for stmt in stmts])
+
+        self.declare_temporaries(module_ast)
+
+    @staticmethod
+    def cases(select):
+        '''Returns the cases of a select statement as a list of (start, stop, statements) sorted by start, or None if
+           they are not all integer literals or if they overlap'''
+        cases = []
+
+        for ((start, stop), stmts) in select.range_stmts_tuples:
+            start = fold(start)
+            stop = start if stop is None else fold(stop)
+
+            if not (isinstance(start, Integer) and isinstance(stop, Integer) and start.value <= stop.value):
+                return None
+
+            cases.append((start.value, stop.value, stmts))
+
+        cases.sort(key = lambda case: case[0])
+
+        if any(cases[i][1] >= cases[i + 1][0] for i in range(len(cases) - 1)):
+            return None
+
+        return cases
+
+    @staticmethod
+    def assigned_literal(stmts):
+        '''Returns (variable, value) if the statements are a single assignment of an integer literal to a variable'''
+        if len(stmts) == 1 and isinstance(stmts[0], AssignStmt) and isinstance(stmts[0].expression, Integer) and \
+           not stmts[0].varref.subscripts and stmts[0].varref.identifier.prefix == '$':
+            return (str(stmts[0].varref.identifier), stmts[0].expression.value)
+
+        return None
+
+    @staticmethod
+    def tree_tests(num_cases):
+        '''Returns the total number of tests done by search_tree over all of num_cases cases'''
+        if num_cases == 1:
+            return 1
+
+        middle = num_cases // 2
+
+        return SelectLowering.tree_tests(middle) + SelectLowering.tree_tests(num_cases - middle) + num_cases
+
+    def lower(self, select):
+        cases = self.cases(select)
+
+        if cases is None or len(cases) < self.min_cases:
+            return [select]
+
+        lexinfo = select.lexinfo
+        costs = self.costs
+        n = len(cases)
+        assignments = [self.assigned_literal(stmts) for (start, stop, stmts) in cases]
+        lowest, highest = cases[0][0], cases[-1][1]
+        size = highest - lowest + 1
+        use_table = not (None in assignments or len(set(variable for (variable, value) in assignments)) != 1 or
+                         size > self.max_table_size or any(cases[i][1] + 1 != cases[i + 1][0] for i in range(n - 1)))
+
+        # compare the expected costs (according to the default cost model of the interpreter) of one execution
+        expression = select.expression
+        needs_temporary = not (isinstance(expression, Integer) or isinstance(expression, VarRef) and not expression.subscripts)
+        read = 0 if isinstance(expression, Integer) else costs['variable read']
+        linear_tests = n * (n + 1) // 2
+        linear_cost = costs['statement'] + costs['branch'] * linear_tests / float(n)
+        lowered_cost = costs['statement'] + costs['assignment'] + costs['variable read'] if needs_temporary else 0
+
+        if use_table:
+            # the assignment in the case costs as much as the one doing the lookup
+            tests = n
+            lowered_cost += costs['statement'] + costs['branch'] + self.cost_model.builtin_cost('in_range') + 2 * read + \
+                            costs['array access'] + (costs['arithmetic'] if lowest else 0)
+        else:
+            tests = self.tree_tests(n)
+            lowered_cost += (costs['statement'] + costs['branch'] + costs['comparison'] + read) * tests / float(n)
+
+        if lowered_cost >= linear_cost:
+            return [select]
+
+        result = []
+
+        if needs_temporary:
+            name = self.temporary('integer', 0)
+            result.append(AssignStmt(lexinfo, VarRef(lexinfo, ID(lexinfo, name)), expression))
+            expression = VarRef(lexinfo, ID(lexinfo, name))
+
+        if use_table:
+            table = []
+
+            for ((start, stop, stmts), (variable, value)) in zip(cases, assignments):
+                table.extend([value] * (stop - start + 1))
+
+            name = self.unused_name('%', 'select_table')
+            self.declarations.append(DeclareStmt(lexinfo, ID(lexinfo, name), [], Integer(lexinfo, size),
+                                                 initial_value = [Integer(lexinfo, value) for value in table]))
+
+            index = expression if lowest == 0 else BinOp(lexinfo, expression, '-', Integer(lexinfo, lowest))
+            lookup = AssignStmt(lexinfo, cases[0][2][0].varref, VarRef(lexinfo, ID(lexinfo, name), [index]))
+            result.append(IfStmt(lexinfo, [(self.case_condition(expression, lowest, highest), [lookup])]))
+            self.lookup_tables += 1
+        else:
+            result.extend(self.search_tree(expression, cases))
+            self.search_trees += 1
+
+        self.expected_tests_saved += (linear_tests - tests) / float(n)
+
+        return result
+
+    @staticmethod
+    def case_condition(expression, start, stop):
+        lexinfo = expression.lexinfo
+
+        if start == stop:
+            return BinOp(lexinfo, expression, '=', Integer(lexinfo, start))
+
+        return FunctionCall(lexinfo, ID(lexinfo, 'in_range'), [expression, Integer(lexinfo, start), Integer(lexinfo, stop)],
+                            is_procedure = False)
+
+    def search_tree(self, expression, cases):
+        '''Returns a balanced tree of if statements that runs the statements of the case the value of expression belongs to'''
+        lexinfo = expression.lexinfo
+
+        if len(cases) == 1:
+            (start, stop, stmts) = cases[0]
+            return [IfStmt(lexinfo, [(self.case_condition(expression, start, stop), stmts)])]
+
+        middle = len(cases) // 2
+        condition = BinOp(lexinfo, expression, '<', Integer(lexinfo, cases[middle][0]))
+
+        return [IfStmt(lexinfo, [(condition, self.search_tree(expression, cases[:middle])),
+                                 (None, self.search_tree(expression, cases[middle:]))])]
+
+
+# ---------------------------------------------------------------- identical functions
+
+def emitted_code(nodes):
+    '''Returns the compact native code of a list of statements, which serves as their structural key: two bodies with
+       the same code behave the same, whatever their source locations'''
+    buffer = io.StringIO()
+    Emitter(buffer, compact = True).write(nodes)
+
+    return buffer.getvalue()
+
+
+class ASTVisitorRenameCalls(ASTVisitor):
+    '''Makes the invocations of the functions in new_names invoke the function named there instead'''
+
+    def __init__(self, ast, new_names):
+        ASTVisitor.__init__(self, visit_expressions = False)
+        self.new_names = new_names
+        self.traverse(ast)
+
+    def visitFunctionCall(self, parent, node, *args):
+        name = node.function_name.identifier
+
+        if name in self.new_names:
+            node.function_name = ID(node.function_name.lexinfo, self.new_names[name])
+
+        return False
+
+
+class IdenticalFunctionMerger(object):
+    '''Keeps only one of the functions invoked with 'call' whose bodies compile to the same code (typically generated by
+       macros for different names) and makes every invocation of the others invoke that one. Merging functions can make
+       their callers identical too, so this is repeated until nothing changes. merged maps the name of every removed
+       function to the one kept instead.
+
+       Also finds the ui_control callbacks that only differ in the name of their control, which could share their code
+       (eg. by keeping the controls in an array and looking them up), but are not changed: similar_callbacks lists the
+       controls of each such group.'''
+
+    def __init__(self, module_ast):
+        self.merged = OrderedDict()
+        new_names = self.find_identical_functions(module_ast)
+
+        while new_names:
+            module_ast.blocks = [block for block in module_ast.blocks
+                                 if not (isinstance(block, FunctionDef) and block.name.identifier in new_names)]
+            ASTVisitorRenameCalls(module_ast, new_names)
+
+            for (name, kept) in list(self.merged.items()):
+                self.merged[name] = new_names.get(kept, kept)
+
+            self.merged.update(new_names)
+            new_names = self.find_identical_functions(module_ast)
+
+        self.similar_callbacks = self.find_similar_callbacks(module_ast)
+
+    def find_identical_functions(self, module_ast):
+        '''Returns a dict that maps the name of every function identical to an earlier one to the name of that one'''
+        first_with_code = {}
+        new_names = OrderedDict()
+
+        for block in module_ast.blocks:
+            if isinstance(block, FunctionDef) and not block.override:
+                key = (block.is_taskfunc, emitted_code(block.lines))
+                name = block.name.identifier
+
+                if key in first_with_code:
+                    new_names[name] = first_with_code[key]
+                else:
+                    first_with_code[key] = name
+
+        return new_names
+
+    def find_similar_callbacks(self, module_ast):
+        groups = OrderedDict()
+
+        for block in module_ast.blocks:
+            if isinstance(block, Callback) and block.variable is not None and block.lines:
+                control = re.escape(block.variable.identifier)
+                code = re.sub(r'(?<![\w.])[$%@!?~]?' + control + r'(?![\w.])', '<control>', emitted_code(block.lines))
+                groups.setdefault((block.name, code), []).append(str(block.variable))
+
+        return [controls for controls in groups.values() if len(controls) > 1]
+
+
+# ---------------------------------------------------------------- peephole rules
+
+def is_user_variable(varref):
+    return isinstance(varref, VarRef) and str(varref.identifier) not in ksp_builtins.variables
+
+def same_variable(a, b):
+    '''True if a and b refer to the same variable (or array element, with subscripts that have no side effects)'''
+    return isinstance(a, VarRef) and isinstance(b, VarRef) and str(a) == str(b) and not has_side_effects(a.subscripts)
+
+def is_1_equals_1(condition):
+    # "if 1=1" is used as a workaround for the Kontakt 2 parser buffer overflow, so it is left alone
+    return isinstance(condition, BinOp) and condition.op == '=' and \
+           all(isinstance(n, Integer) and n.value == 1 for n in (condition.left, condition.right))
+
+def constant_value(expr):
+    '''Returns the value of expr if it can be evaluated at compile time, otherwise None'''
+    try:
+        return comp_extras.evaluate_expression(expr)
+    except SyntaxError:
+        return None
+
+def increment_rule(stmts, i):
+    '''x := x + 1 -> inc(x), x := x - 1 -> dec(x)'''
+    stmt = stmts[i]
+    target, expr = stmt.varref, stmt.expression
+
+    if not (is_user_variable(target) and str(target.identifier)[:1] in '$%' and isinstance(expr, BinOp) and expr.op in ('+', '-')):
+        return None
+
+    def is_one(node):
+        return isinstance(node, Integer) and node.value == 1
+
+    if same_variable(expr.left, target) and is_one(expr.right):
+        name = 'inc' if expr.op == '+' else 'dec'
+    elif expr.op == '+' and is_one(expr.left) and same_variable(expr.right, target):
+        name = 'inc'
+    else:
+        return None
+
+    return (1, [FunctionCall(stmt.lexinfo, ID(stmt.lexinfo, name), [target], is_procedure = True)])
+
+def self_assignment_rule(stmts, i):
+    '''x := x -> nothing'''
+    stmt = stmts[i]
+
+    if is_user_variable(stmt.varref) and same_variable(stmt.varref, stmt.expression):
+        return (1, [])
+
+    return None
+
+def swapped_copy_rule(stmts, i):
+    '''a := b followed by b := a -> a := b'''
+    if i + 1 >= len(stmts) or not isinstance(stmts[i + 1], AssignStmt):
+        return None
+
+    first, second = stmts[i], stmts[i + 1]
+
+    if all(is_user_variable(v) and not v.subscripts for v in (first.varref, first.expression)) and \
+       same_variable(first.varref, second.expression) and same_variable(first.expression, second.varref):
+        return (2, [first])
+
+    return None
+
+def constant_condition_rule(stmts, i):
+    '''Removes the branches of an if statement whose conditions are always false, and the ones after a condition that
+       is always true (which becomes the else branch)'''
+    stmt = stmts[i]
+    condition_stmts_tuples = []
+    changed = False
+
+    for (condition, branch) in stmt.condition_stmts_tuples:
+        value = constant_value(condition) if condition is not None and not is_1_equals_1(condition) else None
+
+        if value is False:
+            changed = True
+            continue
+        elif value is True:
+            condition_stmts_tuples.append((None, branch))
+            changed = True
+            break
+
+        condition_stmts_tuples.append((condition, branch))
+
+    if not changed:
+        return None
+    elif not condition_stmts_tuples:
+        return (1, [])
+    elif condition_stmts_tuples[0][0] is None:
+        return (1, condition_stmts_tuples[0][1])
+
+    stmt.condition_stmts_tuples = condition_stmts_tuples
+
+    return (1, [stmt])
+
+def empty_else_rule(stmts, i):
+    '''Removes an else branch without statements'''
+    stmt = stmts[i]
+
+    if len(stmt.condition_stmts_tuples) > 1 and stmt.condition_stmts_tuples[-1][0] is None and not stmt.condition_stmts_tuples[-1][1]:
+        stmt.condition_stmts_tuples = stmt.condition_stmts_tuples[:-1]
+        return (1, [stmt])
+
+    return None
+
+def empty_if_rule(stmts, i):
+    '''Removes an if statement without statements in any branch, unless its conditions have side effects'''
+    stmt = stmts[i]
+    conditions = [condition for (condition, branch) in stmt.condition_stmts_tuples if condition is not None]
+
+    if not any(branch for (condition, branch) in stmt.condition_stmts_tuples) and not has_side_effects(conditions):
+        return (1, [])
+
+    return None
+
+def double_negation_rule(node):
+    '''-(-x) -> x, .not. .not. x -> x, not not x -> x'''
+    if isinstance(node.right, UnaryOp) and node.right.op == node.op and node.op in ('-', '.not.', 'not'):
+        return node.right.right
+
+    return None
+
+def redundant_parentheses_rule(node):
+    '''a+(b*c) -> a+b*c: the right operand only needs parentheses if its operator does not bind more tightly'''
+    right = node.right
+
+    if isinstance(right, BinOp) and node.parenthesize_right and \
+       precedence.get(right.op, -1) > precedence.get(node.op, len(precedence)):
+        node.parenthesize_right = False
+        return node
+
+    return None
+
+
+class PeepholeRule(object):
+    '''A local rewrite, applied to every node of a class. Statement rules are called as rewrite(stmts, i) for the
+       statement stmts[i] and return None if they do not apply, otherwise (n, replacement) to replace the n statements
+       starting at stmts[i] by the list replacement. Expression rules are called as rewrite(node) and return None or
+       the replacement of node.'''
+
+    def __init__(self, name, node_class, rewrite):
+        self.name = name
+        self.node_class = node_class
+        self.rewrite = rewrite
+
+
+# the rules used by default, in the order they are tried; add to this list to extend the peephole optimizer
+peephole_rules = [
+    PeepholeRule('increment',             AssignStmt, increment_rule),
+    PeepholeRule('self assignment',       AssignStmt, self_assignment_rule),
+    PeepholeRule('swapped copy',          AssignStmt, swapped_copy_rule),
+    PeepholeRule('constant condition',    IfStmt,     constant_condition_rule),
+    PeepholeRule('empty else',            IfStmt,     empty_else_rule),
+    PeepholeRule('empty if',              IfStmt,     empty_if_rule),
+    PeepholeRule('double negation',       UnaryOp,    double_negation_rule),
+    PeepholeRule('redundant parentheses', BinOp,      redundant_parentheses_rule),
+]
+
+
+class ASTModifierPeepholeExpressions(ASTModifier):
+    def __init__(self, peephole):
+        ASTModifier.__init__(self)
+        self.peephole = peephole
+
+    def modifyBinOp(self, node, *args, **kwargs):
+        node = yield from self._modifyBinOp(node, *args, **kwargs)
+        return self.peephole.rewrite_expression(node)
+
+    def modifyUnaryOp(self, node, *args, **kwargs):
+        node = yield from self._modifyUnaryOp(node, *args, **kwargs)
+        return self.peephole.rewrite_expression(node)
+
+
+class PeepholeOptimizer(object):
+    '''Applies small local rewrites (the rules in peephole_rules, unless others are given) to the final AST, cleaning
+       up what the other steps leave behind. Expressions are rewritten bottom-up, and statement lists innermost first,
+       trying the rules again wherever one applied until none does. hits counts how often each rule applied.'''
+
+    def __init__(self, module_ast, rules = None):
+        self.rules = peephole_rules if rules is None else rules
+        self.hits = OrderedDict((rule.name, 0) for rule in self.rules)
+        self.statement_rules = [rule for rule in self.rules if issubclass(rule.node_class, Stmt)]
+        self.expression_rules = [rule for rule in self.rules if issubclass(rule.node_class, Expr)]
+
+        if self.expression_rules:
+            ASTModifierPeepholeExpressions(self).traverse(module_ast)
+
+        if self.statement_rules:
+            for stmts in reversed(statement_lists(module_ast.blocks)):
+                self.process_statements(stmts)
+
+    def rewrite_expression(self, node):
+        applied = True
+
+        while applied:
+            applied = False
+
+            for rule in self.expression_rules:
+                if isinstance(node, rule.node_class):
+                    result = rule.rewrite(node)
+
+                    if result is not None:
+                        self.hits[rule.name] += 1
+                        node = result
+                        applied = True
+                        break
+
+        return node
+
+    def process_statements(self, stmts):
+        i = 0
+
+        while i < len(stmts):
+            for rule in self.statement_rules:
+                if isinstance(stmts[i], rule.node_class):
+                    result = rule.rewrite(stmts, i)
+
+                    if result is not None:
+                        self.hits[rule.name] += 1
+                        n, replacement = result
+                        stmts[i:i + n] = replacement
+                        i = max(i - 1, 0)   # the statement before may match a rule now
+                        break
+            else:
+                i += 1
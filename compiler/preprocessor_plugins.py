@@ -22,7 +22,7 @@ import math
 import collections
 import utils
 from ksp_compiler import ParseException, Line, placeholders
-from simple_eval import SimpleEval
+from simple_eval import MemoizedSimpleEval
 from time import strftime, localtime
 
 varPrefixRe = r"[?~%!@$]"
@@ -47,7 +47,7 @@ initRe = r"^on\s+init$"
 endOnRe = r"^end\s+on$"
 
 concatSyntax = "concat" # The name of the function to concat arrays.
-stringEvaluator = SimpleEval() # Object used to evaluate strings as maths expressions.
+stringEvaluator = MemoizedSimpleEval() # Object used to evaluate strings as maths expressions.
 
 #=================================================================================================
 
@@ -0,0 +1,440 @@
+# ksp-compiler - a compiler for the Kontakt script language
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version:
+# http://www.gnu.org/licenses/gpl-2.0.html
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+'''Compact binary format for Line deques (together with their placeholder table) and for ASTs, so that intermediate
+   compiler state can be saved to disk or handed to another process.
+
+   The data starts with a header (magic bytes, format version and the kind of data), followed by a single value.
+   Every string is written once and referred to by its number afterwards, and so is every AST node and Line, so that
+   shared nodes stay shared. Locations (the (filename, line number) pairs of lines and the lexinfo tuples of nodes)
+   have their own compact records. Both writing and reading use an explicit stack instead of recursion, so that deeply
+   nested ASTs cannot run into Python's recursion limit.'''
+
+import collections
+import gc
+import struct
+from decimal import Decimal
+
+import ksp_ast
+from ksp_compiler import Line, PlaceholderTable
+
+MAGIC = b'KSPS'
+FORMAT_VERSION = 1
+
+KIND_LINES = 1
+KIND_MODULE = 2
+
+# value tags
+NONE, TRUE, FALSE, INT, FLOAT, DECIMAL, STR, LIST, TUPLE, DICT, SET, NODE, LINE, LEXINFO, REF = range(15)
+
+float_struct = struct.Struct('<d')
+
+
+def read_uint(data, pos):
+    '''Returns the unsigned integer starting at data[pos] and the position after it'''
+    b = data[pos]
+    pos += 1
+    n = b & 0x7F
+    shift = 7
+
+    while b & 0x80:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+
+    return n, pos
+
+def unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+class Writer(object):
+    def __init__(self):
+        self.out = bytearray()
+        self.strings = {}     # string -> number
+        self.shapes = {}      # (node class, attribute names) -> number
+        self.objects = {}     # id of node or line -> number
+
+    def write_uint(self, n):
+        out = self.out
+
+        while n > 0x7F:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+
+        out.append(n)
+
+    def write_int(self, n):
+        self.write_uint(n * 2 if n >= 0 else -n * 2 - 1)
+
+    def write_str(self, s):
+        '''Writes 0 for None, 1 followed by the string the first time a string is written, and 2 + its number afterwards'''
+        if s is None:
+            self.out.append(0)
+            return
+
+        n = self.strings.get(s)
+
+        if n is None:
+            self.strings[s] = len(self.strings)
+            data = s.encode('utf-8')
+            self.out.append(1)
+            self.write_uint(len(data))
+            self.out += data
+        else:
+            self.write_uint(n + 2)
+
+    def write_node(self, node):
+        '''Writes the class and attribute names of a node (or only their number if that combination was written before)
+           and returns the attribute values'''
+        attributes = node.__dict__
+        shape = (node.__class__, tuple(attributes))
+        n = self.shapes.get(shape)
+
+        self.out.append(NODE)
+
+        if n is None:
+            self.shapes[shape] = len(self.shapes)
+            self.out.append(0)
+            self.write_str(node.__class__.__name__)
+            self.write_uint(len(attributes))
+
+            for name in attributes:
+                self.write_str(name)
+        else:
+            self.write_uint(n + 1)
+
+        return list(attributes.values())
+
+    def write_lexinfo(self, lexinfo):
+        filename, lineno, function_nodes, namespaces = lexinfo
+        self.out.append(LEXINFO)
+        self.write_str(filename)
+        self.write_int(lineno)
+
+        return [namespaces, function_nodes]
+
+    def write_line(self, line):
+        self.out.append(LINE)
+        self.write_str(line.command)
+        self.write_uint(len(line.locations))
+
+        for filename, lineno in line.locations:
+            self.write_str(filename)
+            self.write_int(lineno)
+
+        return [line.calling_lines, line.source_locations, line.namespaces]
+
+    def write(self, value):
+        out = self.out
+        append = out.append
+        strings = self.strings
+        objects = self.objects
+        stack = [value]
+        pop = stack.pop
+        extend = stack.extend
+
+        while stack:
+            value = pop()
+            t = type(value)
+
+            if t is str:
+                n = strings.get(value)
+
+                if n is not None and n < 126:
+                    out += bytes((STR, n + 2))   # short form of self.write_str
+                else:
+                    append(STR)
+                    self.write_str(value)
+            elif id(value) in objects:
+                append(REF)
+                self.write_uint(objects[id(value)])
+            elif t is list:
+                append(LIST)
+                self.write_uint(len(value))
+                extend(reversed(value))
+            elif t is tuple:
+                if len(value) == 4 and (value[0] is None or type(value[0]) is str) and type(value[1]) is int and type(value[2]) is list:
+                    extend(self.write_lexinfo(value))
+                else:
+                    append(TUPLE)
+                    self.write_uint(len(value))
+                    extend(reversed(value))
+            elif value is None:
+                append(NONE)
+            elif t is bool:
+                append(TRUE if value else FALSE)
+            elif t is int:
+                if 0 <= value < 64:
+                    out += bytes((INT, value * 2))
+                else:
+                    append(INT)
+                    self.write_int(value)
+            elif isinstance(value, ksp_ast.ASTNode):
+                objects[id(value)] = len(objects)
+                values = self.write_node(value)
+                extend(reversed(values))
+            elif t is Line:
+                objects[id(value)] = len(objects)
+                extend(self.write_line(value))
+            elif t is dict:
+                append(DICT)
+                self.write_uint(len(value))
+
+                for key, item in reversed(list(value.items())):
+                    stack.append(item)
+                    stack.append(key)
+            elif t is set:
+                append(SET)
+                self.write_uint(len(value))
+                extend(sorted(value, key = repr))
+            elif t is float:
+                append(FLOAT)
+                out += float_struct.pack(value)
+            elif t is Decimal:
+                append(DECIMAL)
+                self.write_str(str(value))
+            else:
+                raise TypeError('Cannot serialise objects of type %s' % t.__name__)
+
+    def getvalue(self):
+        return bytes(self.out)
+
+
+class Reader(object):
+    def __init__(self, data, placeholders = None):
+        self.data = data
+        self.pos = 0
+        self.strings = []
+        self.shapes = []      # list of (node class, attribute names)
+        self.objects = []
+        self.placeholders = placeholders
+
+    def read_str(self, pos):
+        '''Returns the string (or None) written by Writer.write_str at pos and the position after it'''
+        n, pos = read_uint(self.data, pos)
+
+        if n == 0:
+            return None, pos
+        elif n == 1:
+            length, pos = read_uint(self.data, pos)
+            s = self.data[pos:pos + length].decode('utf-8')
+            self.strings.append(s)
+
+            return s, pos + length
+        else:
+            return self.strings[n - 2], pos
+
+    def read_shape(self, pos):
+        n, pos = read_uint(self.data, pos)
+
+        if n:
+            return self.shapes[n - 1], pos
+
+        name, pos = self.read_str(pos)
+        cls = getattr(ksp_ast, name, None)
+
+        if not (isinstance(cls, type) and issubclass(cls, ksp_ast.ASTNode)):
+            raise ValueError('Unknown AST node class: %s' % name)
+
+        count, pos = read_uint(self.data, pos)
+        names = []
+
+        for i in range(count):
+            attribute, pos = self.read_str(pos)
+            names.append(attribute)
+
+        self.shapes.append((cls, names))
+
+        return (cls, names), pos
+
+    def read(self):
+        # reading creates many objects that all stay alive, so the garbage collector would only waste time looking at them
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+
+        try:
+            return self.read_value()
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def read_value(self):
+        data = self.data
+        pos = self.pos
+        strings = self.strings
+        objects = self.objects
+        stack = []   # containers being read: [tag, values read so far, number of values still missing, extra information]
+
+        while True:
+            tag = data[pos]
+            pos += 1
+
+            if tag == STR:
+                n = data[pos]
+
+                if 1 < n < 0x80:
+                    value = strings[n - 2]
+                    pos += 1
+                else:
+                    value, pos = self.read_str(pos)
+            elif tag == REF:
+                n, pos = read_uint(data, pos)
+                value = objects[n]
+            elif tag == NODE:
+                (cls, names), pos = self.read_shape(pos)
+                node = cls.__new__(cls)
+                objects.append(node)
+
+                if names:
+                    stack.append([NODE, [], len(names), (node, names)])
+                    continue
+
+                value = node
+            elif tag == INT:
+                n, pos = read_uint(data, pos)
+                value = unzigzag(n)
+            elif tag == LIST or tag == TUPLE or tag == DICT or tag == SET:
+                count, pos = read_uint(data, pos)
+
+                if count:
+                    stack.append([tag, [], count * 2 if tag == DICT else count, None])
+                    continue
+
+                value = [] if tag == LIST else () if tag == TUPLE else {} if tag == DICT else set()
+            elif tag == LEXINFO:
+                filename, pos = self.read_str(pos)
+                lineno, pos = read_uint(data, pos)
+                stack.append([LEXINFO, [filename, unzigzag(lineno)], 2, None])
+                continue
+            elif tag == NONE:
+                value = None
+            elif tag == TRUE:
+                value = True
+            elif tag == FALSE:
+                value = False
+            elif tag == LINE:
+                line = Line.__new__(Line)
+                objects.append(line)
+                line.command, pos = self.read_str(pos)
+                count, pos = read_uint(data, pos)
+                line.locations = []
+
+                for i in range(count):
+                    filename, pos = self.read_str(pos)
+                    lineno, pos = read_uint(data, pos)
+                    line.locations.append((filename, unzigzag(lineno)))
+
+                line.placeholders = self.placeholders
+                stack.append([LINE, [], 3, line])
+                continue
+            elif tag == FLOAT:
+                value = float_struct.unpack_from(data, pos)[0]
+                pos += float_struct.size
+            elif tag == DECIMAL:
+                s, pos = self.read_str(pos)
+                value = Decimal(s)
+            else:
+                raise ValueError('Invalid data: unknown tag %d at position %d' % (tag, pos - 1))
+
+            # hand the value to the innermost container, completing as many containers as possible
+            while stack:
+                frame = stack[-1]
+                frame[1].append(value)
+                frame[2] -= 1
+
+                if frame[2]:
+                    break
+
+                stack.pop()
+                tag, items = frame[0], frame[1]
+
+                if tag == NODE:
+                    value, names = frame[3]
+                    value.__dict__.update(zip(names, items))
+                elif tag == LIST:
+                    value = items
+                elif tag == TUPLE or tag == LEXINFO:
+                    value = tuple(items)
+                elif tag == LINE:
+                    value = frame[3]
+                    value.namespaces, value.source_locations, value.calling_lines = items
+                elif tag == DICT:
+                    value = dict(zip(items[0::2], items[1::2]))
+                else:
+                    value = set(items)
+            else:
+                self.pos = pos
+                return value
+
+
+def write_header(writer, kind):
+    writer.out += MAGIC
+    writer.out.append(FORMAT_VERSION)
+    writer.out.append(kind)
+
+def read_header(reader, kind):
+    data = reader.data
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not serialised compiler data')
+
+    version, data_kind = data[len(MAGIC)], data[len(MAGIC) + 1]
+
+    if version != FORMAT_VERSION:
+        raise ValueError('Serialised with format version %d, but version %d is needed' % (version, FORMAT_VERSION))
+
+    if data_kind != kind:
+        raise ValueError('Serialised data is of the wrong kind')
+
+    reader.pos = len(MAGIC) + 2
+
+def dump_lines(lines, placeholders):
+    '''Returns the serialised form of a list or deque of Line objects, together with the strings of their placeholder table'''
+    writer = Writer()
+    write_header(writer, KIND_LINES)
+    writer.write(list(placeholders.strings))
+    writer.write(list(lines))
+
+    return writer.getvalue()
+
+def load_lines(data, placeholders = None):
+    '''Returns a deque of the lines serialised by dump_lines and their placeholder table. The strings are loaded into
+       placeholders if it is given (replacing its contents), otherwise into a new PlaceholderTable.'''
+    if placeholders is None:
+        placeholders = PlaceholderTable()
+
+    reader = Reader(data, placeholders)
+    read_header(reader, KIND_LINES)
+
+    placeholders.clear()
+
+    for s in reader.read():
+        placeholders.add(s)
+
+    return collections.deque(reader.read()), placeholders
+
+def dump_module(module):
+    '''Returns the serialised form of an AST (usually a ksp_ast.Module)'''
+    writer = Writer()
+    write_header(writer, KIND_MODULE)
+    writer.write(module)
+
+    return writer.getvalue()
+
+def load_module(data):
+    reader = Reader(data)
+    read_header(reader, KIND_MODULE)
+
+    return reader.read()
@@ -3,6 +3,8 @@
 # divide that Kontakt will understand. This means there are no floating point
 # numbers.
 # Exceptions have been removed, to be handled by the compiler instead.
+# MemoizedSimpleEval has been added, which caches parsed expressions and their
+# results, since the compiler evaluates the same expressions over and over.
 
 '''
 SimpleEval - (C) 2013/2015 Daniel Fairhead
@@ -85,9 +87,11 @@ well:
 '''
 
 import ast
+import re
 import sys
 import math
 import operator as op
+from collections import OrderedDict
 from random import random
 
 ########################################
@@ -296,6 +300,96 @@ class SimpleEval(object): # pylint: disable=too-few-public-methods
             raise FeatureNotAvailable("Sorry, {0} is not available in this "
                                       "evaluator".format(type(node).__name__ ))
 
+class MemoizedSimpleEval(SimpleEval):
+    ''' SimpleEval which remembers the parsed tree and the result of the
+        most recently used expressions (at most max_entries of them).
+        Expressions calling one of the nondeterministic_functions only
+        have their tree cached. Plain integer literals never reach ast.
+        Failed evaluations are remembered as well and raise the same
+        exception again. Call clear() after changing operators, functions
+        or names. '''
+
+    integer_literal_re = re.compile(r'(?:0|[1-9][0-9]*)$')
+
+    def __init__(self, operators=None, functions=None, names=None,
+                 max_entries=4096, nondeterministic_functions=("rand", "randint")):
+        super(MemoizedSimpleEval, self).__init__(operators, functions, names)
+
+        self.max_entries = max_entries
+        self.nondeterministic_functions = set(nondeterministic_functions)
+        self.entries = OrderedDict()    # expression -> (tree or None, is_deterministic, result, exception)
+        self.hits = 0
+        self.misses = 0
+        self.literals = 0
+
+    blanks_re = re.compile(r'[ \t]+')
+
+    def normalise(self, expr):
+        ''' collapse runs of spaces and tabs, which never change the result
+            (unless they are part of a string) '''
+        if '"' in expr or "'" in expr:
+            return expr
+
+        return self.blanks_re.sub(' ', expr)
+
+    def is_deterministic(self, tree):
+        return not any(isinstance(node, ast.Call) and
+                       getattr(node.func, 'id', None) in self.nondeterministic_functions
+                       for node in ast.walk(tree))
+
+    def eval(self, expr):
+        key = self.normalise(expr)
+
+        if self.integer_literal_re.match(key):
+            self.literals += 1
+            return int(key)
+
+        self.expr = expr
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+
+            try:
+                tree = ast.parse(key).body[0].value
+                entry = (tree, self.is_deterministic(tree), None, None)
+            except Exception as e: # pylint: disable=broad-except
+                entry = (None, True, None, e)
+
+            if entry[1] and entry[3] is None:
+                try:
+                    entry = (tree, True, self._eval(tree), None)
+                except Exception as e: # pylint: disable=broad-except
+                    entry = (tree, True, None, e)
+
+            self.entries[key] = entry
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        tree, deterministic, result, exception = entry
+
+        if exception is not None:
+            raise exception.with_traceback(None)
+
+        if not deterministic:
+            return self._eval(tree)
+
+        return result
+
+    def stats(self):
+        ''' returns a dictionary with the number of evaluations answered
+            from the cache, evaluated from scratch and integer literals '''
+        return {'hits': self.hits, 'misses': self.misses,
+                'literals': self.literals, 'entries': len(self.entries)}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.literals = 0
+
 def simple_eval(expr, operators=None, functions=None, names=None):
     ''' Simply evaluate an expresssion '''
     s = SimpleEval(operators=operators,
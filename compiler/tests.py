@@ -12,9 +12,24 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-from ksp_compiler import ParseException, KSPCompiler
+from ksp_compiler import ParseException, KSPCompiler, ImportCache, IncrementalCache, PythonReadCache, PlaceholderTable
+import batch_compiler
+import ksp_compiler
+from file_watcher import FileWatcher
+from compiled_output import write_compiled_code
+from compile_cache import CompileCache
+import serialization
+import optimizer
+from ksp_interpreter import KSPInterpreter, KSPRuntimeError, CostModel, Event
+from call_graph import CallGraph
+from name_compaction import NameCompactionMap, compress_variable_name, reverse_map_path, output_reverse_map_path, load_reverse_map
+from simple_eval import MemoizedSimpleEval
 import os.path
+import tempfile
+import time
 import unittest
+from unittest import mock
+from io import StringIO
 
 # To use cmd line: python -m unittest
 # To test classes: python -m unittest -k Callbacks
@@ -2177,7 +2192,7 @@ class TestTaskfunc(unittest.TestCase):
             declare %tstate__fs[326]
             $tx := 0
             while ($tx<326)
-            %tstate__fs[$tx] := 168+($tx*100)
+            %tstate__fs[$tx] := 168+$tx*100
             inc($tx)
             end while
             $tx := 0
@@ -2186,7 +2201,7 @@ class TestTaskfunc(unittest.TestCase):
             declare $x
             end on
             function check_full
-            if ($sp<(%tstate__fs[$tx]+2))
+            if ($sp<%tstate__fs[$tx]+2)
             pgs_set_key_val(TCM_EXCEPTION,$CURRENT_SCRIPT_SLOT,2)
             end if
             end function
@@ -2197,9 +2212,8 @@ class TestTaskfunc(unittest.TestCase):
             call check_full
             %p[$fp+1] := random(%p[$fp+2],%p[$fp+3])
             %p[$fp+4] := %p[$fp+1]
-            $sp := $fp
+            $sp := $fp+5
             $fp := %p[$fp]
-            $sp := $sp+5
             end function
             on note
             %p[$sp-3] := 44
@@ -2243,7 +2257,7 @@ class TestTaskfunc(unittest.TestCase):
             declare %tstate__fs[326]
             $tx := 0
             while ($tx<326)
-            %tstate__fs[$tx] := 168+($tx*100)
+            %tstate__fs[$tx] := 168+$tx*100
             inc($tx)
             end while
             $tx := 0
@@ -2252,7 +2266,7 @@ class TestTaskfunc(unittest.TestCase):
             declare $x
             end on
             function check_full
-            if ($sp<(%tstate__fs[$tx]+2))
+            if ($sp<%tstate__fs[$tx]+2)
             pgs_set_key_val(TCM_EXCEPTION,$CURRENT_SCRIPT_SLOT,2)
             end if
             end function
@@ -2263,9 +2277,8 @@ class TestTaskfunc(unittest.TestCase):
             call check_full
             %p[$fp+1] := random(%p[$fp+2],%p[$fp+3])
             %p[$fp+4] := %p[$fp+1]
-            $sp := $fp
+            $sp := $fp+5
             $fp := %p[$fp]
-            $sp := $sp+5
             end function
             on note
             %p[$sp-3] := 44
@@ -2310,7 +2323,7 @@ class TestTaskfunc(unittest.TestCase):
             declare %tstate__fs[326]
             $tx := 0
             while ($tx<326)
-            %tstate__fs[$tx] := 168+($tx*100)
+            %tstate__fs[$tx] := 168+$tx*100
             inc($tx)
             end while
             $tx := 0
@@ -2332,7 +2345,7 @@ class TestTaskfunc(unittest.TestCase):
             $fp := %tstate__fs[$tx]+100
             %p[$fp-1] := %p[$sp-1]
             $sp := $fp
-            wait(%p[$sp-1])
+            wait(%p[$fp-1])
             %tstate__id[$tx] := 0
             $tx := search(%tstate__id,$NI_CALLBACK_ID)
             %tstate__id[$tx] := -1
@@ -2345,12 +2358,11 @@ class TestTaskfunc(unittest.TestCase):
             $fp := $sp-5
             $sp := $fp
             %p[$fp+1] := random(%p[$fp+2],%p[$fp+3])
-            %p[$sp-1] := 1000
+            %p[$fp-1] := 1000
             call _twait
             %p[$fp+4] := %p[$fp+1]
-            $sp := $fp
+            $sp := $fp+5
             $fp := %p[$fp]
-            $sp := $sp+5
             end function
             on note
             %p[$sp-3] := 44
@@ -2432,6 +2444,130 @@ class TestTaskfunc(unittest.TestCase):
 
         self.assertRaises(ParseException, do_compile, code, optimize = True)
 
+    def function_lines(self, output, name):
+        lines = [l.strip() for l in output.split('\n') if l]
+        start = lines.index('function %s' % name)
+
+        return lines[start + 1:lines.index('end function', start)]
+
+    def testVarParameterCopiedBackOnlyIfChanged(self):
+        code = '''
+            on init
+              tcm.init(100)
+              declare x
+            end on
+
+            taskfunc show(var value)
+              message("value: " & value)
+            end taskfunc
+
+            taskfunc bump(var value)
+              value := value + 1
+            end taskfunc
+
+            taskfunc outer(var total)
+              declare n := 5
+              show(n)
+              show(total)
+              bump(n)
+              show(x)
+              total := n
+            end taskfunc
+
+            on note
+              outer(x)
+            end on'''
+
+        expected_output = '''
+            %p[$sp-3] := $fp
+            $fp := $sp-3
+            $sp := $fp
+            %p[$fp+1] := 5
+            %p[$sp-1] := %p[$fp+1]
+            call show
+            %p[$sp-1] := %p[$fp+2]
+            call show
+            %p[$sp-1] := %p[$fp+1]
+            call bump
+            %p[$fp+1] := %p[$sp-1]
+            %p[$sp-1] := $x
+            call show
+            $x := %p[$sp-1]
+            %p[$fp+2] := %p[$fp+1]
+            $sp := $fp+3
+            $fp := %p[$fp]'''
+
+        # the frame slots of outer cannot change while show runs, but x is global and still needs to be copied back
+        assert_equal(self, '\n'.join(self.function_lines(do_compile(code), 'outer')), expected_output)
+
+    def testOutputsNeverReadAreNotCopiedBack(self):
+        code = '''
+            on init
+              tcm.init(100)
+              declare x
+            end on
+
+            taskfunc get(out value)
+              value := 5
+            end taskfunc
+
+            taskfunc outer(out result)
+              declare n
+              declare m
+              get(n)
+              get(m)
+              get(result)
+              message(m)
+            end taskfunc
+
+            on note
+              outer(x)
+            end on'''
+
+        expected_output = '''
+            %p[$sp-4] := $fp
+            $fp := $sp-4
+            $sp := $fp
+            call get
+            call get
+            %p[$fp+2] := %p[$sp-1]
+            call get
+            %p[$fp+3] := %p[$sp-1]
+            message(%p[$fp+2])
+            $sp := $fp+4
+            $fp := %p[$fp]'''
+
+        # n is never read, but m is read afterwards and result is read by the caller of outer
+        assert_equal(self, '\n'.join(self.function_lines(do_compile(code, optimize = True), 'outer')), expected_output)
+
+    def testFrameAddressesHoistedOutOfLoops(self):
+        code = '''
+            on init
+              tcm.init(100)
+              declare %values[100]
+            end on
+
+            taskfunc fill(count, start)
+              declare i
+              i := 0
+              while i < count
+                values[i] := start + i * 2
+                inc(i)
+              end while
+            end taskfunc
+
+            on note
+              fill(10, 5)
+              message(values[3])
+            end on'''
+
+        lines = self.function_lines(do_compile(code, optimize = True), 'fill')
+        loop = lines.index('while (%p[$_inv1]<%p[$_inv2])')
+
+        self.assertIn('$_inv1 := $fp+1', lines[:loop])
+        self.assertIn('$_inv2 := $fp+2', lines[:loop])
+        self.assertEqual(lines[-2:], ['$sp := $fp+4', '$fp := %p[$fp]'])
+
 class K5_6Features(unittest.TestCase):
     def testDeclaration(self):
         code = '''
@@ -2572,5 +2708,1868 @@ class K5_6Features(unittest.TestCase):
         output = do_compile(code, extra_syntax_checks = True, optimize = True)
         assert_equal(self, output, expected_output)
 
+class BatchCompiling(unittest.TestCase):
+    code = '''
+        import "test_imports/ui_cb_test_import.ksp" as f
+
+        on init
+            declare ui_switch mySwitch
+            message(f.mySwitch)
+        end on'''
+
+    def testImportCacheGivesSameOutput(self):
+        cache = ImportCache()
+        outputs = []
+
+        for i in range(2):
+            compiler = KSPCompiler(self.code, os.path.dirname(__file__), import_cache = cache, add_compiled_date_comment = False)
+            compiler.compile()
+            outputs.append(compiler.compiled_code)
+
+        # main script and imported file are each parsed once
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(outputs[0], outputs[1])
+        assert_equal(self, outputs[1], do_compile(self.code, compact = False, combine_callbacks = False))
+
+    def testBatchReportsResultsInJobOrder(self):
+        basedir = os.path.dirname(__file__)
+        broken = '''
+            on init
+                declare x
+                x := y
+            end on'''
+        jobs = [batch_compiler.CompileJob(self.code, basedir, 'first.ksp', dict(add_compiled_date_comment = False)),
+                batch_compiler.CompileJob(broken, basedir, 'second.ksp')]
+        progress = []
+
+        results = batch_compiler.BatchCompiler(jobs).run(lambda result, num_done, num_total: progress.append((result.filename, num_done, num_total)))
+
+        self.assertEqual(progress, [('first.ksp', 1, 2), ('second.ksp', 2, 2)])
+        self.assertTrue(results[0].success)
+        assert_equal(self, results[0].compiled_code, do_compile(self.code, compact = False, combine_callbacks = False))
+        self.assertFalse(results[1].success)
+        self.assertEqual(results[1].error_filename, 'second.ksp')
+        self.assertEqual(results[1].error_lineno, 3)
+
+
+class IncrementalCompiling(unittest.TestCase):
+    code = '''
+        macro declare_pair(#name#)
+            declare #name#_a := 1
+            declare #name#_b := #name#_a + NUM
+        end macro
+
+        on init
+            define NUM := 4
+            declare_pair(x)
+            declare_pair(y)
+            message(x_b + y_b)
+        end on'''
+
+    def compile(self, code, cache):
+        compiler = KSPCompiler(code, os.path.dirname(__file__), incremental_cache = cache)
+        compiler.compile()
+
+        return compiler.compiled_code
+
+    def testRecompileReusesMacroExpansions(self):
+        cache = IncrementalCache()
+        self.compile(self.code, cache)
+        edited = self.code.replace('message(x_b + y_b)', 'message(x_b - y_b)')
+
+        assert_equal(self, self.compile(edited, cache), do_compile(edited, compact = False, combine_callbacks = False))
+        self.assertEqual(cache.expansion_cache.hits, 2)
+        self.assertEqual(cache.changed_files, set([None]))
+
+    def testHitsCountedPerCompilation(self):
+        cache = IncrementalCache()
+
+        for i in range(3):
+            self.compile(self.code, cache)
+
+        self.assertEqual(cache.expansion_cache.hits, 2)
+
+        # a saved cache starts counting from zero again as well
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'cache')
+            cache.save(path)
+            cache = IncrementalCache.load(path)
+            self.compile(self.code, cache)
+
+        self.assertEqual(cache.expansion_cache.hits, 2)
+
+    def testChangedDefineIsNotReused(self):
+        cache = IncrementalCache()
+        self.compile(self.code, cache)
+        edited = self.code.replace('define NUM := 4', 'define NUM := 5')
+
+        assert_equal(self, self.compile(edited, cache), do_compile(edited, compact = False, combine_callbacks = False))
+        self.assertEqual(cache.expansion_cache.hits, 0)
+
+    def testErrorLocationAfterMovingMacro(self):
+        cache = IncrementalCache()
+        code = self.code.replace('#name#_a + NUM', '#name#_a + NUM + undeclared')
+
+        with self.assertRaises(ParseException) as context:
+            self.compile(code, cache)
+
+        self.assertEqual(context.exception.line.lineno, 4)
+
+        # the expansions are reused, but the error has to point at the moved macro line
+        with self.assertRaises(ParseException) as context:
+            self.compile('\n\n' + code, cache)
+
+        self.assertEqual(context.exception.line.lineno, 6)
+        self.assertEqual(cache.expansion_cache.hits, 2)
+
+    def testDependencyGraph(self):
+        cache = IncrementalCache()
+        code = '''
+            import "test_imports/ui_cb_test_import.ksp" as f
+
+            on init
+                declare_pair(x)
+            end on
+
+            macro declare_pair(#name#)
+                declare #name#_a := 1
+            end macro'''
+
+        self.compile(code, cache)
+        graph = cache.dependency_graph
+        imported = os.path.abspath(os.path.join(os.path.dirname(__file__), 'test_imports/ui_cb_test_import.ksp'))
+
+        self.assertEqual(graph.imports[None], [imported])
+        self.assertEqual(graph.macro_uses['declare_pair__1'], set([(None, 5)]))
+        self.assertEqual(graph.affected_files([imported]), set([imported, None]))
+
+
+class FileWatching(unittest.TestCase):
+    def testBurstOfChangesIsReportedOnce(self):
+        with tempfile.TemporaryDirectory() as folder:
+            main = os.path.join(folder, 'main.ksp')
+            added = os.path.join(folder, 'lib', 'added.ksp')
+
+            def write(path, text):
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+
+                with open(path, 'w') as f:
+                    f.write(text)
+
+            write(main, 'on init\nend on')
+
+            watcher = FileWatcher(poll_interval = 0.01, settle_time = 0.02)
+            watcher.watch([main], [folder])
+
+            # each simulated sleep is followed by one more save
+            edits = [lambda: write(main, 'on init\n  message(1)\nend on'), lambda: write(added, 'macro m\nend macro')]
+
+            def sleep(seconds):
+                if edits:
+                    edits.pop(0)()
+
+            self.assertEqual(watcher.wait_for_change(sleep), sorted([main, added]))
+            self.assertEqual(watcher.poll(), [])
+
+
+class PythonBlocks(unittest.TestCase):
+    def compile(self, code, basedir, read_cache = None):
+        compiler = KSPCompiler(code, basedir, python_read_cache = read_cache)
+        compiler.compile()
+
+        return compiler.compiled_code
+
+    def testRunBlocksBeforeReadBlocks(self):
+        code = '''
+            run<<
+            x = 5
+            >>
+            on init
+                declare a := read<<x * 2>>
+                declare b := read<<x + 1>>
+            end on
+            run<<
+            x = 7
+            >>'''
+
+        expected_output = '''
+            on init
+            declare $a := 14
+            declare $b := 8
+            end on'''
+
+        output = do_compile(code, remove_preprocessor_vars = True)
+        assert_equal(self, output, expected_output)
+
+    def testReadWithRelativePathAndMemoisation(self):
+        code = '''
+            run<<
+            def read_value():
+                with open('value.txt') as f:
+                    return f.read()
+            >>
+            on init
+                declare a := read<<read_value()>>
+            end on'''
+
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'value.txt'), 'w') as f:
+                f.write('42')
+
+            cache = PythonReadCache()
+            cwd = os.getcwd()
+
+            self.assertIn('declare $a := 42', self.compile(code, folder, cache))
+            self.assertIn('declare $a := 42', self.compile(code, folder, cache))
+            self.assertEqual(os.getcwd(), cwd)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            with open(os.path.join(folder, 'value.txt'), 'w') as f:
+                f.write('123')
+
+            os.utime(os.path.join(folder, 'value.txt'), ns = (0, 0))
+
+            self.assertIn('declare $a := 123', self.compile(code, folder, cache))
+            self.assertEqual(cache.misses, 2)
+
+
+    def testRelativePathsInOsAndGlobFunctions(self):
+        code = '''
+            run<<
+            import os
+            from os.path import isfile
+            num_files = len([name for name in os.listdir('.') if name == 'data.txt'])
+            >>
+            on init
+                declare a := read<<num_files>>
+                declare b := read<<1 if os.path.exists('data.txt') and isfile('data.txt') else 0>>
+                declare c := read<<len(glob.glob('*.txt'))>>
+            end on'''
+
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'data.txt'), 'w') as f:
+                f.write('1')
+
+            cwd = os.getcwd()
+            output = self.compile(code, folder)
+
+            self.assertIn('declare $a := 1', output)
+            self.assertIn('declare $b := 1', output)
+            self.assertIn('declare $c := 1', output)
+            self.assertEqual(os.getcwd(), cwd)
+
+class Placeholders(unittest.TestCase):
+    def testIdenticalStringsShareOnePlaceholder(self):
+        table = PlaceholderTable()
+        first = table.add('"abc"')
+
+        self.assertEqual(table.add('"def"'), first + 1)
+        self.assertEqual(table.add('"abc"'), first)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.replace_all('message({0} & {1} & {0})'), 'message("abc" & "def" & "abc")')
+
+    def testStringsInMacroIterationsAreResolved(self):
+        code = '''
+            macro show(#n#)
+                message("value #n#" & 'x')
+            end macro
+
+            on init
+                iterate_macro(show) := 1 to 3
+                message("value 1" & 'x')
+            end on'''
+
+        expected_output = '''
+            on init
+            message("value 1" & "x")
+            message("value 2" & "x")
+            message("value 3" & "x")
+            message("value 1" & "x")
+            end on'''
+
+        output = do_compile(code, remove_preprocessor_vars = True)
+        assert_equal(self, output, expected_output)
+
+
+class ExpressionEvaluator(unittest.TestCase):
+    def testResultsAreCached(self):
+        evaluator = MemoizedSimpleEval()
+
+        self.assertEqual(evaluator.eval('3 * 4'), 12)
+        self.assertEqual(evaluator.eval('3  *   4'), 12)
+        self.assertEqual(evaluator.eval('7 / 2'), 3)
+        self.assertEqual(evaluator.eval('42'), 42)
+        self.assertEqual(evaluator.stats(), {'hits': 1, 'misses': 2, 'literals': 1, 'entries': 2})
+
+    def testErrorsAreCached(self):
+        evaluator = MemoizedSimpleEval()
+
+        for i in range(2):
+            self.assertRaises(SyntaxError, evaluator.eval, '007')
+            self.assertRaises(Exception, evaluator.eval, '$x + 1')
+
+        self.assertEqual(evaluator.hits, 2)
+
+    def testRandomIsNotCached(self):
+        evaluator = MemoizedSimpleEval()
+        values = set(evaluator.eval('randint(1000000)') for i in range(10))
+
+        self.assertGreater(len(values), 1)
+
+    def testCompilerStats(self):
+        code = '''
+            define NUM := 4
+            macro show(#n#)
+                message(#n#)
+            end macro
+
+            on init
+                iterate_macro(show) := 1 to NUM * 2
+            end on'''
+
+        compiler = KSPCompiler(code, os.path.dirname(__file__))
+        compiler.compile()
+
+        self.assertGreater(compiler.stats['evaluated expressions'], 0)
+        self.assertIn('expression cache hit rate', compiler.stats)
+
+
+class MultidimensionalArrays(unittest.TestCase):
+    code = '''
+        on init
+            declare grid[4, 5]
+            declare $i
+            grid[1, 2] := 3
+            $i := grid[3, 4] + grid[0, 1]
+            clear_row(grid)
+        end on
+
+        function clear_row(g)
+            g[0, 0] := 0
+        end function
+        '''
+
+    def testAccessesAreLoweredToFlatIndex(self):
+        output = do_compile(self.code)
+        self.assertIn('%_grid[5*1+2] := 3', output)
+        self.assertIn('$i := %_grid[5*3+4]+%_grid[5*0+1]', output)
+        self.assertIn('%_grid[5*0+0] := 0', output)
+
+    def testPropertyFunctionsOnlyInlinedForIndirectAccess(self):
+        do_compile(self.code)
+        self.assertIn('grid', ksp_compiler.multidimensional_arrays)
+        # only the access through the function parameter still goes through the set function of the property
+        self.assertEqual(ksp_compiler.call_graph.multiplicity(None, 'grid.set'), 1)
+        self.assertNotIn('grid.get', ksp_compiler.call_graph)
+
+class PrefixResolution(unittest.TestCase):
+    def testIndex(self):
+        index = ksp_compiler.PrefixIndex()
+        index.add_variable('%Notes')
+        index.add_variable('$notes')
+        index.add_name('play', 'function')
+        self.assertEqual(index.resolve('NOTES'), (None, ('$', '%')))
+        self.assertEqual(index.resolve('play'), ('function', ()))
+        self.assertEqual(index.resolve('EVENT_ID'), (None, ('$',)))
+        self.assertEqual(index.resolve('event_id'), (None, ()))   # builtins are case sensitive
+        self.assertEqual(index.resolve('message'), ('builtin', ()))
+        self.assertEqual(index.resolve('undeclared'), (None, ()))
+
+    def testVariablesAddedAfterLookup(self):
+        index = ksp_compiler.PrefixIndex()
+        self.assertEqual(index.resolve('x'), (None, ()))
+        index.add_variable('@x')
+        self.assertEqual(index.resolve('x'), (None, ('@',)))
+
+    def testAmbiguousName(self):
+        code = '''
+            on init
+                declare $value
+                declare @value
+                message(value)
+            end on
+            '''
+        self.assertRaisesRegex(ParseException, r'ambigious! Variable prefix could be any of the following: \$, @', do_compile, code)
+
+class CallGraphTests(unittest.TestCase):
+    def testEdgesAreCountedOnce(self):
+        graph = CallGraph()
+        graph.add_edge(None, 'foo')
+        graph.add_edge(None, 'bar')
+        graph.add_edge(None, 'foo')
+        self.assertEqual(graph.successors(None), ['bar', 'foo'])
+        self.assertEqual(graph.multiplicity(None, 'foo'), 2)
+        self.assertEqual(graph.nodes(), [None, 'bar', 'foo'])
+
+    def testLongCallChain(self):
+        graph = CallGraph()
+
+        for i in range(5000):
+            graph.add_edge('f%d' % i, 'f%d' % (i + 1))
+
+        self.assertEqual(len(graph.reachable(['f0'])), 5001)
+        self.assertEqual(graph.find_cycles(), [])
+        self.assertEqual(graph.topological_sort()[:2], ['f0', 'f1'])
+
+    def testAllCyclesAreReported(self):
+        graph = CallGraph()
+        graph.add_edge(None, 'a')
+        graph.add_edge('a', 'b')
+        graph.add_edge('b', 'c')
+        graph.add_edge('c', 'a')
+        graph.add_edge('d', 'd')
+        self.assertEqual(graph.find_cycles(), [['a', 'b', 'c', 'a'], ['d', 'd']])
+
+    def testRecursionUsingCall(self):
+        code = '''
+            on init
+                declare $x
+            end on
+
+            function foo
+                call bar
+            end function
+
+            function bar
+                call foo
+            end function
+
+            on note
+                call foo
+            end on
+            '''
+        self.assertRaisesRegex(Exception, 'Recursion detected! bar->foo->bar', do_compile, code)
+
+class DeepNesting(unittest.TestCase):
+    def testLongElseIfChain(self):
+        num_arms = 1500
+        code = ['on init', 'declare $x', 'end on', 'on note', 'if ($x = 0)', '$x := 1']
+
+        for i in range(1, num_arms):
+            code += ['else if ($x = %d)' % i, '$x := %d' % (i + 1)]
+
+        code += ['else', '$x := 0', 'end if', 'end on']
+
+        output = do_compile('\n'.join(code))
+        self.assertEqual(output.count('end if'), num_arms)
+        self.assertEqual(output.count('else'), num_arms)
+        self.assertIn('if ($x=1499)\n$x := 1500\nelse\n$x := 0\nend if', output)
+
+    def testDeeplyNestedStatements(self):
+        depth = 500
+        code = ['on init', 'declare $x', 'end on', 'on note']
+        code += ['if ($x < %d)' % i if i % 2 == 0 else 'while ($x < %d)' % i for i in range(depth)]
+        code += ['inc($x)']
+        code += ['end if' if i % 2 == 0 else 'end while' for i in reversed(range(depth))]
+        code += ['end on']
+
+        output = do_compile('\n'.join(code), compact = False)
+        self.assertIn(' ' * (2 * depth + 2) + 'inc($x)', output)
+        self.assertEqual(output.count('end while'), depth // 2)
+
+    def testGeneratorModifyMethods(self):
+        class AddOne(ksp_compiler.ksp_ast_processing.ASTModifier):
+            def modifyInteger(self, node):
+                return ksp_compiler.ksp_ast.Integer(node.lexinfo, node.value + 1)
+
+            def modifyIfStmt(self, node):
+                # keep only the first branch of every if-statement
+                condition, stmts = node.condition_stmts_tuples[0]
+                condition = yield (condition, (), {})
+                stmts = ksp_compiler.flatten((yield from self._modify_list(stmts, (), {})))
+                node.condition_stmts_tuples = [(condition, stmts)]
+
+                return [node]
+
+        li = ('test', 1, [], None)
+        ast = ksp_compiler.ksp_ast
+        message = lambda value: ast.FunctionCall(li, ast.ID(li, 'message'), [ast.Integer(li, value)], is_procedure = True)
+        inner_if = ast.IfStmt(li, [(ast.BinOp(li, ast.Integer(li, 3), '=', ast.Integer(li, 4)), [message(5)]), (None, [message(6)])])
+        outer_if = ast.IfStmt(li, [(ast.BinOp(li, ast.Integer(li, 1), '=', ast.Integer(li, 2)), [inner_if])])
+        module = ast.Module(li, [ast.Callback(li, 'init', lines = [outer_if])])
+
+        AddOne().traverse(module)
+        self.assertEqual(outer_if.condition_stmts_tuples[0][0].left.value, 2)
+        self.assertEqual(inner_if.condition_stmts_tuples[0][0].right.value, 5)
+        self.assertEqual(len(inner_if.condition_stmts_tuples), 1)
+        self.assertEqual(inner_if.condition_stmts_tuples[0][1][0].parameters[0].value, 6)
+
+class PersistentNameCompaction(unittest.TestCase):
+    def compile(self, code, map_file):
+        compiler = KSPCompiler(code, os.path.dirname(__file__), compact = True, compact_variables = True, compaction_map_file = map_file)
+        compiler.compile()
+
+        return compiler
+
+    def testNamesStayTheSameAcrossBuilds(self):
+        with tempfile.TemporaryDirectory() as folder:
+            map_file = os.path.join(folder, 'names.json')
+
+            first = self.compile('on init\n declare $alpha := 1\n declare $beta := 2\nend on', map_file)
+            second = self.compile('on init\n declare $gamma := 3\n declare $beta := 2\n declare $alpha := 1\nend on', map_file)
+
+            self.assertEqual(second.original2short['$alpha'], first.original2short['$alpha'])
+            self.assertEqual(second.original2short['$beta'], first.original2short['$beta'])
+            self.assertEqual(second.stats['newly compacted names'], 1)
+            self.assertIn('$gamma', second.original2short)
+
+    def testReverseMap(self):
+        with tempfile.TemporaryDirectory() as folder:
+            map_file = os.path.join(folder, 'names.json')
+            compiler = self.compile('on init\n declare $alpha := 1\n message($alpha)\nend on', map_file)
+            short2original = load_reverse_map(reverse_map_path(map_file))
+
+            self.assertIn('$alpha', ksp_compiler.uncompress_variable_names(compiler.compiled_code, short2original))
+            self.assertEqual(short2original, compiler.short2original)
+            self.assertEqual(load_reverse_map(os.path.join(folder, 'missing.json')), {})
+
+    def testCollisionsAreResolvedDeterministically(self):
+        names_map = NameCompactionMap()
+        taken = '$' + compress_variable_name('$alpha')
+        names_map.add_names(['$alpha', '$beta'], reserved = set([taken]))
+
+        self.assertNotEqual(names_map.original2short['$alpha'], taken)
+        self.assertEqual(names_map.original2short['$alpha'], '$' + compress_variable_name('$alpha', 1))
+        self.assertEqual(names_map.original2short['$beta'], '$' + compress_variable_name('$beta'))
+        self.assertEqual(names_map.collisions, 1)
+
+        other_map = NameCompactionMap()
+        other_map.add_names(['$beta', '$alpha'], reserved = set([taken]))
+        self.assertEqual(other_map.original2short, names_map.original2short)
+
+class ShortestNames(unittest.TestCase):
+    code = '''
+        on init
+            declare $rarely_used
+            declare %often_used[3] := (1, 2, 3)
+            declare ui_knob $knob (0, 100, 1)
+            {#pragma preserve_names knob}
+            %often_used[0] := %often_used[1] + %often_used[2]
+            $knob := %often_used[0]
+        end on
+        function a
+            $rarely_used := 1
+        end function
+        on note
+            call a
+        end on'''
+
+    def compile(self, shortest_names):
+        compiler = KSPCompiler(self.code, os.path.dirname(__file__), compact = True, compact_variables = True, shortest_names = shortest_names)
+        compiler.compile()
+
+        return compiler
+
+    def testMostFrequentNameIsShortest(self):
+        compiler = self.compile(True)
+
+        # 'a' is taken by the function, so the most used variable gets the next name
+        self.assertEqual(compiler.original2short['%often_used'], '%b')
+        self.assertEqual(compiler.original2short['$rarely_used'], '$c')
+        self.assertIn('declare ui_knob $knob(0,100,1)', compiler.compiled_code)
+        self.assertIn('function a', compiler.compiled_code)
+
+    def testReportedSavings(self):
+        hashed = self.compile(False)
+        shortest = self.compile(True)
+
+        self.assertEqual(len(hashed.compiled_code) - len(shortest.compiled_code), shortest.stats['bytes saved compared to hashed names'])
+
+class CompiledOutput(unittest.TestCase):
+    def testUnchangedOutputIsNotRewritten(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'out.txt')
+
+            self.assertEqual(write_compiled_code([path], 'on init\nend on'), [(path, True)])
+            mtime = os.stat(path).st_mtime_ns
+            os.utime(path, ns = (mtime - 10**9, mtime - 10**9))
+
+            self.assertEqual(write_compiled_code([path], 'on init\nend on'), [(path, False)])
+            self.assertEqual(os.stat(path).st_mtime_ns, mtime - 10**9)
+
+            self.assertEqual(write_compiled_code([path], 'on init\n  message(1)\nend on'), [(path, True)])
+            self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def testDateCommentCanBeIgnored(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'out.txt')
+            write_compiled_code([path], '{ Compiled on Mon Jan  1 10:00:00 2024 }\non init\nend on')
+
+            self.assertEqual(write_compiled_code([path], '{ Compiled on Tue Jan  2 10:00:00 2024 }\non init\nend on', ignore_date_header = True), [(path, False)])
+            self.assertEqual(write_compiled_code([path], '{ Compiled on Tue Jan  2 10:00:00 2024 }\non init\nend on'), [(path, True)])
+
+            with open(path, 'r', encoding = 'latin-1') as f:
+                self.assertIn('Tue Jan  2', f.read())
+
+    def testReverseMapWrittenNextToOutput(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'out.txt')
+            compiler = KSPCompiler('on init\n  declare counter\n  message(counter)\nend on', folder, compact_variables = True)
+            compiler.compile()
+
+            write_compiled_code([path], compiler.compiled_code, short2original = compiler.short2original)
+            map_path = output_reverse_map_path(path)
+            self.assertEqual(map_path, os.path.join(folder, '.out.txt.kspnames.reverse.json'))
+
+            # the compiled code can be decoded with nothing but the file next to it
+            with open(path, 'r', encoding = 'latin-1') as f:
+                code = f.read()
+
+            self.assertIn('message($counter)', ksp_compiler.uncompress_variable_names(code, load_reverse_map(map_path)))
+            self.assertNotIn('$counter', code)
+
+            mtime = os.stat(map_path).st_mtime_ns
+            os.utime(map_path, ns = (mtime - 10**9, mtime - 10**9))
+            write_compiled_code([path], compiler.compiled_code, short2original = compiler.short2original)
+            self.assertEqual(os.stat(map_path).st_mtime_ns, mtime - 10**9)
+
+            # without compacted names no map is written
+            other = os.path.join(folder, 'other.txt')
+            write_compiled_code([other], 'on init\nend on', short2original = {})
+            self.assertFalse(os.path.exists(output_reverse_map_path(other)))
+
+class CompileCacheTests(unittest.TestCase):
+    def compile(self, folder, code, cache):
+        compiler = KSPCompiler(code, folder, compact = True, compile_cache = cache)
+        compiler.compile()
+
+        return compiler
+
+    def testHitsAndMisses(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = CompileCache(os.path.join(folder, 'cache'))
+            lib = os.path.join(folder, 'lib')
+            os.mkdir(lib)
+
+            with open(os.path.join(lib, 'a.ksp'), 'w') as f:
+                f.write('function foo\n  message(1)\nend function\n')
+
+            code = 'import "lib"\non init\n  foo\nend on'
+            first = self.compile(folder, code, cache)
+            self.assertEqual(first.stats['compile cache'], 'stored')
+
+            second = self.compile(folder, code, cache)
+            self.assertEqual(second.stats['compile cache'], 'hit')
+            self.assertEqual(second.compiled_code, first.compiled_code)
+            self.assertEqual(second.stats['compile fingerprint'], first.stats['compile fingerprint'])
+
+            # a different option, a changed imported file and a new file in an imported folder are all misses
+            compiler = KSPCompiler(code, folder, compact = False, compile_cache = cache)
+            compiler.compile()
+            self.assertEqual(compiler.stats['compile cache'], 'stored')
+
+            with open(os.path.join(lib, 'a.ksp'), 'w') as f:
+                f.write('function foo\n  message(2)\nend function\n')
+
+            self.assertIn('message(2)', self.compile(folder, code, cache).compiled_code)
+
+            with open(os.path.join(lib, 'b.ksp'), 'w') as f:
+                f.write('function bar\nend function\n')
+
+            self.assertEqual(self.compile(folder, code, cache).stats['compile cache'], 'stored')
+            self.assertEqual(self.compile(folder, code, cache).stats['compile cache'], 'hit')
+            self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def testCompiledDateIsNotCached(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = CompileCache(folder)
+            code = 'on init\n  message(1)\nend on'
+            results = []
+
+            for timestamp in (1000000000, 1000086400):
+                compiler = KSPCompiler(code, folder, compact = True, add_compiled_date_comment = True, compile_cache = cache)
+
+                with mock.patch.object(ksp_compiler.time, 'time', return_value = timestamp):
+                    compiler.compile()
+
+                results.append(compiler)
+
+            self.assertEqual([c.stats['compile cache'] for c in results], ['stored', 'hit'])
+
+            for (compiler, timestamp) in zip(results, (1000000000, 1000086400)):
+                self.assertTrue(compiler.compiled_code.startswith('{ Compiled on %s }\n' % time.asctime(time.localtime(timestamp))))
+
+            self.assertEqual(results[0].compiled_code.split('\n')[1:], results[1].compiled_code.split('\n')[1:])
+
+    def testPythonBlocksAreNotCached(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = CompileCache(folder)
+            code = 'on init\n  message(read<<1 + 1>>)\nend on'
+
+            self.assertEqual(self.compile(folder, code, cache).stats['compile cache'], 'not stored')
+            self.assertEqual(self.compile(folder, code, cache).stats['compile cache'], 'not stored')
+
+    def testEviction(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = CompileCache(folder, max_age = 100)
+
+            for i in range(3):
+                self.compile(folder, 'on init\n  message(%d)\nend on' % i, cache)
+
+            paths = sorted(os.path.join(folder, name) for name in os.listdir(folder))
+            self.assertEqual(len(paths), 3)
+
+            now = os.stat(paths[0]).st_mtime
+            os.utime(paths[0], (now - 1000, now - 1000))
+            self.assertEqual(cache.evict(now), 1)
+
+            cache.max_size = os.stat(paths[1]).st_size
+            self.assertEqual(cache.evict(now), 1)
+            self.assertEqual(len(os.listdir(folder)), 1)
+
+class Serialization(unittest.TestCase):
+    @staticmethod
+    def corpus():
+        '''Returns all scripts assigned to a variable named code in this file'''
+        import ast
+
+        with open(__file__, 'r', encoding = 'utf-8') as f:
+            tree = ast.parse(f.read())
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == 'code' for t in node.targets):
+                if isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+                    yield node.value.value
+
+    @staticmethod
+    def emit(module):
+        buffer = StringIO()
+        module.emit(ksp_compiler.ksp_ast.Emitter(buffer, compact = True))
+
+        return buffer.getvalue()
+
+    def testRoundTripOfCorpus(self):
+        num_compiled = 0
+
+        for code in self.corpus():
+            compiler = KSPCompiler(code, os.path.dirname(__file__), compact = True, extra_syntax_checks = True, optimize = True)
+
+            try:
+                compiler.compile()
+            except Exception:
+                continue   # scripts that are expected to fail
+
+            num_compiled += 1
+
+            with self.subTest(code = code):
+                data = serialization.dump_module(compiler.module)
+                module = serialization.load_module(data)
+                self.assertEqual(self.emit(module), self.emit(compiler.module))
+                self.assertEqual(serialization.dump_module(module), data)
+
+                data = serialization.dump_lines(compiler.lines, ksp_compiler.placeholders)
+                lines, table = serialization.load_lines(data)
+                self.assertEqual([l.command for l in lines], [l.command for l in compiler.lines])
+                self.assertEqual([l.locations for l in lines], [l.locations for l in compiler.lines])
+                self.assertEqual(table.strings, ksp_compiler.placeholders.strings)
+                self.assertIs(lines[0].placeholders, table)
+                self.assertEqual(serialization.dump_lines(lines, table), data)
+
+        self.assertGreater(num_compiled, 100)
+
+    def testSharedNodesAndDeepNesting(self):
+        li = ('test', 1, [], None)
+        ast = ksp_compiler.ksp_ast
+        shared = ast.Integer(li, 5)
+        expr = ast.BinOp(li, shared, '+', shared)
+
+        for i in range(5000):
+            expr = ast.UnaryOp(li, '-', expr)
+
+        module = serialization.load_module(serialization.dump_module(expr))
+
+        for i in range(5000):
+            module = module.right
+
+        self.assertIs(module.left, module.right)
+        self.assertEqual(module.left.value, 5)
+
+    def testWrongData(self):
+        data = serialization.dump_module(ksp_compiler.ksp_ast.Integer(('test', 1, [], None), 5))
+
+        self.assertRaises(ValueError, serialization.load_module, b'nonsense')
+        self.assertRaises(ValueError, serialization.load_lines, data)
+        self.assertRaises(ValueError, serialization.load_module, data[:4] + bytes([serialization.FORMAT_VERSION + 1]) + data[5:])
+
+class Interpreter(unittest.TestCase):
+    @staticmethod
+    def run_script(code, optimize = False, **kwargs):
+        compiler = KSPCompiler(code, os.path.dirname(__file__), compact = True, extra_syntax_checks = True, optimize = optimize)
+        compiler.compile()
+        interpreter = KSPInterpreter(compiler.module, **kwargs)
+        interpreter.run_init()
+
+        return interpreter
+
+    def testStatementsAndExpressions(self):
+        code = """
+        on init
+            declare i
+            declare sum
+            declare %values[4] := (3, 1, 4, 1)
+            declare @text
+            for i := 0 to 3
+                sum := sum + values[i]
+            end for
+            select sum
+                case 0 to 8
+                    @text := "small"
+                case 9
+                    @text := "nine"
+            end select
+            message(@text & " " & sum)
+        end on"""
+        interpreter = self.run_script(code)
+
+        self.assertEqual(interpreter.variables['$sum'], 9)
+        self.assertEqual(interpreter.variables['@text'], 'nine')
+        self.assertEqual(interpreter.messages, ['nine 9'])
+        self.assertEqual(interpreter.operations['loop iteration'], 4)
+        self.assertEqual(interpreter.builtin_calls['inc'], 4)
+        self.assertEqual(interpreter.builtin_calls['message'], 1)
+        self.assertEqual(interpreter.report()['builtin calls'], 5)
+
+    def testIntegerArithmetic(self):
+        code = """
+        on init
+            declare x := -7
+            declare a
+            declare b
+            declare c
+            a := x / 2
+            b := x mod 2
+            c := 2147483647 + 1
+        end on"""
+        interpreter = self.run_script(code)
+
+        self.assertEqual(interpreter.variables['$a'], -3)
+        self.assertEqual(interpreter.variables['$b'], -1)
+        self.assertEqual(interpreter.variables['$c'], -2147483648)
+
+    def testCallbacksAndEvents(self):
+        code = """
+        on init
+            declare ui_knob knob(0, 100, 1)
+            declare last_note
+            declare count
+        end on
+
+        function count_it
+            inc(count)
+        end function
+
+        on note
+            last_note := EVENT_NOTE
+            call count_it
+        end on
+
+        on ui_control(knob)
+            if knob > 50
+                exit
+            end if
+            call count_it
+        end on"""
+        interpreter = self.run_script(code)
+
+        interpreter.run_callback('note', event = Event.note(64))
+        self.assertEqual(interpreter.variables['$last_note'], 64)
+
+        interpreter.variables['$knob'] = 70
+        self.assertTrue(interpreter.run_callback('ui_control', '$knob'))
+        self.assertEqual(interpreter.variables['$count'], 1)
+        self.assertEqual(interpreter.function_calls['count_it'], 1)
+        self.assertFalse(interpreter.run_callback('controller'))
+
+    def testCostModel(self):
+        code = """
+        on init
+            declare x
+            x := x + 1
+            wait(1)
+        end on"""
+        default = self.run_script(code)
+        custom = self.run_script(code, cost_model = CostModel({'arithmetic': 100}, {'wait': 1000}))
+
+        self.assertEqual(custom.cost - default.cost, 99 + 1000 - CostModel.default_costs['builtin call'])
+
+    def testStubbedBuiltins(self):
+        code = """
+        on init
+            declare x
+            x := get_engine_par(ENGINE_PAR_VOLUME, -1, -1, -1)
+        end on"""
+        interpreter = self.run_script(code, builtins = {'get_engine_par': lambda interpreter, parameters: 42})
+
+        self.assertEqual(interpreter.variables['$x'], 42)
+
+    def testEndlessLoop(self):
+        code = """
+        on init
+            while 1 = 1
+            end while
+        end on"""
+        self.assertRaises(KSPRuntimeError, self.run_script, code, max_statements = 1000)
+
+    def testOptimizedCodeDoesNotCostMore(self):
+        code = """
+        on init
+            declare const SIZE := 8
+            declare %table[SIZE]
+            declare i
+            declare unused
+            for i := 0 to SIZE - 1
+                table[i] := i * (2 + 3)
+            end for
+            if 1 = 0
+                message("never")
+            end if
+            message(table[SIZE - 1])
+        end on"""
+        plain = self.run_script(code)
+        optimized = self.run_script(code, optimize = True)
+
+        self.assertEqual(plain.messages, ['35'])
+        self.assertEqual(plain.variables['%table'], optimized.variables['%table'])
+        self.assertLess(optimized.cost, plain.cost)
+
+class ConstantPropagation(unittest.TestCase):
+    def compile_note_callback(self, lines, declarations = (), init_lines = ()):
+        code = '\n'.join(['on init', 'declare ui_knob knob(0, 100, 1)'] + ['declare %s' % d for d in declarations] + list(init_lines) +
+                         ['end on', 'on note'] + list(lines) + ['end on'])
+
+        return do_compile(code, optimize = True)
+
+    def testConstantsAndCopies(self):
+        output = self.compile_note_callback(['x := 5',
+                                             'y := x * 2',
+                                             'z := EVENT_NOTE',
+                                             'w := z',
+                                             'play_note(y, w, 0, -1)'], ['x', 'y', 'z', 'w'])
+
+        self.assertIn('play_note(10,$z,0,-1)', output)
+        self.assertNotIn('declare $y', output)
+        self.assertNotIn('declare $w', output)
+
+    def testWaitAndCallForgetValues(self):
+        output = self.compile_note_callback(['x := 5', 'wait(10)', 'play_note(x, 100, 0, -1)'], ['x'])
+        self.assertIn('play_note($x,100,0,-1)', output)
+
+    def testJoinAfterBranches(self):
+        output = self.compile_note_callback(['if EVENT_NOTE > 60',
+                                             '    x := 1',
+                                             '    y := 1',
+                                             'else',
+                                             '    x := 1',
+                                             '    y := 2',
+                                             'end if',
+                                             'play_note(x, y, 0, -1)'], ['x', 'y'])
+
+        self.assertIn('play_note(1,$y,0,-1)', output)
+
+    def testLoops(self):
+        output = self.compile_note_callback(['i := 0',
+                                             'n := 4',
+                                             'while i < n',
+                                             '    play_note(i, 100, 0, -1)',
+                                             '    inc(i)',
+                                             'end while'], ['i', 'n'])
+
+        self.assertIn('while ($i<4)', output)
+        self.assertIn('play_note($i,100,0,-1)', output)
+
+    def testOpaqueVariables(self):
+        output = self.compile_note_callback(['knob := 5',
+                                             'p := 7',
+                                             'play_note(knob, p, 0, -1)'], ['p'], ['make_persistent(p)'])
+
+        self.assertIn('play_note($knob,$p,0,-1)', output)
+
+    def testInterpretedResultsUnchanged(self):
+        code = """
+        on init
+            declare i
+            declare total
+            declare offset
+            declare %notes[8]
+        end on
+
+        on note
+            offset := 12
+            total := 0
+            i := 0
+            while i < 8
+                notes[i] := EVENT_NOTE + offset + i
+                total := total + notes[i]
+                inc(i)
+            end while
+            if total > 100
+                offset := offset * 2
+            end if
+            message(total & ", " & offset)
+        end on"""
+        results = []
+
+        for optimize in (False, True):
+            compiler = KSPCompiler(code, os.path.dirname(__file__), extra_syntax_checks = True, optimize = optimize)
+            compiler.compile()
+            interpreter = KSPInterpreter(compiler.module)
+            interpreter.run_init()
+            interpreter.run_note(60)
+            results.append(interpreter)
+
+        self.assertEqual(results[0].messages, results[1].messages)
+        self.assertLess(results[1].cost, results[0].cost)
+
+    def testInlinedArgumentsAreNotShared(self):
+        code = """
+        on init
+            declare y
+        end on
+
+        function show(value)
+            message(value)
+            y := 3
+            message(value)
+        end function
+
+        on note
+            y := EVENT_NOTE
+            show(y + 1)
+        end on"""
+        compiler = KSPCompiler(code, os.path.dirname(__file__), optimize = True)
+        compiler.compile()
+        interpreter = KSPInterpreter(compiler.module)
+        interpreter.run_init()
+        interpreter.run_note(60)
+
+        self.assertEqual(interpreter.messages, ['61', '4'])
+
+class CommonSubexpressionElimination(unittest.TestCase):
+    def compile_note_callback(self, lines, declarations = (), eliminate_common_subexpressions = True):
+        code = '\n'.join(['on init'] + ['declare %s' % d for d in declarations] + ['end on', 'on note'] + list(lines) + ['end on'])
+        compiler = KSPCompiler(code, os.path.dirname(__file__), extra_syntax_checks = True, optimize = True,
+                               eliminate_common_subexpressions = eliminate_common_subexpressions)
+        compiler.compile()
+
+        return compiler.compiled_code.replace('\r', '')
+
+    def testRepeatedExpressions(self):
+        output = self.compile_note_callback(['x := EVENT_NOTE',
+                                             'y := (x * 3 + v * 5) * 2',
+                                             'z := (x * 3 + v * 5) * 5',
+                                             'play_note(y, z, 0, -1)'], ['x', 'y', 'z', 'v'])
+
+        self.assertIn('declare $_cse1', output)
+        self.assertIn('$_cse1 := $x*3+$v*5\n', output)
+        self.assertIn('$y := $_cse1*2', output)
+        self.assertIn('$z := $_cse1*5', output)
+
+    def testDisabledByDefault(self):
+        output = self.compile_note_callback(['x := EVENT_NOTE',
+                                             'y := (x * 3 + v * 5) * 2',
+                                             'z := (x * 3 + v * 5) * 5',
+                                             'play_note(y, z, 0, -1)'], ['x', 'y', 'z', 'v'], eliminate_common_subexpressions = False)
+
+        self.assertNotIn('_cse', output)
+
+    def testAssignmentsAndWaitsEndReuse(self):
+        output = self.compile_note_callback(['x := EVENT_NOTE',
+                                             'y := x * x + v * 5',
+                                             'x := y + 1',
+                                             'z := x * x + v * 5',
+                                             'wait(1)',
+                                             'y := x * x + v * 5',
+                                             'play_note(y, z, 0, -1)'], ['x', 'y', 'z', 'v'])
+
+        self.assertNotIn('_cse', output)
+
+    def testEngineReadsOfInlinedArgument(self):
+        code = """
+        on init
+            declare ui_knob knob(0, 100, 1)
+            declare id
+            declare x
+            declare y
+            id := get_ui_id(knob)
+        end on
+
+        function scale(value)
+            x := value + 1
+            y := value * 3
+        end function
+
+        on note
+            scale(get_control_par(id, $CONTROL_PAR_VALUE) * 2)
+            message(x + y)
+        end on"""
+        compiler = KSPCompiler(code, os.path.dirname(__file__), optimize = True, eliminate_common_subexpressions = True)
+        compiler.compile()
+        output = compiler.compiled_code.replace('\r', '')
+
+        self.assertEqual(output.count('get_control_par('), 1)
+        self.assertIn('$_cse1 := get_control_par($id,$CONTROL_PAR_VALUE)*2\n', output)
+
+    def testEngineReadsInvalidated(self):
+        declarations = ['ui_knob knob(0, 100, 1)', 'id', 'x', 'y']
+
+        for (change, count) in (('message(x)', 1), ('set_control_par(id, $CONTROL_PAR_VALUE, 5)', 2), ('knob := 5', 2), ('wait(1)', 2)):
+            output = self.compile_note_callback(['id := get_ui_id(knob)',
+                                                 'x := get_control_par(id, $CONTROL_PAR_VALUE) * 2 + 1',
+                                                 change,
+                                                 'y := get_control_par(id, $CONTROL_PAR_VALUE) * 2 + 3',
+                                                 'message(x + y)'], declarations)
+
+            self.assertEqual(output.count('get_control_par('), count, change)
+
+    def testConditionAndArrays(self):
+        output = self.compile_note_callback(['x := EVENT_NOTE',
+                                             'table[x mod 8 + 1] := table[x mod 8 + 1] + x',
+                                             'if table[x mod 8 + 1] > 10',
+                                             '    play_note(x, 100, 0, -1)',
+                                             'end if'], ['x', '%table[10]'])
+
+        self.assertIn('$_cse1 := $x mod 8+1', output)
+        self.assertIn('%table[$_cse1] := %table[$_cse1]+$x', output)
+        self.assertIn('if (%table[$_cse1]>10)', output)
+
+    def testInterpretedResultsUnchanged(self):
+        code = """
+        on init
+            declare x
+            declare ~r
+            declare @text
+            declare %values[16]
+        end on
+
+        on note
+            x := EVENT_NOTE
+            values[x mod 16] := (x * x + 7) / 3
+            values[(x + 1) mod 16] := (x * x + 7) / 3 + values[x mod 16]
+            ~r := int_to_real(values[x mod 16]) * 0.5 + int_to_real(values[x mod 16])
+            @text := "note " & x
+            message(@text & ", " & ("note " & x) & ", " & values[(x + 1) mod 16] & ", " & real_to_int(~r))
+        end on"""
+        results = []
+
+        for eliminate_common_subexpressions in (False, True):
+            compiler = KSPCompiler(code, os.path.dirname(__file__), extra_syntax_checks = True, optimize = True,
+                                   eliminate_common_subexpressions = eliminate_common_subexpressions)
+            compiler.compile()
+            interpreter = KSPInterpreter(compiler.module)
+            interpreter.run_init()
+            interpreter.reset_counters()   # the temporary variables make init a little more expensive
+            interpreter.run_note(60)
+            results.append(interpreter)
+
+        self.assertEqual(results[0].messages, results[1].messages)
+        self.assertLess(results[1].cost, results[0].cost)
+
+class LoopInvariantCodeMotion(unittest.TestCase):
+    def compile_note_callback(self, lines, declarations = ()):
+        code = '\n'.join(['on init', 'declare ui_knob knob(0, 100, 1)', 'declare i', 'declare j', 'declare %table[16]'] +
+                         ['declare %s' % d for d in declarations] + ['end on', 'on note'] + list(lines) + ['end on'])
+
+        return do_compile(code, optimize = True)
+
+    def testForLoopBound(self):
+        output = self.compile_note_callback(['for i := 0 to num_elements(table) - 1',
+                                             '    table[i] := EVENT_NOTE',
+                                             'end for'])
+
+        self.assertIn('declare $_inv1', output)
+        self.assertIn('$_inv1 := num_elements(%table)\nwhile ($i<$_inv1)', output)
+
+    def testNestedLoops(self):
+        output = self.compile_note_callback(['x := EVENT_NOTE',
+                                             'for i := 0 to 3',
+                                             '    for j := 0 to 3',
+                                             '        table[i * 4 + j] := x * 3 + knob * 2',
+                                             '    end for',
+                                             'end for',
+                                             'message(table[5])'], ['x'])
+
+        self.assertIn('$i := 0\n$_inv1 := $x*3+$knob*2\nwhile', output)
+        self.assertIn('$j := 0\n$_inv2 := $i*4\nwhile ($j<=3)\n%table[$_inv2+$j] := $_inv1', output)
+
+    def testAssignedVariablesAndWaitKeepCode(self):
+        output = self.compile_note_callback(['x := EVENT_NOTE',
+                                             'for i := 0 to 3',
+                                             '    table[i] := x * 3 + 1',
+                                             '    x := table[i]',
+                                             'end for',
+                                             'for i := 0 to 3',
+                                             '    table[i] := x * 5 + 1',
+                                             '    wait(1)',
+                                             'end for'], ['x'])
+
+        self.assertNotIn('_inv', output)
+
+    def testBuiltinsThatChangeControls(self):
+        output = self.compile_note_callback(['for i := 0 to 3',
+                                             '    table[i] := knob * 3 + 1',
+                                             '    set_control_par(get_ui_id(knob), CONTROL_PAR_VALUE, i)',
+                                             'end for'])
+
+        self.assertNotIn('_inv', output)
+
+    def testInterpretedResultsUnchanged(self):
+        code = """
+        on init
+            declare %low[16]
+            declare %high[16]
+            declare i
+            declare zone
+            declare total
+            declare ui_knob spread(0, 12, 1)
+
+            for i := 0 to num_elements(low) - 1
+                low[i] := i * 8
+                high[i] := i * 8 + 7
+            end for
+        end on
+
+        on note
+            zone := -1
+            total := 0
+            for i := 0 to num_elements(low) - 1
+                if in_range(EVENT_NOTE, low[i], high[i]) and zone = -1
+                    zone := i
+                end if
+                total := total + high[i] * (spread * 2 + EVENT_VELOCITY / 10)
+            end for
+            message(zone & ", " & total)
+        end on"""
+        results = []
+
+        for optimize in (False, True):
+            compiler = KSPCompiler(code, os.path.dirname(__file__), extra_syntax_checks = True, optimize = optimize)
+            compiler.compile()
+            interpreter = KSPInterpreter(compiler.module)
+            interpreter.run_init()
+            interpreter.reset_counters()
+            interpreter.run_note(60)
+            results.append(interpreter)
+
+        self.assertEqual(results[0].messages, results[1].messages)
+        self.assertLess(results[1].cost, results[0].cost)
+        self.assertLess(results[1].builtin_calls['num_elements'], results[0].builtin_calls['num_elements'])
+
+class SelectLowering(unittest.TestCase):
+    def select_code(self, num_cases, case_lines, selector = 'EVENT_NOTE'):
+        lines = ['on init', 'declare y', 'declare z', 'end on', 'on note', 'select (%s)' % selector]
+
+        for k in range(num_cases):
+            lines += case_lines(k)
+
+        return '\n'.join(lines + ['end select', 'message(y & " " & z)', 'end on'])
+
+    def compile(self, code, lower_select_statements = True):
+        compiler = KSPCompiler(code, os.path.dirname(__file__), extra_syntax_checks = True, optimize = True,
+                               lower_select_statements = lower_select_statements)
+        compiler.compile()
+
+        return compiler
+
+    def run_notes(self, compiler, notes):
+        interpreter = KSPInterpreter(compiler.module)
+        interpreter.run_init()
+        interpreter.reset_counters()
+
+        for note in notes:
+            interpreter.run_note(note)
+
+        return interpreter
+
+    def testLookupTable(self):
+        code = self.select_code(100, lambda k: ['case %d to %d' % (k * 2 + 1, k * 2 + 2), 'y := %d' % (k * k)], 'EVENT_NOTE mod 256')
+        compiler = self.compile(code)
+        output = compiler.compiled_code.replace('\r', '')
+
+        self.assertNotIn('select (', output)
+        self.assertIn('declare %_select_table1[200] := (0, 0, 1, 1, 4, 4, 9, 9', output)
+        self.assertIn('$_sel1 := $EVENT_NOTE mod 256\nif (in_range($_sel1,1,200))\n$y := %_select_table1[$_sel1-1]\nend if', output)
+        self.assertEqual(compiler.stats['select statements turned into lookup tables'], 1)
+        self.assertEqual(compiler.stats['expected select case tests saved per execution'], 49.5)
+
+        plain = self.run_notes(self.compile(code, False), range(-5, 300))
+        lowered = self.run_notes(compiler, range(-5, 300))
+        self.assertEqual(plain.messages, lowered.messages)
+        self.assertLess(lowered.cost, plain.cost)
+
+    def testBinaryTree(self):
+        code = self.select_code(100, lambda k: ['case %d' % (k * 3), 'y := %d' % k, 'z := z + 1'])
+        compiler = self.compile(code)
+        output = compiler.compiled_code.replace('\r', '')
+
+        self.assertNotIn('select (', output)
+        self.assertIn('if ($EVENT_NOTE<150)\nif ($EVENT_NOTE<75)\n', output)
+        self.assertEqual(compiler.stats['select statements turned into if trees'], 1)
+
+        plain = self.run_notes(self.compile(code, False), range(-5, 300))
+        lowered = self.run_notes(compiler, range(-5, 300))
+        self.assertEqual(plain.messages, lowered.messages)
+        self.assertLess(lowered.cost, plain.cost)
+        self.assertLess(lowered.operations['branch'], plain.operations['branch'])
+
+    def testSmallAndIrregularSelectsUnchanged(self):
+        small = self.select_code(6, lambda k: ['case %d' % k, 'y := %d' % k])
+        overlapping = self.select_code(100, lambda k: ['case %d to %d' % (k, k + 1), 'y := %d' % k])
+
+        for code in (small, overlapping):
+            compiler = self.compile(code)
+            self.assertIn('select ($EVENT_NOTE)', compiler.compiled_code)
+            self.assertEqual(compiler.stats['expected select case tests saved per execution'], 0)
+
+class FunctionOutlining(unittest.TestCase):
+    code = '''
+on init
+  declare total
+  declare ui_knob k(0, 10, 1)
+  reset
+  big
+end on
+function reset
+  total := 0
+end function
+function big
+%s
+  small
+end function
+function small
+  inc(total)
+end function
+function helper
+  big
+  big
+end function
+function add(value)
+  total := total + value
+end function
+on note
+  big
+  reset
+  helper
+  add(EVENT_NOTE)
+  message(total)
+end on
+on release
+  big
+end on
+on ui_control(k)
+  big
+  helper
+end on
+''' % '\n'.join('  total := total + %d * EVENT_NOTE' % k for k in range(10))
+
+    def compile(self, outline_threshold):
+        compiler = KSPCompiler(self.code, os.path.dirname(__file__), outline_threshold = outline_threshold)
+        compiler.compile()
+
+        return compiler
+
+    def run_callbacks(self, compiler):
+        interpreter = KSPInterpreter(compiler.module)
+        interpreter.run_init()
+        interpreter.run_note(60)
+        interpreter.run_callback('ui_control', '$k')
+
+        return interpreter
+
+    def testLargeFunctionOutlined(self):
+        inlined = self.compile(0)
+        outlined = self.compile(5)
+        output = outlined.compiled_code.replace('\r', '')
+
+        self.assertIn('function big\n', output)
+        self.assertIn('on release\ncall big\nend on', output)
+        self.assertIn('on ui_control($k)\ncall big\ncall big\ncall big\nend on', output)
+        self.assertLess(len(output.splitlines()), len(inlined.compiled_code.splitlines()))
+        self.assertEqual(outlined.stats['outlined functions'], 1)
+        self.assertEqual(outlined.stats['outlined function big'], '11 lines, was inlined 8 times')
+        self.assertGreater(outlined.stats['estimated lines saved by outlining'], 0)
+
+        self.assertEqual(self.run_callbacks(inlined).messages, self.run_callbacks(outlined).messages)
+
+    def testInitSmallAndParameterFunctionsInlined(self):
+        output = self.compile(5).compiled_code.replace('\r', '')
+        init = output[:output.index('end on')]
+
+        self.assertNotIn('call', init)
+        self.assertIn('$total := $total+(9*$EVENT_NOTE)\ninc($total)\nend on', output)
+        self.assertNotIn('function reset', output)
+        self.assertNotIn('function small', output)
+        self.assertNotIn('function add', output)
+        self.assertIn('$total := $total+$EVENT_NOTE', output)
+
+    def testHighThresholdKeepsInlining(self):
+        compiler = self.compile(100)
+
+        self.assertNotIn('call', compiler.compiled_code)
+        self.assertEqual(compiler.stats['outlined functions'], 0)
+
+    def testFunctionsInlinedIntoInitKeepInlining(self):
+        code = '''
+on init
+  declare total
+  outer
+end on
+function big
+%s
+end function
+function outer
+  big
+end function
+on note
+  big
+end on
+on release
+  big
+end on
+''' % '\n'.join('  total := total + %d * EVENT_NOTE' % k for k in range(30))
+
+        compiler = KSPCompiler(code, os.path.dirname(__file__), outline_threshold = 10)
+        compiler.compile()
+        output = compiler.compiled_code.replace('\r', '')
+
+        # big is inlined into init through outer, so only the invocations in the note and release callbacks change
+        self.assertNotIn('call', output[:output.index('end on')])
+        self.assertIn('on note\ncall big\nend on', output)
+        self.assertIn('on release\ncall big\nend on', output)
+
+    def testFunctionsWithExitKeepInlining(self):
+        code = '''
+on init
+  declare x
+end on
+function check
+%s
+  if x > 3
+    exit
+  end if
+end function
+function outer
+  check
+end function
+on note
+  check
+  message("after")
+end on
+on release
+  outer
+  message("after")
+end on
+''' % '\n'.join('  x := x + %d * EVENT_NOTE' % k for k in range(30))
+
+        compiler = KSPCompiler(code, os.path.dirname(__file__), outline_threshold = 5)
+        compiler.compile()
+        output = compiler.compiled_code.replace('\r', '')
+
+        # exit would only leave the function if it was invoked with 'call', so neither check nor outer is outlined
+        self.assertNotIn('call', output)
+        self.assertNotIn('function', output)
+        self.assertEqual(compiler.stats['outlined functions'], 0)
+
+
+class DeadStoreElimination(unittest.TestCase):
+    def compile_note_callback(self, lines, declarations = (), init_lines = ()):
+        code = '\n'.join(['on init', 'declare ui_knob knob(0, 100, 1)'] + ['declare %s' % d for d in declarations] + list(init_lines) +
+                         ['end on', 'on note'] + list(lines) + ['end on'])
+        compiler = KSPCompiler(code, os.path.dirname(__file__), compact = True, optimize = True)
+        compiler.compile()
+
+        return compiler
+
+    def note_callback(self, compiler):
+        output = compiler.compiled_code.replace('\r', '')
+        return output[output.index('on note'):]
+
+    def testOverwrittenStores(self):
+        compiler = self.compile_note_callback(['x := EVENT_NOTE',
+                                               'values[2] := EVENT_VELOCITY',
+                                               'values[3] := 1',
+                                               'x := EVENT_NOTE * 2',
+                                               'values[2] := x',
+                                               'message(x & values[2] & values[3])'], ['x', '%values[4]'])
+        output = self.note_callback(compiler)
+
+        self.assertEqual(output, 'on note\n%values[3] := 1\n$x := $EVENT_NOTE*2\n%values[2] := $x\n'
+                                 'message($x & %values[2] & %values[3])\nend on\n')
+        self.assertEqual(compiler.stats['dead stores removed'], 2)
+
+    def testStoresThatMayBeRead(self):
+        output = self.note_callback(self.compile_note_callback(['x := EVENT_NOTE',
+                                                                'wait(10)',
+                                                                'x := EVENT_VELOCITY',
+                                                                'y := EVENT_NOTE',
+                                                                'if EVENT_VELOCITY > 64',
+                                                                '    message(y)',
+                                                                'end if',
+                                                                'y := 0',
+                                                                'values[EVENT_NOTE mod 4] := 1',
+                                                                'values[0] := 2',
+                                                                'knob := 10',
+                                                                'knob := 20',
+                                                                'p := 1',
+                                                                'p := 2',
+                                                                'message(x & y & knob & p & values[0])'], ['x', 'y', 'p', '%values[4]'], ['make_persistent(p)']))
+
+        self.assertIn('$x := $EVENT_NOTE\nwait(10)\n$x := $EVENT_VELOCITY\n', output)
+        self.assertIn('$y := $EVENT_NOTE\n', output)
+        self.assertIn('%values[$EVENT_NOTE mod 4] := 1\n%values[0] := 2\n', output)
+        self.assertIn('$knob := 10\n$knob := 20\n', output)
+        self.assertIn('$p := 1\n$p := 2\n', output)
+
+    def testLoopsAndBranches(self):
+        output = self.note_callback(self.compile_note_callback(['total := EVENT_NOTE',
+                                                                'last := EVENT_NOTE',
+                                                                'i := 0',
+                                                                'while i < 4',
+                                                                '    total := total + i',
+                                                                '    inc(i)',
+                                                                'end while',
+                                                                'last := total',
+                                                                'if EVENT_VELOCITY > 64',
+                                                                '    y := 1',
+                                                                'else',
+                                                                '    y := 2',
+                                                                'end if',
+                                                                'y := 3',
+                                                                'message(total & last & y)'], ['total', 'last', 'i', 'y']))
+
+        self.assertIn('$total := $EVENT_NOTE\n', output)
+        self.assertNotIn('$last := $EVENT_NOTE', output)
+        self.assertNotIn('$y := 1', output)
+        self.assertNotIn('$y := 2', output)
+
+    def testRedundantAssignments(self):
+        compiler = self.compile_note_callback(['x := EVENT_NOTE',
+                                               'message(x)',
+                                               'y := x',
+                                               'x := y',
+                                               'z := 5',
+                                               'message(x & y & z)',
+                                               'z := 5',
+                                               'message(x & y & z)'], ['x', 'y', 'z'])
+        output = self.note_callback(compiler)
+
+        self.assertEqual(output.count('$x := '), 1)
+        self.assertEqual(compiler.stats['redundant assignments removed'], 2)
+
+    def testInterpretedResultsUnchanged(self):
+        code = """
+        on init
+            declare i
+            declare result
+            declare count
+            declare %steps[4]
+        end on
+
+        function next_step(n) -> out
+            out := 0
+            if n > 60
+                out := n * 2
+            else
+                out := n + 1
+            end if
+        end function
+
+        on note
+            count := 0
+            i := 0
+            while i < 4
+                steps[i] := next_step(EVENT_NOTE + i)
+                count := count + 1
+                result := steps[i]
+                inc(i)
+            end while
+            result := next_step(result)
+            message(result & ", " & count & ", " & steps[3])
+        end on"""
+        results = []
+
+        for optimize in (False, True):
+            compiler = KSPCompiler(code, os.path.dirname(__file__), extra_syntax_checks = True, optimize = optimize)
+            compiler.compile()
+            interpreter = KSPInterpreter(compiler.module)
+            interpreter.run_init()
+            interpreter.reset_counters()
+
+            for note in (40, 80):
+                interpreter.run_note(note)
+
+            results.append(interpreter)
+
+        self.assertGreater(compiler.stats['dead stores removed'], 0)
+        self.assertEqual(results[0].messages, results[1].messages)
+        self.assertLess(results[1].cost, results[0].cost)
+
+    def testTaskfuncFrameSlots(self):
+        code = '''
+            on init
+              tcm.init(100)
+              declare x
+            end on
+
+            taskfunc f(a) -> result
+              declare n
+              declare m
+              n := a * 2
+              m := a * 3
+              n := a + m
+              result := n
+            end taskfunc
+
+            on note
+              x := f(EVENT_NOTE)
+              message(x)
+            end on'''
+
+        compiler = KSPCompiler(code, os.path.dirname(__file__), compact = True, optimize = True)
+        compiler.compile()
+        output = compiler.compiled_code.replace('\r', '')
+
+        # n is overwritten before it is read, m (another offset from $fp) is read in between
+        self.assertNotIn('%p[$fp+1] := %p[$fp+3]*2', output)
+        self.assertIn('%p[$fp+2] := %p[$fp+3]*3\n%p[$fp+1] := %p[$fp+3]+%p[$fp+2]\n', output)
+        self.assertIn('%p[$sp-2] := $EVENT_NOTE\ncall f\n', output)
+
+    def testDeeplyNestedLoops(self):
+        depth = 20
+        lines = ['z := EVENT_NOTE']
+        lines += ['while (x < %d)' % i for i in range(depth)]
+        lines += ['y := x', 'y := x + 1', 'message(y)', 'inc(x)']
+        lines += ['end while'] * depth
+        lines += ['z := EVENT_VELOCITY', 'message(z)']
+        compiler = self.compile_note_callback(lines, ['x', 'y', 'z'], ['x := EVENT_NOTE'])
+        output = self.note_callback(compiler)
+
+        self.assertNotIn('$z := $EVENT_NOTE', output)
+        self.assertNotIn('$y := $x\n', output)
+        self.assertIn('$y := $x+1\nmessage($y)', output)
+        self.assertEqual(compiler.stats['dead stores removed'], 2)
+
+    def testDeeplyNestedStatements(self):
+        depth = 500
+        code = ['on init', 'declare $x', 'declare $y', 'end on', 'on note']
+        code += ['if ($x < %d)' % i if i % 2 == 0 else 'while ($x < %d)' % i for i in range(depth)]
+        code += ['$y := $x', '$y := $x + 1', 'message($y)', 'inc($x)']
+        code += ['end if' if i % 2 == 0 else 'end while' for i in reversed(range(depth))]
+        code += ['end on']
+
+        output = do_compile('\n'.join(code), optimize = True)
+        self.assertEqual(output.count('end while'), depth // 2)
+        self.assertNotIn('$y := $x\n', output)
+
+class PeepholeOptimization(unittest.TestCase):
+    def apply_rules(self, lines, declarations = (), rules = None):
+        code = '\n'.join(['on init'] + ['declare %s' % d for d in declarations] + ['end on', 'on note'] + list(lines) + ['end on'])
+        compiler = KSPCompiler(code, os.path.dirname(__file__))
+        compiler.compile()
+        peephole = optimizer.PeepholeOptimizer(compiler.module, rules)
+
+        buffer = StringIO()
+        compiler.module.emit(ksp_compiler.ksp_ast.Emitter(buffer, compact = True))
+        output = buffer.getvalue()
+
+        return output[output.index('on note'):], peephole.hits
+
+    def testStatementRules(self):
+        output, hits = self.apply_rules(['x := x + 1',
+                                         'y := 1 + y',
+                                         'values[x] := values[x] - 1',
+                                         'x := y',
+                                         'y := x',
+                                         'y := y',
+                                         'if x > 2',
+                                         '    message(x)',
+                                         'else',
+                                         'end if',
+                                         'if y > 2',
+                                         'end if',
+                                         'if 2 > 3',
+                                         '    message(y)',
+                                         'else if 2 < 3',
+                                         '    message(x)',
+                                         'end if',
+                                         'x := x + 2'], ['x', 'y', '%values[4]'])
+
+        self.assertEqual(output, 'on note\ninc($x)\ninc($y)\ndec(%values[$x])\n$x := $y\nif ($x>2)\nmessage($x)\nend if\n'
+                                 'message($x)\n$x := $x+2\nend on\n')
+        self.assertEqual(hits['increment'], 3)
+        self.assertEqual(hits['swapped copy'], 1)
+        self.assertEqual(hits['self assignment'], 1)
+        self.assertEqual(hits['empty else'], 1)
+        self.assertEqual(hits['empty if'], 1)
+        self.assertEqual(hits['constant condition'], 2)   # else if is an if statement in the else branch
+
+    def testExpressionRules(self):
+        output, hits = self.apply_rules(['x := x * 3 + (y * 5)',
+                                         'x := x - (y - 1)',
+                                         'x := -(-y)',
+                                         'if x > 2 or (y > 3 and x < 2)',
+                                         '    message(x & (y + 1))',
+                                         'end if'], ['x', 'y'])
+
+        self.assertIn('$x := $x*3+$y*5\n$x := $x-($y-1)\n$x := $y\n', output)
+        self.assertIn('if ($x>2 or $y>3 and $x<2)\nmessage($x & $y+1)\n', output)
+        self.assertEqual(hits['double negation'], 1)
+        self.assertEqual(hits['redundant parentheses'], 4)
+
+    def testIfOneEqualsOneKept(self):
+        output, hits = self.apply_rules(['if 1 = 1', '    message("")', 'end if'])
+
+        self.assertIn('if (1=1)\nmessage("")\nend if', output)
+        self.assertEqual(hits['constant condition'], 0)
+
+    def testCustomRules(self):
+        def zero_rule(stmts, i):
+            stmt = stmts[i]
+
+            if isinstance(stmt.expression, ksp_compiler.ksp_ast.BinOp) and stmt.expression.op == '*' and \
+               isinstance(stmt.expression.right, ksp_compiler.ksp_ast.Integer) and stmt.expression.right.value == 0:
+                stmt.expression = stmt.expression.right
+                return (1, [stmt])
+
+            return None
+
+        rules = [optimizer.PeepholeRule('multiplication by zero', ksp_compiler.ksp_ast.AssignStmt, zero_rule)]
+        output, hits = self.apply_rules(['x := y * 0', 'x := x + 1'], ['x', 'y'], rules)
+
+        self.assertEqual(output, 'on note\n$x := 0\n$x := $x+1\nend on\n')
+        self.assertEqual(list(hits.items()), [('multiplication by zero', 1)])
+
+    def testCompiledCodeGivesSameResults(self):
+        code = """
+        on init
+            declare i
+            declare total
+            declare %values[8]
+        end on
+
+        on note
+            total := 0
+            i := 0
+            while i < 8
+                values[i] := EVENT_NOTE * 2 + (i * 3)
+                values[i] := values[i] + 1
+                total := total + values[i] - (i - 1)
+                i := i + 1
+            end while
+            message(total)
+        end on"""
+        results = []
+        sizes = []
+
+        for optimize in (False, True):
+            compiler = KSPCompiler(code, os.path.dirname(__file__), optimize = optimize)
+            compiler.compile()
+            sizes.append(len(compiler.compiled_code))
+
+            # run what was emitted, to check that the parentheses left out were not needed
+            compiler = KSPCompiler(compiler.compiled_code, os.path.dirname(__file__))
+            compiler.compile()
+            interpreter = KSPInterpreter(compiler.module)
+            interpreter.run_init()
+            interpreter.reset_counters()
+            interpreter.run_note(60)
+            results.append(interpreter)
+
+        self.assertEqual(results[0].messages, results[1].messages)
+        self.assertLessEqual(results[1].cost, results[0].cost)
+        self.assertLess(sizes[1], sizes[0])
+
+
+class IdenticalFunctionMerging(unittest.TestCase):
+    code = '''
+        on init
+          declare ui_knob knob1(0, 100, 1)
+          declare ui_knob knob2(0, 100, 1)
+          declare ui_knob other(0, 100, 1)
+          declare %levels[3]
+          declare x
+        end on
+
+        function show_a
+          message("level: " & levels[0])
+        end function
+
+        function show_b
+          message("level: " & levels[0])
+        end function
+
+        function show_c
+          message("level: " & levels[1])
+        end function
+
+        function update_a
+          call show_a
+          inc(x)
+        end function
+
+        function update_b
+          call show_b
+          inc(x)
+        end function
+
+        on ui_control(knob1)
+          levels[0] := knob1
+          call update_a
+        end on
+
+        on ui_control(knob2)
+          levels[0] := knob2
+          call update_b
+        end on
+
+        on ui_control(other)
+          levels[1] := other
+          call show_c
+        end on
+
+        on note
+          message(x)
+        end on'''
+
+    def compile(self, optimize = True):
+        compiler = KSPCompiler(self.code, os.path.dirname(__file__), optimize = optimize)
+        compiler.compile()
+
+        return compiler
+
+    def testIdenticalFunctionsMerged(self):
+        compiler = self.compile()
+        output = compiler.compiled_code.replace('\r', '')
+
+        # once show_b is replaced by show_a, update_b is the same as update_a too
+        self.assertEqual(compiler.stats['identical functions merged'], 2)
+        self.assertEqual(compiler.stats['merged function show_b'], 'into show_a')
+        self.assertEqual(compiler.stats['merged function update_b'], 'into update_a')
+        self.assertNotIn('function show_b', output)
+        self.assertNotIn('function update_b', output)
+        self.assertIn('function show_c', output)
+        self.assertEqual(output.count('call update_a'), 2)
+
+    def testBehaviourUnchanged(self):
+        results = []
+
+        for optimize in (False, True):
+            interpreter = KSPInterpreter(self.compile(optimize).module)
+            interpreter.run_init()
+
+            for name in ('knob1', 'knob2', 'other'):
+                interpreter.run_callback('ui_control', '$' + name)
+
+            interpreter.run_note(60)
+            results.append(interpreter.messages)
+
+        self.assertEqual(results[0], results[1])
+
+    def testSimilarUICallbacksReported(self):
+        stats = self.compile().stats
+
+        self.assertEqual(stats['ui callbacks differing only in their control $knob1'], '$knob1, $knob2')
+        self.assertFalse([key for key in stats if key.startswith('ui callbacks') and 'other' in key])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,60 @@
+'''Times the compilation of scripts with very long "else if" chains and very deeply nested statements.
+
+   Usage: python benchmark-deep-nesting.py [number of else if arms] [nesting depth]
+   (defaults: 10000 arms, 500 levels)'''
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'compiler'))
+
+import ksp_compiler
+
+
+def else_if_chain(num_arms):
+    lines = ['on init', '  declare $x', 'end on', 'on note', '  if ($x = 0)', '    $x := 1']
+
+    for i in range(1, num_arms):
+        lines.append('  else if ($x = %d)' % i)
+        lines.append('    $x := %d' % (i + 1))
+
+    lines += ['  else', '    $x := 0', '  end if', 'end on']
+
+    return '\n'.join(lines)
+
+def nested_statements(depth):
+    lines = ['on init', '  declare $x', 'end on', 'on note']
+
+    for i in range(depth):
+        lines.append('  ' * (i + 1) + ('if ($x < %d)' if i % 2 == 0 else 'while ($x < %d)') % (i + 1))
+
+    lines.append('  ' * (depth + 1) + 'inc($x)')
+
+    for i in reversed(range(depth)):
+        lines.append('  ' * (i + 1) + ('end if' if i % 2 == 0 else 'end while'))
+
+    lines.append('end on')
+
+    return '\n'.join(lines)
+
+def benchmark(name, code):
+    for optimize in (False, True):
+        compiler = ksp_compiler.KSPCompiler(code, os.getcwd(), compact = True, optimize = optimize)
+        start = time.perf_counter()
+        compiler.compile()
+        duration = time.perf_counter() - start
+
+        print('%-40s optimize=%-5s %8.2f s  %9d bytes of output' % (name, optimize, duration, len(compiler.compiled_code)))
+
+        # the three slowest phases
+        for (desc, seconds) in sorted(compiler.phase_timings, key = lambda t: -t[1])[:3]:
+            print('    %-36s %8.2f s' % (desc, seconds))
+
+if __name__ == '__main__':
+    num_arms = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    print('Python recursion limit: %d' % sys.getrecursionlimit())
+    benchmark('if with %d else if arms' % num_arms, else_if_chain(num_arms))
+    benchmark('%d levels of nested if/while' % depth, nested_statements(depth))
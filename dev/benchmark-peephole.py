@@ -0,0 +1,79 @@
+'''Compiles the scripts in the tests of the compiler with optimize_code, once without and once with the peephole rules,
+   and compares the size of the compiled code and the cost of running it with the reference interpreter (the init
+   callback, then every other callback once, with the event of a note). Also shows how often each rule applied.
+
+   Usage: python benchmark-peephole.py'''
+
+import os
+import sys
+from collections import OrderedDict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'compiler'))
+
+import ksp_compiler
+import optimizer
+import tests
+from ksp_interpreter import Event, KSPInterpreter, KSPRuntimeError
+
+
+def compile_and_run(code, basedir):
+    compiler = ksp_compiler.KSPCompiler(code, basedir, compact = True, optimize = True)
+    compiler.compile()
+
+    interpreter = KSPInterpreter(compiler.module, max_statements = 100000)
+
+    try:
+        interpreter.run_init()
+
+        for (name, variable) in sorted(interpreter.callbacks, key = str):
+            if name != 'init':
+                interpreter.run_callback(name, variable, Event.note(60))
+
+        cost = interpreter.cost
+    except KSPRuntimeError:
+        cost = None
+
+    return compiler, cost
+
+if __name__ == '__main__':
+    basedir = os.path.dirname(os.path.abspath(tests.__file__))
+    rules = list(optimizer.peephole_rules)
+    totals = OrderedDict((key, [0, 0]) for key in ('scripts', 'bytes', 'lines', 'cost'))
+    hits = OrderedDict((rule.name, 0) for rule in rules)
+
+    for code in tests.Serialization.corpus():
+        results = []
+
+        for rules_used in ([], rules):
+            optimizer.peephole_rules[:] = rules_used
+
+            try:
+                results.append(compile_and_run(code, basedir))
+            except Exception:
+                break
+
+        optimizer.peephole_rules[:] = rules
+
+        if len(results) < 2:
+            continue
+
+        for (i, (compiler, cost)) in enumerate(results):
+            totals['scripts'][i] += 1
+            totals['bytes'][i] += len(compiler.compiled_code)
+            totals['lines'][i] += len(compiler.compiled_code.splitlines())
+
+            if results[0][1] is not None and results[1][1] is not None:
+                totals['cost'][i] += cost
+
+        for rule in rules:
+            hits[rule.name] += results[1][0].stats['peephole rule %s' % rule.name]
+
+    print('%-22s %12s %12s' % ('', 'without', 'with rules'))
+
+    for (key, (without, with_rules)) in totals.items():
+        print('%-22s %12d %12d' % (key, without, with_rules))
+
+    print()
+
+    for (name, n) in hits.items():
+        print('%-22s %12d' % (name, n))
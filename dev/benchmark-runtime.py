@@ -0,0 +1,89 @@
+'''Compiles a script with and without optimize_code, runs both results with the reference interpreter and compares
+   how much work they do: executed statements, builtin calls and the cost given by the default cost model.
+
+   Usage: python benchmark-runtime.py [script to compile] [number of notes to play]
+   (defaults: a generated script, 100 notes)
+
+   The init callback runs first, then every UI callback once, then the note and release callbacks for each note.'''
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'compiler'))
+
+import ksp_compiler
+from ksp_interpreter import KSPInterpreter
+
+
+def generated_script():
+    return '''
+on init
+    declare const ZONE_COUNT := 16
+    declare %zone_low[ZONE_COUNT]
+    declare %zone_high[ZONE_COUNT]
+    declare i
+    declare zone
+    declare ui_knob spread(0, 12, 1)
+
+    for i := 0 to ZONE_COUNT - 1
+        zone_low[i] := i * 8
+        zone_high[i] := i * 8 + 7
+    end for
+end on
+
+function update_zone
+    zone := -1
+    for i := 0 to ZONE_COUNT - 1
+        if in_range(EVENT_NOTE, zone_low[i], zone_high[i]) and zone = -1
+            zone := i
+        end if
+    end for
+end function
+
+on note
+    call update_zone
+    if zone # -1
+        change_tune(EVENT_ID, (zone mod 2) * spread * 1000, 1)
+    end if
+end on
+
+on ui_control(spread)
+    message("spread: " & spread)
+end on
+'''
+
+def run(code, basedir, optimize, num_notes):
+    compiler = ksp_compiler.KSPCompiler(code, basedir, compact = True, extra_syntax_checks = True, optimize = optimize)
+    compiler.compile()
+
+    interpreter = KSPInterpreter(compiler.module)
+    interpreter.run_init()
+
+    for (name, variable) in sorted(interpreter.callbacks, key = str):
+        if variable is not None:
+            interpreter.run_callback(name, variable)
+
+    for i in range(num_notes):
+        interpreter.run_note(i % 128, 100)
+
+    return interpreter.report()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and os.path.exists(sys.argv[1]):
+        with open(sys.argv[1], 'r', encoding = 'latin-1') as f:
+            code = f.read()
+
+        basedir = os.path.dirname(os.path.abspath(sys.argv[1]))
+    else:
+        code = generated_script()
+        basedir = os.getcwd()
+
+    num_notes = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    plain = run(code, basedir, False, num_notes)
+    optimized = run(code, basedir, True, num_notes)
+
+    print('%-22s %12s %12s' % ('', 'plain', 'optimized'))
+
+    for key in ('executed statements', 'builtin calls', 'function calls', 'cost'):
+        print('%-22s %12d %12d' % (key, plain[key], optimized[key]))
@@ -0,0 +1,76 @@
+'''Measures how fast the lines and the AST of a compiled script are saved and loaded with the serialization module,
+   next to pickle for comparison.
+
+   Usage: python benchmark-serialization.py [script to compile] [number of repetitions]
+   (defaults: a generated script with 2000 functions, 5 repetitions)'''
+
+import os
+import pickle
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'compiler'))
+
+import ksp_compiler
+import serialization
+
+
+def generated_script(num_functions):
+    lines = ['on init', '  declare $x', '  declare %values[100]', '  declare @text']
+
+    for i in range(num_functions):
+        lines.append('  call_%d' % i)
+
+    lines.append('end on')
+
+    for i in range(num_functions):
+        lines += ['function call_%d' % i,
+                  '  if ($x > %d)' % i,
+                  '    %%values[%d mod 100] := $x * 2 + %d' % (i, i),
+                  '    @text := "function %d"' % i,
+                  '  else',
+                  '    inc($x)',
+                  '  end if',
+                  'end function']
+
+    return '\n'.join(lines)
+
+def measure(func, repetitions):
+    start = time.perf_counter()
+
+    for i in range(repetitions):
+        result = func()
+
+    return result, (time.perf_counter() - start) / repetitions
+
+def report(name, dump, load, repetitions):
+    data, dump_time = measure(dump, repetitions)
+    result, load_time = measure(lambda: load(data), repetitions)
+    size = len(data) / 1024.0 / 1024.0
+
+    print('%-22s %8.2f MB   save %7.1f ms (%6.1f MB/s)   load %7.1f ms (%6.1f MB/s)' %
+          (name, size, dump_time * 1000, size / dump_time, load_time * 1000, size / load_time))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and os.path.exists(sys.argv[1]):
+        with open(sys.argv[1], 'r', encoding = 'latin-1') as f:
+            code = f.read()
+
+        basedir = os.path.dirname(os.path.abspath(sys.argv[1]))
+    else:
+        code = generated_script(2000)
+        basedir = os.getcwd()
+
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    compiler = ksp_compiler.KSPCompiler(code, basedir, compact = True)
+    compiler.compile()
+
+    lines = compiler.lines
+    table = ksp_compiler.placeholders
+
+    print('%d lines, %d strings' % (len(lines), len(table.strings)))
+    report('lines (serialization)', lambda: serialization.dump_lines(lines, table), serialization.load_lines, repetitions)
+    report('lines (pickle)', lambda: pickle.dumps(list(lines), protocol = pickle.HIGHEST_PROTOCOL), pickle.loads, repetitions)
+    report('AST (serialization)', lambda: serialization.dump_module(compiler.module), serialization.load_module, repetitions)
+    report('AST (pickle)', lambda: pickle.dumps(compiler.module, protocol = pickle.HIGHEST_PROTOCOL), pickle.loads, repetitions)
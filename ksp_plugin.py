@@ -23,11 +23,14 @@ sys.path.append(os.path.join(os.path.dirname(__file__), 'compiler'))
 
 import ksp_ast
 import ksp_compiler
+import batch_compiler
+import compiled_output
 import preprocessor_plugins
 import subprocess
 import utils
 
-last_compiler = None
+last_short2original = None  # compacted variable names of the last compilation (short name -> original name)
+incremental_caches = {}  # maps from view id to the IncrementalCache holding the results of the last compilation of that view
 sublime_version = int(sublime.version())
 
 pragma_save_src_re = r'\{\s*\#pragma\s+save_compiled_source\s+(.*)\}'
@@ -176,6 +179,7 @@ class CompileKspThread(threading.Thread):
         self.open_views = open_views
         self.current_view = None
         self.compile_all_open = False
+        self.batch = None
 
         if len(open_views) > 1:
             self.compile_all_open = True
@@ -184,6 +188,9 @@ class CompileKspThread(threading.Thread):
         if self.compiler:
             self.compiler.abort_compilation()
 
+        if self.batch:
+            self.batch.abort()
+
     @classmethod
     def find_view_by_filename(cls, filename, base_path = None):
         if filename is None:
@@ -217,8 +224,118 @@ class CompileKspThread(threading.Thread):
         sublime.error_message(error_msg)
         sublime.status_message('')
 
+    def get_compiler_options(self, settings):
+        check = settings.get('ksp_extra_checks', True)
+
+        return dict(compact                        = settings.get('ksp_compact_output', False),
+                    compact_variables              = settings.get('ksp_compact_variables', False),
+                    shortest_names                 = settings.get('ksp_shortest_variable_names', False),
+                    extra_syntax_checks            = check,
+                    combine_callbacks              = settings.get('ksp_combine_callbacks', False),
+                    optimize                       = check and settings.get('ksp_optimize_code', False),
+                    eliminate_common_subexpressions = check and settings.get('ksp_eliminate_common_subexpressions', False),
+                    lower_select_statements        = check and settings.get('ksp_lower_select_statements', False),
+                    outline_threshold              = settings.get('ksp_outline_threshold', 0),
+                    additional_branch_optimization = check and settings.get('ksp_additional_branch_optimization', False),
+                    sanitize_exit_command          = settings.get('ksp_sanitize_exit_command', True),
+                    add_compiled_date_comment      = settings.get('ksp_add_compiled_date', True),
+                    write_log_on_fail              = settings.get('ksp_write_log_on_fail', False),
+                    compiled_code_tab_size         = settings.get('ksp_compiled_code_tab_size', 2))
+
+    @staticmethod
+    def compaction_map_path(settings, filepath):
+        '''Returns the file in which the compacted variable names of the script at filepath are kept between builds,
+           or None if they should not be kept'''
+        if not filepath or not settings.get('ksp_persistent_compaction_map', False):
+            return None
+
+        return os.path.join(os.path.dirname(filepath), '.%s.kspnames.json' % os.path.basename(filepath))
+
+    def save_compiled_code(self, code, output_files, base_path, delta, short2original = None):
+        settings = sublime.load_settings("KSP.sublime-settings")
+        paths = []
+
+        for f in output_files:
+            if not os.path.isabs(f):
+                f = os.path.join(base_path, f)
+
+            paths.append(f)
+
+        results = compiled_output.write_compiled_code(paths, code, ignore_date_header = settings.get('ksp_ignore_compile_date_changes', False),
+                                                      short2original = short2original)
+
+        utils.log_message('Successfully compiled in %s! Compiled code was saved to:' % delta)
+
+        for p, changed in results:
+            utils.log_message('    %s%s' % (p, '' if changed else ' (unchanged, not rewritten)'))
+
     def run(self):
-        global last_compiler
+        settings = sublime.load_settings("KSP.sublime-settings")
+        num_workers = settings.get('ksp_compile_workers', 1)
+
+        if self.compile_all_open and num_workers > 1:
+            self.run_batch(settings, num_workers)
+        else:
+            self.run_one_by_one(settings)
+
+    def run_batch(self, settings, num_workers):
+        '''Compile all open views in parallel worker processes'''
+        jobs = []
+
+        for view in self.open_views:
+            code = view.substr(sublime.Region(0, view.size()))
+            filepath = view.file_name()
+
+            if not save_src_compiled_re.search(code):
+                utils.log_message('Error: No output path was specified for \'%s\' - skipping compilation for this script!' % (filepath or 'untitled'))
+                continue
+
+            base_path = os.path.dirname(filepath) if filepath else None
+            options = self.get_compiler_options(settings)
+            options['compaction_map_file'] = self.compaction_map_path(settings, filepath)
+            jobs.append(batch_compiler.CompileJob(code, base_path, filepath, options))
+
+        if not jobs:
+            return
+
+        utils.log_message('Compiling %d scripts using up to %d worker processes...' % (len(jobs), num_workers))
+
+        def on_result(result, num_done, num_total):
+            name = result.filename or 'untitled'
+
+            if result.success:
+                utils.log_message('Compiled \'%s\' (%d of %d) in %s.' % (name, num_done, num_total, utils.calc_time_diff(result.duration)))
+            elif result.aborted:
+                utils.log_message('Compilation of \'%s\' was aborted (%d of %d).' % (name, num_done, num_total))
+            else:
+                utils.log_message('Error in \'%s\' (%d of %d)!' % (name, num_done, num_total))
+
+        self.batch = batch_compiler.BatchCompiler(jobs, num_workers, settings.get('ksp_compile_python_executable', None))
+        t1 = datetime.now()
+        results = self.batch.run(on_result)
+        self.batch = None
+
+        first_error = None
+
+        for result in results:
+            if result is None or result.aborted:
+                continue
+
+            if result.success:
+                self.save_compiled_code(result.compiled_code, result.output_files, None, utils.calc_time_diff(result.duration), result.short2original)
+            elif first_error is None:
+                first_error = result
+
+        utils.log_message('Compiled %d scripts in %s.' % (len(jobs), utils.calc_time_diff(datetime.now() - t1)))
+
+        if first_error:
+            self.base_path = os.path.dirname(first_error.filename) if first_error.filename else None
+            self.compile_handle_error(first_error.error_message, first_error.error_lineno, first_error.error_filename)
+        elif settings.get('ksp_play_sound', False) and not any(r is None or r.aborted for r in results):
+            GetSound().play(command = "finished")
+
+    def run_one_by_one(self, settings):
+        global last_short2original
 
         for view in self.open_views:
             self.current_view = view
@@ -230,19 +347,7 @@ class CompileKspThread(threading.Thread):
             else:
                 self.base_path = None
 
-            settings = sublime.load_settings("KSP.sublime-settings")
-
-            compact = settings.get('ksp_compact_output', False)
-            compact_variables = settings.get('ksp_compact_variables', False)
-            check = settings.get('ksp_extra_checks', True)
-            optimize = settings.get('ksp_optimize_code', False)
-            combine_callbacks = settings.get('ksp_combine_callbacks', False)
-            sanitize_exit_command = settings.get('ksp_sanitize_exit_command', True)
-            additional_branch_optimization = settings.get('ksp_additional_branch_optimization', False)
-            add_compiled_date_comment = settings.get('ksp_add_compiled_date', True)
             should_play_sound = settings.get('ksp_play_sound', False)
-            compiled_code_tab_size = settings.get('ksp_compiled_code_tab_size', 2)
-            write_log_on_fail = settings.get('ksp_write_log_on_fail', False)
 
             error_msg = None
             error_lineno = None
@@ -269,21 +374,18 @@ class CompileKspThread(threading.Thread):
 
                     utils.log_message('Compiling \'%s\'...' % filepath)
 
+                incremental_cache = incremental_caches.setdefault(view.id(), ksp_compiler.IncrementalCache())
+
                 self.compiler = ksp_compiler.KSPCompiler(code,
                                                          self.base_path,
-                                                         compact                        = compact,
-                                                         compact_variables              = compact_variables,
-                                                         extra_syntax_checks            = check,
-                                                         combine_callbacks              = combine_callbacks,
-                                                         optimize                       = check and optimize,
-                                                         additional_branch_optimization = check and additional_branch_optimization,
-                                                         sanitize_exit_command          = sanitize_exit_command,
-                                                         add_compiled_date_comment      = add_compiled_date_comment,
-                                                         write_log_on_fail              = write_log_on_fail,
-                                                         compiled_code_tab_size         = compiled_code_tab_size)
+                                                         import_cache = batch_compiler.process_import_cache,
+                                                         incremental_cache = incremental_cache,
+                                                         python_read_cache = incremental_cache.python_read_cache if settings.get('ksp_memoize_python_reads', False) else None,
+                                                         compaction_map_file = self.compaction_map_path(settings, filepath),
+                                                         **self.get_compiler_options(settings))
 
                 if self.compiler.compile(callback = utils.compile_on_progress):
-                    last_compiler = self.compiler
+                    last_short2original = self.compiler.short2original
                     code = self.compiler.compiled_code
                     code = code.replace('\r', '')
                     num_output_files = len(self.compiler.output_files)
@@ -291,44 +393,19 @@ class CompileKspThread(threading.Thread):
                     delta = utils.calc_time_diff(datetime.now() - t1)
 
                     if num_output_files > 0:
-                        paths = []
-
-                        for f in self.compiler.output_files:
-                            if not os.path.isabs(f):
-                                f = os.path.join(self.base_path, f)
-
-                            with io.open(f, 'w', encoding = 'latin-1') as o:
-                                o.write(code)
-
-                            paths.append(f)
-
-                        utils.log_message('Successfully compiled in %s! Compiled code was saved to:' % delta)
-
-                        for p in paths:
-                            utils.log_message('    %s' % p)
+                        self.save_compiled_code(code, self.compiler.output_files, self.base_path, delta, self.compiler.short2original)
                     else:
                         utils.log_message('Successfully compiled in %s! The code is copied to the clipboard, ready to be pasted into Kontakt.' % delta)
                         sublime.set_clipboard(code)
 
-            except ksp_ast.ParseException as e:
-                error_msg = str(e)
-                line_object = self.compiler.lines[e.lineno]
-
-                if line_object:
-                    error_lineno = line_object.lineno-1
-                    error_filename = line_object.filename
+                    full_timings = incremental_cache.full_phase_timings
 
-                if line_object:
-                    error_msg = re.sub(r'line (\d+)', 'line %s' % line_object.lineno, error_msg)
-
-            except ksp_compiler.ParseException as e:
-                error_lineno = e.line.lineno-1
-                error_filename = e.line.filename
-                error_msg = e.message
+                    if full_timings and full_timings is not self.compiler.phase_timings:
+                        utils.log_message('Reused earlier results where nothing changed (all phases: %.0f ms, last full compile: %.0f ms).' %
+                                          (sum(t for (desc, t) in self.compiler.phase_timings) * 1000, sum(t for (desc, t) in full_timings) * 1000))
 
             except Exception as e:
-                error_msg = str(e)
-                error_msg = ''.join(traceback.format_exception(*sys.exc_info()))
+                error_msg, error_filename, error_lineno = batch_compiler.describe_compile_error(self.compiler, e, error_filename)
 
             if error_msg:
                 self.compile_handle_error(error_msg, error_lineno, error_filename)
@@ -834,19 +911,54 @@ class KspOnEnter(sublime_plugin.TextCommand):
 
 
 class KspUncompressCode(sublime_plugin.TextCommand):
-    def run(self, edit):
-        global last_compiler
+    def get_short2original(self):
+        '''Returns the short -> original name dictionary to decode with: the reverse map written next to the compiled
+           code file in this view, or the one written next to the compaction map of the script in this view (if it was
+           compiled with persistent compaction maps), or else the names of the last compilation (if any)'''
+        filepath = self.view.file_name()
+        map_paths = []
+
+        if filepath:
+            map_paths.append(ksp_compiler.output_reverse_map_path(filepath))
+
+        map_path = CompileKspThread.compaction_map_path(sublime.load_settings('KSP.sublime-settings'), filepath)
+
+        if map_path:
+            map_paths.append(ksp_compiler.reverse_map_path(map_path))
+
+        for path in map_paths:
+            short2original = ksp_compiler.load_reverse_map(path)
+
+            if short2original:
+                return short2original
+
+        return last_short2original
+
+    def run(self, edit, map_path = None):
+        if map_path:
+            short2original = ksp_compiler.load_reverse_map(map_path)
+
+            if not short2original:
+                sublime.error_message('No compacted variable names found in \'%s\'!' % map_path)
+                return
+        else:
+            short2original = self.get_short2original()
+
+        if not short2original:
+            # eg. compiled code in an unsaved view: let the user point to the reverse map written next to the output file
+            self.view.window().show_input_panel('Reverse map of the compacted variable names (.kspnames.reverse.json):', '',
+                                                lambda path: self.view.run_command('ksp_uncompress_code', {'map_path': path}),
+                                                None, None)
+            return
 
-        if last_compiler:
-            uncompress = last_compiler.uncompress_variable_names
-            selections = self.view.sel()
+        selections = self.view.sel()
 
-            if len(selections) == 1 and selections[0].empty():
-                selections = [sublime.Region(0, self.view.size())]
+        if len(selections) == 1 and selections[0].empty():
+            selections = [sublime.Region(0, self.view.size())]
 
-            for selection in selections:
-                code = self.view.substr(selection)
-                self.view.replace(edit, selection, uncompress(code))
+        for selection in selections:
+            code = self.view.substr(selection)
+            self.view.replace(edit, selection, ksp_compiler.uncompress_variable_names(code, short2original))
 
     def is_enabled(self):
         # only show the command when a file with KSP syntax highlighting is visible